@@ -0,0 +1,146 @@
+import os
+import asyncio
+import logging
+from typing import Optional, Callable, Dict
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Как в pytubefix: googlevideo замедляет ответы на слишком большие диапазоны
+RANGE_CHUNK_SIZE = 9 * 1024 * 1024
+# Кусок, который читается из ответа и передается писателю
+READ_CHUNK_SIZE = 256 * 1024
+WRITER_QUEUE_SIZE = 16
+
+
+class AsyncFileWriter:
+    """Стадия записи: очередь кусков и фоновая задача, которая пишет их в файл вне цикла событий.
+
+    Ограниченная очередь дает обратное давление: сеть не обгоняет диск больше чем
+    на WRITER_QUEUE_SIZE кусков.
+    """
+
+    def __init__(self, path: str, queue_size: int = WRITER_QUEUE_SIZE):
+        self.path = path
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._file = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        self._file = await asyncio.to_thread(open, self.path, 'wb')
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            try:
+                await self._put(None)
+                await self._task
+            except BaseException:
+                await asyncio.to_thread(self._discard)
+                raise
+            await asyncio.to_thread(self._file.close)
+            return
+        # Ошибка или отмена: останавливаем запись и удаляем частичный файл
+        self._task.cancel()
+        try:
+            await self._task
+        except (asyncio.CancelledError, Exception):
+            pass
+        await asyncio.to_thread(self._discard)
+
+    async def write(self, chunk: bytes):
+        await self._put(chunk)
+
+    async def _put(self, item: Optional[bytes]):
+        if self._task.done():
+            # Писатель упал - пробрасываем его ошибку в загрузку
+            self._task.result()
+        if not self._queue.full():
+            self._queue.put_nowait(item)
+            return
+        put = asyncio.ensure_future(self._queue.put(item))
+        try:
+            await asyncio.wait({put, self._task}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            put_done = put.done()
+            if not put_done:
+                put.cancel()
+        if not put_done:
+            self._task.result()
+
+    async def _run(self):
+        while True:
+            chunk = await self._queue.get()
+            if chunk is None:
+                return
+            await asyncio.to_thread(self._file.write, chunk)
+
+    def _discard(self):
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+async def fetch_to_file(client: httpx.AsyncClient, url: str, path: str, size: int,
+                        on_chunk: Optional[Callable[[bytes], None]] = None,
+                        bandwidth_job=None, headers: Optional[Dict[str, str]] = None,
+                        range_size: int = RANGE_CHUNK_SIZE) -> str:
+    """Скачивает поток диапазонами на цикле событий и пишет его через AsyncFileWriter.
+
+    Отмена корутины прерывает запрос и удаляет частичный файл.
+    """
+    async with AsyncFileWriter(path) as writer:
+        position = 0
+        while position < size:
+            end = min(position + range_size, size) - 1
+            request_headers = dict(headers or {}, Range=f"bytes={position}-{end}")
+            async with client.stream('GET', url, headers=request_headers) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(READ_CHUNK_SIZE):
+                    if bandwidth_job:
+                        await bandwidth_job.consume_async(len(chunk))
+                    await writer.write(chunk)
+                    position += len(chunk)
+                    if on_chunk:
+                        on_chunk(chunk)
+            if position <= end:
+                raise httpx.HTTPError(f"Short read at byte {position} of {size}")
+    return path
+
+
+def _read_file(path: str) -> bytes:
+    # Кусками: f.read() целого файла держит GIL, пока ядро заполняет новые страницы
+    # буфера, и на это время останавливает цикл событий. join больших строк GIL отпускает
+    chunks = []
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE * 4)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return b''.join(chunks)
+
+
+async def read_file(path: str) -> bytes:
+    """Читает файл целиком вне цикла событий.
+
+    PTB читает переданный ему файловый объект синхронно, прямо в цикле, поэтому
+    для отправки лучше передавать уже прочитанные байты.
+    """
+    return await asyncio.to_thread(_read_file, path)
+
+
+def _remove_files(paths):
+    for path in dict.fromkeys(paths):
+        try:
+            if path and os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            logger.error(f"Error deleting file {path}: {e}")
+
+
+async def remove_files(*paths: str):
+    """Удаляет файлы вне цикла событий; отсутствующие и повторяющиеся пропускает"""
+    await asyncio.to_thread(_remove_files, paths)
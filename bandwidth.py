@@ -0,0 +1,202 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Optional, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+INGRESS = 'ingress'
+EGRESS = 'egress'
+
+# Базовый вес задач, зарегистрированных в текущем контексте (фоновые загрузки - меньше 1)
+bandwidth_weight_var: contextvars.ContextVar[float] = contextvars.ContextVar('bandwidth_weight', default=1.0)
+
+
+@contextmanager
+def bandwidth_weight(weight: float):
+    """Задачи, зарегистрированные внутри блока, получают долю полосы с этим весом"""
+    token = bandwidth_weight_var.set(weight)
+    try:
+        yield
+    finally:
+        bandwidth_weight_var.reset(token)
+
+
+class TokenBucket:
+    """Ведро токенов с долгом: резервирование возвращает время ожидания"""
+
+    def __init__(self, rate: float, burst_seconds: float = 1.0, now: float = 0.0):
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self.tokens = rate * burst_seconds
+        self.updated = now
+
+    def reserve(self, amount: int, now: float) -> float:
+        if self.rate <= 0:
+            return 0.0
+        capacity = self.rate * self.burst_seconds
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class BandwidthJob:
+    """Поток байтов одной задачи в одном направлении"""
+
+    def __init__(self, scheduler: 'BandwidthScheduler', direction: str, total: int = 0, weight: float = 1.0):
+        self.scheduler = scheduler
+        self.direction = direction
+        self.total = total
+        self.weight = weight
+        self.done = 0
+        self.bucket = TokenBucket(0, scheduler.burst_seconds, scheduler.clock())
+        self._seen: Dict[str, int] = {}
+
+    @property
+    def remaining(self) -> Optional[int]:
+        return max(0, self.total - self.done) if self.total else None
+
+    def consume(self, amount: int):
+        """Блокирующее ожидание своей доли полосы (для потоков загрузки)"""
+        delay = self.scheduler.reserve(self, amount)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def consume_async(self, amount: int):
+        delay = self.scheduler.reserve(self, amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def wrap_callback(self, callback: Optional[Callable] = None) -> 'ThrottledCallback':
+        """Колбэк pytubefix, который ограничивает скорость и вызывает исходный колбэк"""
+        return ThrottledCallback(self, callback)
+
+    def ydl_hook(self, d: dict):
+        """Хук yt-dlp: считает прирост байтов по каждому файлу задачи"""
+        if d.get('status') != 'downloading':
+            return
+        filename = d.get('filename') or ''
+        downloaded = d.get('downloaded_bytes') or 0
+        delta = downloaded - self._seen.get(filename, 0)
+        self._seen[filename] = downloaded
+        total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+        if total > self.total:
+            self.total = total
+        if delta > 0:
+            self.consume(delta)
+
+    def close(self):
+        self.scheduler.unregister(self)
+
+
+class ThrottledCallback:
+    """Колбэк прогресса pytubefix с ограничением скорости"""
+    __slots__ = ('job', 'callback')
+
+    def __init__(self, job: BandwidthJob, callback: Optional[Callable] = None):
+        self.job = job
+        self.callback = callback
+
+    def __call__(self, stream, chunk, bytes_remaining):
+        filesize = getattr(stream, 'filesize', 0) or 0
+        if filesize > self.job.total:
+            self.job.total = filesize
+        if chunk:
+            self.job.consume(len(chunk))
+        if self.callback:
+            self.callback(stream, chunk, bytes_remaining)
+
+    def set_stage(self, stage: str, total: int = 0):
+        if hasattr(self.callback, 'set_stage'):
+            self.callback.set_stage(stage, total)
+
+
+class BandwidthScheduler:
+    """Иерархические ведра токенов: общий лимит на направление и доля на каждую задачу.
+
+    Доля задачи пропорциональна весу; маленьким и почти завершенным задачам вес
+    увеличивается, чтобы они заканчивались быстрее (минимизация среднего времени задачи).
+    Базовый вес задачи задается при регистрации: спекулятивные загрузки уступают полосу
+    запрошенным. Скорость 0 - без ограничений.
+    """
+
+    def __init__(self, ingress_rate: float = 0, egress_rate: float = 0, small_job_bytes: int = 20 * 1024 * 1024,
+                 small_job_weight: float = 4.0, burst_seconds: float = 1.0, clock: Callable[[], float] = time.monotonic):
+        self.rates = {INGRESS: ingress_rate, EGRESS: egress_rate}
+        self.small_job_bytes = small_job_bytes
+        self.small_job_weight = small_job_weight
+        self.burst_seconds = burst_seconds
+        self.clock = clock
+        now = clock()
+        self._buckets = {direction: TokenBucket(rate, burst_seconds, now) for direction, rate in self.rates.items()}
+        self._jobs = {INGRESS: set(), EGRESS: set()}
+        self._lock = threading.Lock()
+
+    def register(self, direction: str, total: int = 0, weight: Optional[float] = None) -> BandwidthJob:
+        """Новая задача; без weight берется вес из контекста (bandwidth_weight)"""
+        job = BandwidthJob(self, direction, total, bandwidth_weight_var.get() if weight is None else weight)
+        with self._lock:
+            self._jobs[direction].add(job)
+        return job
+
+    def unregister(self, job: BandwidthJob):
+        with self._lock:
+            self._jobs[job.direction].discard(job)
+
+    def weight(self, job: BandwidthJob) -> float:
+        remaining = job.remaining
+        if remaining is not None and remaining <= self.small_job_bytes:
+            return job.weight * self.small_job_weight
+        return job.weight
+
+    def reserve(self, job: BandwidthJob, amount: int) -> float:
+        """Резервирует байты и возвращает, сколько секунд нужно подождать"""
+        rate = self.rates[job.direction]
+        job.done += amount
+        if rate <= 0:
+            return 0.0
+        with self._lock:
+            now = self.clock()
+            jobs = self._jobs[job.direction] or {job}
+            total_weight = sum(self.weight(j) for j in jobs)
+            # Доля задачи пересчитывается при каждом резервировании
+            job.bucket.rate = rate * self.weight(job) / total_weight
+            return max(
+                self._buckets[job.direction].reserve(amount, now),
+                job.bucket.reserve(amount, now)
+            )
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_bandwidth_scheduler() -> BandwidthScheduler:
+    """Общий планировщик для всех загрузчиков и отправки; лимиты в мегабитах из окружения"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            mbit = 1024 * 1024 / 8
+            _scheduler = BandwidthScheduler(
+                ingress_rate=float(os.getenv('BANDWIDTH_INGRESS_MBIT', '0')) * mbit,
+                egress_rate=float(os.getenv('BANDWIDTH_EGRESS_MBIT', '0')) * mbit
+            )
+        return _scheduler
+
+
+async def pace_upload(size: int):
+    """Резервирует полосу отправки перед загрузкой файла в Telegram.
+
+    python-telegram-bot отправляет тело запроса целиком, поэтому ограничение
+    применяется ко времени начала отправки, а не к каждому куску.
+    """
+    job = get_bandwidth_scheduler().register(EGRESS, size)
+    try:
+        await job.consume_async(size)
+    finally:
+        job.close()
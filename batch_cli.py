@@ -0,0 +1,290 @@
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import argparse
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict
+
+from log_setup import setup_logging
+from progress import ProgressTracker, STAGE_CONVERT
+from storage import save
+from youtube_utils import is_youtube_url, extract_video_id
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('pytubefix', 'yt-dlp')
+REPORT_FIELDS = ('url', 'video_id', 'status', 'title', 'path', 'size',
+                 'download_s', 'convert_s', 'total_s', 'error')
+# Как часто обновляется строка прогресса: в терминале и при выводе в файл/пайп
+PROGRESS_INTERVAL_TTY = 0.5
+PROGRESS_INTERVAL_LOG = 10.0
+
+
+def load_backend(name: str):
+    """Класс загрузчика; модуль бэкенда импортируется, только если он выбран"""
+    if name == 'yt-dlp':
+        from downloader_yt_dlp import YouTubeDownloader
+    else:
+        from downloader_pytubefix import YouTubeDownloader
+    return YouTubeDownloader
+
+
+def read_urls(sources: List[str]) -> List[str]:
+    """Ссылки из файлов или stdin ('-'): по одной в строке, '#' в начале - комментарий"""
+    lines = []
+    for source in sources or ['-']:
+        if source == '-':
+            lines += sys.stdin.read().splitlines()
+        else:
+            with open(source, encoding='utf-8') as f:
+                lines += f.read().splitlines()
+    urls = [line.strip() for line in lines if line.strip() and not line.lstrip().startswith('#')]
+    return list(dict.fromkeys(urls))
+
+
+class BatchItem:
+    """Одна ссылка пакета: прогресс и строка отчета"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.video_id = extract_video_id(url) or ''
+        self.status = 'pending'
+        self.title = ''
+        self.path = ''
+        self.size = 0
+        self.download_s = 0.0
+        self.convert_s = 0.0
+        self.total_s = 0.0
+        self.error = ''
+        self.tracker = ProgressTracker(min_interval=0.2)
+
+    def row(self) -> Dict[str, object]:
+        row = {field: getattr(self, field) for field in REPORT_FIELDS}
+        for field in ('download_s', 'convert_s', 'total_s'):
+            row[field] = round(row[field], 3)
+        return row
+
+
+class BatchRunner:
+    """Параллельная загрузка списка ссылок без участия пользователя.
+
+    Готовые файлы переносятся в output_dir как <video_id>_<вариант>.<расширение>, а без
+    output_dir удаляются: остается только копия в общем хранилище (прогрев кэша) и
+    замеры в отчете (нагрузочный тест).
+    """
+
+    def __init__(self, downloader, resolution: Optional[str] = None, audio: bool = False,
+                 output_dir: Optional[str] = None, concurrency: int = 4, skip_existing: bool = False):
+        self.downloader = downloader
+        # MP3 без явного разрешения качается из аудиопотока, как кнопка MP3 в боте
+        self.resolution = resolution or ('audio' if audio else None)
+        self.audio = audio
+        # Готовый MP3 хранится под вариантом 'audio' при любом -r: там его ищет бот
+        self.storage_resolution = 'audio' if audio else resolution
+        self.output_dir = output_dir
+        self.concurrency = max(1, concurrency)
+        self.skip_existing = skip_existing
+        self.variant = 'mp3' if audio else (resolution or 'best')
+        self.items: List[BatchItem] = []
+        self.started_at = 0.0
+        self.finished_at = 0.0
+        self._existing = set()
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+    def run(self, urls: List[str], progress: bool = True) -> List[BatchItem]:
+        self.items = [BatchItem(url) for url in urls]
+        if self.output_dir and self.skip_existing:
+            self._existing = {name.rsplit('.', 1)[0] for name in os.listdir(self.output_dir)}
+        self.started_at = time.time()
+        stop = threading.Event()
+        reporter = None
+        if progress:
+            reporter = threading.Thread(target=self._report_progress, args=(stop,), daemon=True)
+            reporter.start()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='batch')
+        try:
+            for future in [executor.submit(self.process, item) for item in self.items]:
+                future.result()
+        except KeyboardInterrupt:
+            # Начатые загрузки дорабатывают, остальные в отчете помечаются отмененными
+            executor.shutdown(wait=True, cancel_futures=True)
+            for item in self.items:
+                if item.status == 'pending':
+                    item.status = 'cancelled'
+        finally:
+            executor.shutdown(wait=True)
+            self.finished_at = time.time()
+            stop.set()
+            if reporter:
+                reporter.join()
+        return self.items
+
+    def process(self, item: BatchItem):
+        started = time.monotonic()
+        item.status = 'running'
+        try:
+            if not is_youtube_url(item.url) or not item.video_id:
+                raise ValueError("not a YouTube URL")
+            if self.skip_existing and self.exists(item):
+                item.status = 'skipped'
+                return
+
+            result = self.downloader.download_video(item.url, self.resolution, item.tracker)
+            item.download_s = time.monotonic() - started
+            if not result:
+                error = self.downloader.last_error(item.url)
+                raise RuntimeError(f"{type(error).__name__}: {error}" if error else "download failed")
+            path, item.title = result
+
+            if self.audio and not path.endswith('.mp3'):
+                convert_started = time.monotonic()
+                item.tracker.set_stage(STAGE_CONVERT)
+                audio_path = self.downloader.convert_to_mp3(path)
+                self.downloader.cleanup_file(path)
+                if not audio_path:
+                    raise RuntimeError("MP3 conversion failed")
+                path = audio_path
+                # Тот же ключ, под которым бот ищет готовый MP3
+                save(self.downloader.storage,
+                     self.downloader.storage_key(item.url, self.storage_resolution, transform='mp3'),
+                     (path, item.title))
+                item.convert_s = time.monotonic() - convert_started
+
+            item.size = os.path.getsize(path)
+            if self.output_dir:
+                item.path = os.path.join(self.output_dir, f"{self.output_name(item)}{os.path.splitext(path)[1]}")
+                shutil.move(path, item.path)
+            else:
+                self.downloader.cleanup_file(path)
+            item.status = 'ok'
+        except Exception as e:
+            item.status = 'failed'
+            item.error = str(e)
+            logger.error(f"Batch item {item.url} failed: {e}")
+        finally:
+            item.total_s = time.monotonic() - started
+
+    def output_name(self, item: BatchItem) -> str:
+        return f"{item.video_id}_{self.variant}"
+
+    def exists(self, item: BatchItem) -> bool:
+        """Файл уже лежит в output_dir или в общем хранилище"""
+        if self.output_name(item) in self._existing:
+            return True
+        key = self.downloader.storage_key(item.url, self.storage_resolution, transform='mp3' if self.audio else None)
+        return bool(key) and self.downloader.storage.stat(key) is not None
+
+    def summary(self) -> Dict[str, object]:
+        counts = {status: 0 for status in ('ok', 'skipped', 'failed', 'cancelled')}
+        for item in self.items:
+            if item.status in counts:
+                counts[item.status] += 1
+        wall = (self.finished_at or time.time()) - self.started_at
+        total_bytes = sum(item.size for item in self.items)
+        return dict(counts, total=len(self.items), bytes=total_bytes, wall_s=round(wall, 3),
+                    throughput_mb_s=round(total_bytes / wall / (1024 * 1024), 2) if wall > 0 else 0.0)
+
+    def progress_line(self) -> str:
+        finished = [item for item in self.items if item.status not in ('pending', 'running')]
+        active = [item for item in self.items if item.status == 'running']
+        done_bytes = sum(item.size for item in finished)
+        speed = 0.0
+        for item in active:
+            event = item.tracker.latest
+            if event:
+                done_bytes += event.done
+                speed += event.avg_speed
+        failed = sum(1 for item in finished if item.status == 'failed')
+        return (f"[{len(finished)}/{len(self.items)}] active {len(active)}, failed {failed} | "
+                f"{done_bytes / (1024 * 1024):.1f} MB, {speed / (1024 * 1024):.1f} MB/s | "
+                f"{time.time() - self.started_at:.0f}s")
+
+    def _report_progress(self, stop: threading.Event):
+        tty = sys.stderr.isatty()
+        interval = PROGRESS_INTERVAL_TTY if tty else PROGRESS_INTERVAL_LOG
+        while not stop.wait(interval):
+            # В терминале строка перезаписывается, в файле копится история
+            sys.stderr.write(f"\r{self.progress_line()}\033[K" if tty else f"{self.progress_line()}\n")
+            sys.stderr.flush()
+        if tty:
+            sys.stderr.write("\n")
+
+    def write_report(self, path: str, backend: str):
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+                writer.writeheader()
+                writer.writerows(item.row() for item in self.items)
+            return
+        report = {
+            'backend': backend,
+            'resolution': self.resolution,
+            'audio': self.audio,
+            'concurrency': self.concurrency,
+            'started_at': self.started_at,
+            'summary': self.summary(),
+            'items': [item.row() for item in self.items],
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Пакетная загрузка YouTube: прогрев кэша, архивирование и нагрузочные тесты",
+        epilog="Пример: python batch_cli.py urls.txt --backend yt-dlp -j 8 -r 720p -o archive "
+               "--skip-existing --report report.json"
+    )
+    parser.add_argument('sources', nargs='*', metavar='FILE',
+                        help="файлы со ссылками, по одной в строке; '-' или без аргументов - stdin")
+    parser.add_argument('--backend', choices=BACKENDS, default=os.getenv('BATCH_BACKEND', 'pytubefix'))
+    parser.add_argument('-r', '--resolution', default=None,
+                        help="разрешение, например 720p; по умолчанию лучшее доступное")
+    parser.add_argument('--audio', action='store_true', help="конвертировать в MP3; без -r качается только аудиопоток")
+    parser.add_argument('-j', '--concurrency', type=int, default=int(os.getenv('BATCH_CONCURRENCY', '4')),
+                        help="одновременных загрузок (по умолчанию 4)")
+    parser.add_argument('-o', '--output-dir', default=None,
+                        help="куда сложить файлы; без него файлы удаляются после загрузки")
+    parser.add_argument('--skip-existing', action='store_true',
+                        help="пропускать ссылки, уже лежащие в --output-dir или в общем хранилище")
+    parser.add_argument('--report', default=None, help="отчет по каждой ссылке: .json или .csv")
+    parser.add_argument('-q', '--quiet', action='store_true', help="без строки прогресса")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    # Логи только в файл, чтобы не перебивать строку прогресса
+    setup_logging(log_file=os.getenv('LOG_FILE', 'batch.log'), console=False)
+
+    urls = read_urls(args.sources)
+    if not urls:
+        print("Нет ссылок для загрузки", file=sys.stderr)
+        return 2
+
+    runner = BatchRunner(load_backend(args.backend)(), resolution=args.resolution, audio=args.audio,
+                         output_dir=args.output_dir, concurrency=args.concurrency,
+                         skip_existing=args.skip_existing)
+    runner.run(urls, progress=not args.quiet)
+    if args.report:
+        runner.write_report(args.report, args.backend)
+
+    summary = runner.summary()
+    print(f"Готово: {summary['ok']} скачано, {summary['skipped']} пропущено, {summary['failed']} с ошибкой"
+          f"{', ' + str(summary['cancelled']) + ' отменено' if summary['cancelled'] else ''} "
+          f"за {summary['wall_s']:.0f}s ({summary['bytes'] / (1024 * 1024):.1f} MB, "
+          f"{summary['throughput_mb_s']} MB/s)", file=sys.stderr)
+    for item in runner.items:
+        if item.status == 'failed':
+            print(f"  ✗ {item.url}: {item.error}", file=sys.stderr)
+    return 1 if summary['failed'] or summary['cancelled'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
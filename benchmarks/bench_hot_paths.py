@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+from bandwidth import BandwidthScheduler, INGRESS
+from format_selection import available_resolutions, select_format
+from progress import ProgressTracker, SizedStream
+from youtube_utils import is_youtube_url, extract_video_id
+
+URLS = [
+    'https://www.youtube.com/watch?v=dQw4w9WgXcQ',
+    'https://youtu.be/dQw4w9WgXcQ?t=42',
+    'https://m.youtube.com/watch?feature=share&v=dQw4w9WgXcQ',
+    'https://www.youtube.com/shorts/dQw4w9WgXcQ',
+    'привет, как дела?',
+    'https://example.com/watch?v=dQw4w9WgXcQ',
+]
+
+CHUNK = b'\0' * 9 * 1024 * 1024  # кусок pytubefix по умолчанию - 9 MB
+
+
+def bench_is_youtube_url(benchmark, budget):
+    benchmark(lambda: [is_youtube_url(url) for url in URLS])
+    budget(benchmark, 'is_youtube_url')
+
+
+def bench_extract_video_id(benchmark, budget):
+    benchmark(lambda: [extract_video_id(url) for url in URLS])
+    budget(benchmark, 'extract_video_id')
+
+
+def bench_yt_dlp_available_resolutions(benchmark, budget, yt_dlp_info):
+    result = benchmark(available_resolutions, yt_dlp_info['formats'])
+    assert result == ['1080p', '720p', '480p', '360p', '240p', 'audio']
+    budget(benchmark, 'yt_dlp_available_resolutions')
+
+
+@pytest.mark.parametrize('resolution', ['audio', '720p', '144p'])
+def bench_yt_dlp_select_format(benchmark, budget, yt_dlp_info, resolution):
+    format_spec, _ = benchmark(select_format, yt_dlp_info['formats'], resolution)
+    assert format_spec
+    budget(benchmark, 'yt_dlp_select_format')
+
+
+def bench_pytubefix_available_resolutions(benchmark, budget, pytubefix_streams):
+    downloader_module = pytest.importorskip('downloader_pytubefix')
+    downloader = downloader_module.YouTubeDownloader.__new__(downloader_module.YouTubeDownloader)
+    result = benchmark(downloader.get_available_resolutions, {'streams': pytubefix_streams})
+    assert result[-1] == 'audio' and '1080p' in result
+    budget(benchmark, 'pytubefix_available_resolutions')
+
+
+def bench_split_large_file(benchmark, budget, tmp_path):
+    bot_module = pytest.importorskip('bot_fixed')
+    source = tmp_path / 'video.mp4'
+    source.write_bytes(os.urandom(8 * 1024 * 1024))
+
+    parts = benchmark(bot_module.TelegramYTBot.split_large_file, None, str(source), 2 * 1024 * 1024)
+    assert len(parts) == 4
+    budget(benchmark, 'split_large_file')
+
+
+def bench_progress_tracker_tick(benchmark, budget):
+    tracker = ProgressTracker()
+    stream = SizedStream(100 * 1024 * 1024)
+    state = {'remaining': stream.filesize}
+
+    def tick():
+        state['remaining'] = max(0, state['remaining'] - len(CHUNK)) or stream.filesize
+        tracker(stream, CHUNK, state['remaining'])
+
+    benchmark(tick)
+    budget(benchmark, 'progress_tracker_tick')
+
+
+def bench_progress_tracker_ydl_hook(benchmark, budget):
+    tracker = ProgressTracker()
+    event = {'status': 'downloading', 'downloaded_bytes': 0, 'total_bytes': 100 * 1024 * 1024,
+             'fragment_index': 1, 'fragment_count': 100, 'speed': 5e6}
+
+    def tick():
+        event['downloaded_bytes'] = (event['downloaded_bytes'] + len(CHUNK)) % event['total_bytes']
+        tracker.ydl_hook(event)
+
+    benchmark(tick)
+    budget(benchmark, 'progress_tracker_ydl_hook')
+
+
+def bench_throttled_callback_tick(benchmark, budget):
+    # Без лимита полосы обертка не должна заметно замедлять колбэк
+    job = BandwidthScheduler().register(INGRESS)
+    callback = job.wrap_callback(ProgressTracker())
+    stream = SizedStream(100 * 1024 * 1024)
+
+    benchmark(callback, stream, CHUNK, stream.filesize // 2)
+    job.close()
+    budget(benchmark, 'throttled_callback_tick')
+
+
+def bench_combined_progress_tick(benchmark, budget, pytubefix_streams):
+    downloader_module = pytest.importorskip('downloader_pytubefix')
+    video = pytubefix_streams.get_by_itag(137)
+    audio = pytubefix_streams.get_by_itag(140)
+    combined = downloader_module._CombinedProgress([video, audio], ProgressTracker())
+
+    benchmark(combined, video, CHUNK, video.filesize // 2)
+    budget(benchmark, 'combined_progress_tick')
@@ -0,0 +1,42 @@
+import os
+import asyncio
+
+import pytest
+
+from async_download import read_file, remove_files
+from loop_watchdog import LoopWatchdog
+
+# p99 задержки цикла событий, пока обработчики режут и читают большие файлы
+LOOP_LAG_P99_BUDGET = 0.02
+FILE_SIZE = 64 * 1024 * 1024
+HANDLERS = 3
+
+
+def bench_loop_lag_under_file_load(tmp_path):
+    bot_module = pytest.importorskip('bot_fixed')
+    split = bot_module.TelegramYTBot.split_large_file
+
+    sources = []
+    for index in range(HANDLERS):
+        source = tmp_path / f'video{index}.mp4'
+        source.write_bytes(os.urandom(FILE_SIZE))
+        sources.append(str(source))
+
+    async def handler(source: str):
+        # То же, что делает download_and_send_callback с большим видео
+        size = await asyncio.to_thread(os.path.getsize, source)
+        parts = await asyncio.to_thread(split, None, source, size // 4 + 1)
+        for part in parts:
+            await read_file(part)
+        await remove_files(source, *parts)
+
+    async def run():
+        watchdog = LoopWatchdog(interval=0.005, threshold=0.05, report_interval=0)
+        await watchdog.start()
+        await asyncio.gather(*(handler(source) for source in sources))
+        await watchdog.stop()
+        return watchdog.stats()
+
+    stats = asyncio.run(run())
+    assert stats['samples'] > 0
+    assert stats['p99_ms'] <= LOOP_LAG_P99_BUDGET * 1000, f"loop lag p99 {stats['p99_ms']:.1f}ms"
@@ -0,0 +1,39 @@
+import pytest
+
+from identity_pool import Identity
+
+OPTS = {'quiet': True, 'noplaylist': True, 'format': 'best'}
+FORMAT = 'bestaudio/best'
+
+
+# Что стоил запрос без пула: новый YoutubeDL и селектор формата
+def bench_ydl_new_instance(benchmark, budget):
+    yt_dlp = pytest.importorskip('yt_dlp')
+    identity = Identity()
+
+    def create():
+        with yt_dlp.YoutubeDL(identity.apply(dict(OPTS))) as ydl:
+            ydl.build_format_selector(FORMAT)
+    benchmark(create)
+    budget(benchmark, 'ydl_new_instance')
+
+
+def bench_ydl_pool_checkout(benchmark, budget):
+    ydl_pool = pytest.importorskip('ydl_pool')
+    identity = Identity()
+    pool = ydl_pool.YDLPool(OPTS)
+    hooks = [lambda d: None]
+    with pool.checkout(identity):
+        pass
+
+    def checkout():
+        with pool.checkout(identity, overrides={'format': FORMAT}, progress_hooks=hooks) as ydl:
+            return ydl
+    try:
+        ydl = benchmark(checkout)
+        # Выдача не оставляет следов на экземпляре
+        assert ydl.params['format'] == 'best' and hooks[0] not in ydl._progress_hooks
+        assert pool.created == 1
+    finally:
+        pool.close()
+    budget(benchmark, 'ydl_pool_checkout')
@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import inspect
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+sys.path.insert(0, ROOT)
+
+# Абсолютные бюджеты среднего времени одного замера, в секундах
+# (для URL - проход по всему списку URLS).
+# Относительные регрессии между запусками ловит --benchmark-compare-fail.
+BUDGETS = {
+    'is_youtube_url': 25e-6,
+    'extract_video_id': 150e-6,
+    'yt_dlp_available_resolutions': 50e-6,
+    'yt_dlp_select_format': 50e-6,
+    'pytubefix_available_resolutions': 100e-6,
+    'split_large_file': 0.5,
+    'progress_tracker_tick': 3e-6,
+    'progress_tracker_ydl_hook': 5e-6,
+    'throttled_callback_tick': 10e-6,
+    'combined_progress_tick': 10e-6,
+    # Пул окупается, только если выдача намного дешевле нового YoutubeDL
+    'ydl_new_instance': 0.25,
+    'ydl_pool_checkout': 1e-3,
+}
+
+
+def _load(name: str) -> dict:
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return json.load(f)
+
+
+@pytest.fixture(scope='session')
+def yt_dlp_info() -> dict:
+    """Ответ extract_info с форматами типичного музыкального видео"""
+    return _load('yt_dlp_info.json')
+
+
+@pytest.fixture(scope='session')
+def pytubefix_streams():
+    """StreamQuery pytubefix, собранный из streamingData того же видео"""
+    query = pytest.importorskip('pytubefix.query')
+    streams_module = pytest.importorskip('pytubefix.streams')
+    monostate_module = pytest.importorskip('pytubefix.monostate')
+
+    data = _load('pytubefix_streaming_data.json')
+    monostate = monostate_module.Monostate(on_progress=None, on_complete=None, title=data['title'])
+    # Число аргументов Stream меняется между версиями pytubefix (po_token и т.п.)
+    extra = [None] * (len(inspect.signature(streams_module.Stream).parameters) - 2)
+    formats = data['streamingData']['formats'] + data['streamingData']['adaptiveFormats']
+    return query.StreamQuery([streams_module.Stream(fmt, monostate, *extra) for fmt in formats])
+
+
+@pytest.fixture
+def budget():
+    """Проверяет средний результат бенчмарка по BUDGETS после замера"""
+    def check(benchmark, name: str):
+        stats = getattr(benchmark, 'stats', None)
+        if stats is None:
+            # --benchmark-disable: функции выполнены один раз без замера
+            return
+        mean = stats.stats.mean
+        assert mean <= BUDGETS[name], f"{name}: mean {mean * 1e6:.1f}us exceeds budget {BUDGETS[name] * 1e6:.1f}us"
+    return check
@@ -1,31 +1,164 @@
 import os
-import re
+import time
 import logging
 import asyncio
+import uuid
+import threading
+import functools
+from typing import Optional, List
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from downloader_pytubefix import YouTubeDownloader
+from download_errors import DownloadError
+from prefetch import SpeculativePrefetcher, PREFETCH_BANDWIDTH_WEIGHT
+from multipart_upload import MultipartUploader
+from progress import ProgressTracker, format_progress
+from bandwidth import pace_upload
+from transcoder import (FIT_MAX_OVERSHOOT, MediaInfo, probe_media, mp4_faststart, remux_faststart,
+                        make_thumbnail, thumbnail_time)
+from youtube_utils import is_youtube_url, parse_clip_request, clamp_clip, format_timestamp
+from media_server import MediaServer
+from passthrough import PassthroughPlanner
+from async_download import read_file, remove_files
+from storage import restore, save
+from loop_watchdog import LoopWatchdog
+from log_setup import setup_logging, log_context, job_id_var
+from pipeline import Pipeline, Stage, Job, JobCancelled, DONE
 
 load_dotenv()
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
+
+# Кусок копирования при нарезке большого файла на части
+SPLIT_COPY_CHUNK = 1024 * 1024
+
+
+# Лимит размера файла для надежной отправки ботом
+UPLOAD_LIMIT = 50 * 1024 * 1024
+
+
+class DeliveryFailed(Exception):
+    """Задачу нельзя довести до конца; текст исключения показывается пользователю"""
+
+
+class Delivery:
+    """Запрос пользователя, который проходит стадии конвейера отправки"""
+    
+    def __init__(self, query, bot, url: str, resolution: str, audio_only: bool, clip=None,
+                 duration: Optional[float] = None, info: Optional[dict] = None):
+        self.query = query
+        self.bot = bot
+        self.url = url
+        self.resolution = resolution
+        self.audio_only = audio_only
+        self.clip = clip
+        # Длительность из метаданных источника, чтобы не пробовать файл лишний раз
+        self.duration = duration
+        # Данные get_video_info: из них выбираются потоки без повторного извлечения
+        self.info = info
+        self.user_id = query.from_user.id
+        self.chat_id = query.message.chat_id
+        # Результаты стадий
+        self.selection = None  # выбранные потоки, общие для passthrough, памяти и диска
+        # Отмена корутины не прерывает загрузку в потоке - ее останавливает этот флаг
+        self.cancel_event = threading.Event()
+        self.path: Optional[str] = None
+        self.title: Optional[str] = None
+        self.buffered = None  # (BytesIO, имя файла, название) для небольших загрузок в память
+        self.audio_data: Optional[bytes] = None
+        self.parts: List[str] = []
+        self.file_size = 0
+        # Ссылка на встроенный сервер для файлов больше лимита и время ее истечения
+        self.link: Optional[str] = None
+        self.link_expires = 0.0
+        # Длительность, размер кадра и миниатюра для плеера Telegram
+        self.media: Optional[MediaInfo] = None
+        self.thumbnail: Optional[bytes] = None
+        # Отправка из памяти не удалась - повторная загрузка только через диск
+        self.disk_only = False
+
+
 class TelegramYTBot:
     def __init__(self, token: str):
         self.token = token
         self.downloader = YouTubeDownloader()
-        self.application = Application.builder().token(token).build()
+        self.upload_concurrency = int(os.getenv('UPLOAD_CONCURRENCY', '4'))
+        # Сжатие видео, немного превышающих лимит, вместо нарезки на части
+        self.fit_to_limit = os.getenv('FIT_TO_LIMIT_ENABLED', '1') == '1'
+        self.prefetcher = None
+        if os.getenv('PREFETCH_ENABLED', '1') == '1':
+            self.prefetcher = SpeculativePrefetcher(
+                # Загрузчики задач делят кэш метаданных основного, а не открывают свой на каждую
+                functools.partial(YouTubeDownloader, metadata_cache=self.downloader.metadata_cache),
+                work_dir=os.path.join(self.downloader.download_dir, 'prefetch'),
+                max_jobs=int(os.getenv('PREFETCH_MAX_JOBS', '2')),
+                max_bytes=int(os.getenv('PREFETCH_MAX_MB', '500')) * 1024 * 1024,
+                ttl=float(os.getenv('PREFETCH_TTL', '120')),
+                bandwidth_weight=float(os.getenv('PREFETCH_BANDWIDTH_WEIGHT', str(PREFETCH_BANDWIDTH_WEIGHT)))
+            )
+        # Небольшие потоки Telegram забирает сам по ссылке (напрямую или через наш прокси)
+        self.media_server = None
+        public_url = os.getenv('MEDIA_SERVER_PUBLIC_URL')
+        if public_url:
+            files_enabled = os.getenv('FILE_LINKS_ENABLED', '1') == '1'
+            self.media_server = MediaServer(
+                public_url,
+                host=os.getenv('MEDIA_SERVER_HOST', '0.0.0.0'),
+                port=int(os.getenv('MEDIA_SERVER_PORT', '8080')),
+                max_connections=int(os.getenv('MEDIA_SERVER_MAX_CONNECTIONS', '32')),
+                # Файлы больше лимита Telegram отдаем ссылкой вместо нарезки на части
+                files_dir=os.path.join(self.downloader.download_dir, 'links') if files_enabled else None,
+                file_ttl=float(os.getenv('FILE_LINK_TTL_HOURS', '24')) * 3600,
+                secret=os.getenv('MEDIA_SERVER_SECRET')
+            )
+        self.passthrough = None
+        if os.getenv('PASSTHROUGH_ENABLED', '1') == '1':
+            self.passthrough = PassthroughPlanner(self.media_server)
+        # Доставка идет конвейером: загрузки, ffmpeg и отправки разных задач не ждут друг друга,
+        # а число задач на каждой стадии ограничено отдельно
+        process_workers = int(os.getenv('PIPELINE_PROCESS_WORKERS', '0')) or os.cpu_count() or 2
+        self.pipeline = Pipeline([
+            Stage('fetch', self.stage_fetch, workers=int(os.getenv('PIPELINE_FETCH_WORKERS', '8'))),
+            Stage('process', self.stage_process, workers=process_workers),
+            Stage('prepare', self.stage_prepare, workers=process_workers),
+            Stage('upload', self.stage_upload, workers=int(os.getenv('PIPELINE_UPLOAD_WORKERS', '4'))),
+        ], name='delivery')
+        # Текущая задача каждого пользователя, чтобы отменить брошенную
+        self.active_jobs = {}
+        
+        self.watchdog = None
+        if os.getenv('LOOP_WATCHDOG_ENABLED', '1') == '1':
+            self.watchdog = LoopWatchdog(
+                threshold=float(os.getenv('LOOP_LAG_THRESHOLD_MS', '100')) / 1000,
+                report_interval=float(os.getenv('LOOP_LAG_REPORT_INTERVAL', '300'))
+            )
+        self.application = (
+            Application.builder()
+            .token(token)
+            # Загрузки не держат потоки, поэтому обработчики разных пользователей идут параллельно
+            .concurrent_updates(True)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
         self.setup_handlers()
     
+    async def post_init(self, application: Application):
+        if self.watchdog:
+            await self.watchdog.start()
+        await self.pipeline.start()
+        if self.media_server:
+            await self.media_server.start()
+    
+    async def post_shutdown(self, application: Application):
+        await self.pipeline.stop()
+        if self.media_server:
+            await self.media_server.stop()
+        if self.watchdog:
+            await self.watchdog.stop()
+    
     def setup_handlers(self):
         self.application.add_handler(CommandHandler("start", self.start))
         self.application.add_handler(CommandHandler("help", self.help_command))
@@ -59,32 +192,12 @@ class TelegramYTBot:
         await update.message.reply_text(help_text)
     
     def is_youtube_url(self, text: str) -> bool:
-        youtube_regex = re.compile(
-            r'(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/'
-            r'(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})'
-        )
-        return bool(youtube_regex.match(text))
+        return is_youtube_url(text)
     
     def create_progress_callback(self, query, context):
-        progress_data = {'query': query, 'context': context, 'current_progress': 0}
-        last_pct = [0]
-        
-        def progress_callback(stream, chunk, bytes_remaining):
-            try:
-                total = stream.filesize
-                done = total - bytes_remaining
-                pct = int(done / total * 100)
-                
-                # Обновляем каждые 5%
-                if pct >= last_pct[0] + 5:
-                    progress_data['current_progress'] = pct
-                    last_pct[0] = pct
-                    logger.info(f"Progress: {pct}%")
-            except Exception as e:
-                logger.error(f"Progress callback error: {e}")
-        
-        progress_callback.progress_data = progress_data
-        return progress_callback
+        # Трекер подходит и как колбэк pytubefix, и как хук yt-dlp;
+        # последнее событие читает update_progress_periodically
+        return ProgressTracker()
     
     def split_large_file(self, file_path: str, max_size: int = 50 * 1024 * 1024) -> list:
         """Разбивает большой файл на части"""
@@ -94,19 +207,21 @@ class TelegramYTBot:
                 return [file_path]
             
             part_files = []
-            with open(file_path, 'rb') as f:
-                part_num = 1
-                while True:
-                    chunk = f.read(max_size)
-                    if not chunk:
-                        break
-                    
+            with open(file_path, 'rb', buffering=0) as f:
+                for part_num, offset in enumerate(range(0, file_size, max_size), 1):
                     part_path = f"{file_path}.part{part_num:03d}"
-                    with open(part_path, 'wb') as part_file:
-                        part_file.write(chunk)
+                    with open(part_path, 'wb', buffering=0) as part_file:
+                        # Копируем кусками по 1 MB, а не частью целиком: меньше памяти
+                        # и GIL не держится на заполнении буфера размером с часть
+                        remaining = min(max_size, file_size - offset)
+                        while remaining:
+                            chunk = f.read(min(SPLIT_COPY_CHUNK, remaining))
+                            if not chunk:
+                                break
+                            part_file.write(chunk)
+                            remaining -= len(chunk)
                     
                     part_files.append(part_path)
-                    part_num += 1
             
             return part_files
         except Exception as e:
@@ -115,18 +230,32 @@ class TelegramYTBot:
     
     async def update_progress_periodically(self, progress_callback, query):
         """Периодически обновляет прогресс в сообщении"""
+        last_shown_text = None
+        last_shown_stage = None
         last_shown_progress = 0
+        last_shown_at = 0.0
+        loop = asyncio.get_event_loop()
         
         while True:
             try:
                 await asyncio.sleep(1)  # Проверяем каждую секунду
                 
-                current_progress = progress_callback.progress_data.get('current_progress', 0)
+                event = progress_callback.latest
+                if event is None:
+                    continue
+                text = format_progress(event)
                 
-                # Показываем изменения прогресса каждые 5%
-                if current_progress >= last_shown_progress + 5:
-                    await query.edit_message_text(f"⏬ Скачивание: {current_progress}%")
-                    last_shown_progress = current_progress
+                # Показываем изменения прогресса каждые 5% или раз в 5 секунд (скорость и ETA)
+                if text != last_shown_text and (
+                    event.stage != last_shown_stage
+                    or event.percent >= last_shown_progress + 5
+                    or loop.time() - last_shown_at >= 5
+                ):
+                    await query.edit_message_text(text)
+                    last_shown_text = text
+                    last_shown_stage = event.stage
+                    last_shown_progress = event.percent
+                    last_shown_at = loop.time()
                     
             except asyncio.CancelledError:
                 break
@@ -143,21 +272,35 @@ class TelegramYTBot:
             )
             return
         
-        await self.process_youtube_url(update, context, message_text)
+        # "ссылка 1:23-2:45" или "ссылка?t=83 2:45" - нужен только фрагмент
+        url, clip = parse_clip_request(message_text)
+        with log_context(job_id=uuid.uuid4().hex[:8], user_id=update.effective_user.id):
+            await self.process_youtube_url(update, context, url, clip)
+    
+    def cancel_active_download(self, user_id: int) -> bool:
+        job = self.active_jobs.pop(user_id, None)
+        if job and not job.done:
+            job.cancel()
+            return True
+        return False
     
-    async def process_youtube_url(self, update: Update, context: ContextTypes.DEFAULT_TYPE, url: str):
+    async def process_youtube_url(self, update: Update, context: ContextTypes.DEFAULT_TYPE, url: str,
+                                  clip=None):
+        if self.cancel_active_download(update.effective_user.id):
+            logger.info(f"Cancelled abandoned download for user {update.effective_user.id}")
         try:
             status_message = await update.message.reply_text("🔍 Получаю информацию о видео...")
             
             # Запускаем в отдельном потоке, так как yt-dlp синхронный
-            loop = asyncio.get_event_loop()
-            info = await loop.run_in_executor(None, self.downloader.get_video_info, url)
+            info = await asyncio.to_thread(self.downloader.get_video_info, url)
             
             if not info:
-                await status_message.edit_text("❌ Не удалось получить информацию о видео.")
+                error = self.downloader.last_error(url)
+                reason = f"\n{error.user_message}" if error else ""
+                await status_message.edit_text(f"❌ Не удалось получить информацию о видео.{reason}")
                 return
             
-            resolutions = await loop.run_in_executor(None, self.downloader.get_available_resolutions, info)
+            resolutions = await asyncio.to_thread(self.downloader.get_available_resolutions, info)
             if not resolutions:
                 await status_message.edit_text("❌ Не найдено доступных форматов для скачивания.")
                 return
@@ -166,6 +309,8 @@ class TelegramYTBot:
             duration = info.get('duration', 0)
             view_count = info.get('view_count', 0)
             
+            clip = clamp_clip(clip, duration)
+            
             # Создаем клавиатуру с кнопками
             keyboard = []
             
@@ -184,9 +329,11 @@ class TelegramYTBot:
             
             reply_markup = InlineKeyboardMarkup(keyboard)
             
+            clip_line = f"✂️ Фрагмент: {format_timestamp(clip[0])}–{format_timestamp(clip[1])}\n" if clip else ""
             await status_message.edit_text(
                 f"📹 Видео: {title}\n"
                 f"⏱️ Длительность: {duration // 60}:{duration % 60:02d}\n"
+                f"{clip_line}"
                 f"👁️ Просмотры: {view_count:,}\n\n"
                 f"Выберите формат для скачивания:",
                 reply_markup=reply_markup
@@ -196,9 +343,25 @@ class TelegramYTBot:
                 'url': url,
                 'info': info,
                 'resolutions': resolutions,
-                'status_message': status_message
+                'status_message': status_message,
+                'clip': clip
             }
             
+            # Пока пользователь выбирает качество, начинаем качать самый вероятный вариант
+            # (фрагменту это не нужно - он качается быстро и целиком не нужен)
+            if self.prefetcher and not clip:
+                try:
+                    await asyncio.to_thread(
+                        self.prefetcher.start,
+                        update.effective_user.id,
+                        url,
+                        info,
+                        resolutions,
+                        functools.partial(self.downloader.estimate_size, info)
+                    )
+                except Exception as e:
+                    logger.error(f"Error starting prefetch: {e}")
+            
         except Exception as e:
             logger.error(f"Error processing URL: {e}")
             await update.message.reply_text("❌ Произошла ошибка при обработке ссылки.")
@@ -214,342 +377,512 @@ class TelegramYTBot:
         
         callback_data = query.data
         
-        if callback_data == "audio":
-            await self.download_and_send_callback(query, context, resolution="audio", audio_only=True)
-        elif callback_data.startswith("video_"):
-            resolution = callback_data.replace("video_", "")
-            await self.download_and_send_callback(query, context, resolution=resolution)
+        if self.prefetcher and (callback_data == "audio" or callback_data.startswith("video_")):
+            self.prefetcher.stats.record(query.from_user.id, callback_data.replace("video_", ""))
+        
+        # Каждое нажатие - отдельная задача: ее записи в логе связаны одним job_id
+        with log_context(job_id=uuid.uuid4().hex[:8], user_id=query.from_user.id):
+            if callback_data == "audio":
+                await self.download_and_send_callback(query, context, resolution="audio", audio_only=True)
+            elif callback_data.startswith("video_"):
+                resolution = callback_data.replace("video_", "")
+                await self.download_and_send_callback(query, context, resolution=resolution)
     
-    async def download_and_send_callback(self, query, context: ContextTypes.DEFAULT_TYPE, 
-                                        resolution: str = None, audio_only: bool = False):
+    async def send_from_memory(self, delivery: Delivery) -> bool:
+        """Отправляет скачанный в память файл. False - нужно повторить через диск"""
+        query = delivery.query
+        buffer, filename, title = delivery.buffered
         try:
-            video_info = context.user_data.get('video_info')
-            if not video_info:
-                await query.edit_message_text("❌ Сначала отправь ссылку на видео.")
-                return
-            
-            await query.edit_message_text("⏬ Начинаю скачивание...")
-            
-            progress_callback = self.create_progress_callback(query, context)
-            
-            # Запускаем периодическое обновление прогресса
-            progress_task = asyncio.create_task(self.update_progress_periodically(progress_callback, query))
-            
-            # Запускаем скачивание в отдельном потоке
-            loop = asyncio.get_event_loop()
+            if delivery.audio_only:
+                await query.edit_message_text("📤 Отправляю аудио...")
+                await pace_upload(len(delivery.audio_data))
+                await delivery.bot.send_audio(
+                    chat_id=delivery.chat_id,
+                    audio=delivery.audio_data,
+                    filename=os.path.splitext(filename)[0] + '.mp3',
+                    title=title[:50],
+                    **delivery.media.send_kwargs(),
+                    caption=f"🎵 {title}",
+                    read_timeout=300,
+                    write_timeout=300,
+                    connect_timeout=60,
+                    pool_timeout=60
+                )
+                await query.edit_message_text("✅ Аудио отправлено!")
+            else:
+                await query.edit_message_text("📤 Отправляю видео...")
+                await pace_upload(buffer.getbuffer().nbytes)
+                await delivery.bot.send_video(
+                    chat_id=delivery.chat_id,
+                    video=buffer,
+                    filename=filename,
+                    caption=f"📹 {title}",
+                    supports_streaming=True,
+                    thumbnail=delivery.thumbnail,
+                    **delivery.media.send_kwargs(),
+                    read_timeout=600,
+                    write_timeout=600,
+                    connect_timeout=120,
+                    pool_timeout=120
+                )
+                await query.edit_message_text("✅ Видео отправлено!")
+            return True
+        except Exception as e:
+            logger.error(f"Error sending from memory: {e}")
+            return False
+    
+    @staticmethod
+    def source_media(delivery: Delivery) -> MediaInfo:
+        """Метаданные без ffprobe: длительность из источника, размер кадра из выбранного потока"""
+        width, height = delivery.selection.frame_size() if delivery.selection else (None, None)
+        return MediaInfo(duration=delivery.duration, width=width, height=height)
+    
+    async def select_streams(self, delivery: Delivery):
+        """Одно извлечение на задачу: выбранные потоки нужны passthrough, загрузке в память и на диск"""
+        if delivery.selection is None:
             try:
-                result = await loop.run_in_executor(
-                    None, 
-                    self.downloader.download_video,
-                    video_info['url'], 
-                    resolution,
-                    progress_callback
+                delivery.selection = await asyncio.to_thread(
+                    self.downloader.select_streams, delivery.url, delivery.resolution, delivery.info
                 )
-            finally:
-                # Останавливаем задачу обновления прогресса
-                progress_task.cancel()
-                try:
-                    await progress_task
-                except asyncio.CancelledError:
-                    pass
-            
-            if not result:
-                await query.edit_message_text("❌ Ошибка при скачивании видео.")
-                return
-            
-            video_path, title = result
-            
-            if audio_only:
-                # Проверяем, уже ли это MP3 файл
-                if video_path.endswith('.mp3'):
-                    audio_path = video_path
-                    await query.edit_message_text("📤 Отправляю аудио...")
-                else:
-                    await query.edit_message_text("🎵 Конвертирую в MP3...")
-                    audio_path = await loop.run_in_executor(None, self.downloader.convert_to_mp3, video_path)
-                
-                if audio_path:
-                    # Проверяем размер файла
-                    file_size = os.path.getsize(audio_path)
-                    max_size = 50 * 1024 * 1024  # 50 MB лимит для аудио в Telegram
-                    
-                    if file_size > max_size:
-                        size_mb = file_size / (1024 * 1024)
-                        await query.edit_message_text(
-                            f"❌ Аудио файл слишком большой ({size_mb:.1f} MB).\n"
-                            f"Максимальный размер для аудио: 50 MB.\n"
-                            f"Попробуйте выбрать видео вместо аудио."
-                        )
-                        self.downloader.cleanup_file(video_path)
-                        if audio_path != video_path:
-                            self.downloader.cleanup_file(audio_path)
-                        return
-                    
-                    if not video_path.endswith('.mp3'):
-                        await query.edit_message_text("📤 Отправляю аудио...")
-                    
-                    with open(audio_path, 'rb') as audio_file:
-                        await context.bot.send_audio(
-                            chat_id=query.message.chat_id,
-                            audio=audio_file,
-                            title=title[:50],
-                            caption=f"🎵 {title}",
-                            read_timeout=300,
-                            write_timeout=300,
-                            connect_timeout=60,
-                            pool_timeout=60
-                        )
-                    
-                    self.downloader.cleanup_file(video_path)
-                    if audio_path != video_path:
-                        self.downloader.cleanup_file(audio_path)
-                    await query.edit_message_text("✅ Аудио отправлено!")
-                else:
-                    await query.edit_message_text("❌ Ошибка при конвертации в MP3.")
+            except DownloadError as e:
+                logger.error(f"Error selecting streams: {e}")
+                raise DeliveryFailed(f"❌ Ошибка при скачивании видео.{self.error_reason(delivery.url)}")
+        return delivery.selection
+    
+    async def send_passthrough(self, delivery: Delivery) -> bool:
+        """Отдает Telegram ссылку на поток вместо скачивания. False - нужен обычный путь"""
+        query, bot = delivery.query, delivery.bot
+        if delivery.audio_only:
+            # Пользователь выбрал MP3, а прямой поток - M4A: нужна конвертация
+            return False
+        # Размер известен из метаданных: большие файлы отсеиваем до выбора потоков и проверки ссылки
+        known_size = await asyncio.to_thread(self.downloader.estimate_size, delivery.info or {}, delivery.resolution)
+        if known_size and known_size > self.passthrough.max_bytes:
+            return False
+        selection = await self.select_streams(delivery)
+        stream = await asyncio.to_thread(
+            self.downloader.resolve_direct_stream, delivery.url, delivery.resolution, selection
+        )
+        if not stream:
+            return False
+        media_url = await self.passthrough.delivery_url(stream)
+        if not media_url:
+            return False
+        # Файл не скачивается, поэтому метаданные для плеера берутся из источника
+        media = self.source_media(delivery)
+        
+        try:
+            if stream.kind == 'audio':
+                await query.edit_message_text("📤 Отправляю аудио...")
+                await bot.send_audio(
+                    chat_id=query.message.chat_id,
+                    audio=media_url,
+                    title=stream.title[:50],
+                    **media.send_kwargs(),
+                    caption=f"🎵 {stream.title}",
+                    read_timeout=300,
+                    write_timeout=300,
+                    connect_timeout=60,
+                    pool_timeout=60
+                )
+                await query.edit_message_text("✅ Аудио отправлено!")
             else:
-                # Проверяем размер видео файла
-                file_size = os.path.getsize(video_path)
-                size_mb = file_size / (1024 * 1024)
-                
-                # Более строгий лимит для надежной отправки
-                max_size = 50 * 1024 * 1024  # 50 MB лимит для надежной отправки
-                
-                if file_size > max_size:
-                    # Предлагаем разбить файл на части
-                    await query.edit_message_text(
-                        f"📁 Видео файл большой ({size_mb:.1f} MB).\n"
-                        f"Разбиваю на части для отправки..."
-                    )
-                    
-                    part_files = self.split_large_file(video_path)
-                    
-                    if len(part_files) > 1:
-                        await query.edit_message_text(f"📤 Отправляю видео ({len(part_files)} частей)...")
-                        
-                        for i, part_path in enumerate(part_files, 1):
-                            try:
-                                with open(part_path, 'rb') as part_file:
-                                    await context.bot.send_document(
-                                        chat_id=query.message.chat_id,
-                                        document=part_file,
-                                        caption=f"📹 {title} (часть {i}/{len(part_files)})",
-                                        read_timeout=600,
-                                        write_timeout=600,
-                                        connect_timeout=120,
-                                        pool_timeout=120
-                                    )
-                                # Удаляем часть после отправки
-                                os.remove(part_path)
-                            except Exception as e:
-                                logger.error(f"Error sending part {i}: {e}")
-                                await query.edit_message_text(f"❌ Ошибка при отправке части {i}")
-                                return
-                        
-                        await query.edit_message_text(f"✅ Видео отправлено ({len(part_files)} частей)!")
-                    else:
-                        # Если не удалось разбить, отправляем как обычно
-                        await query.edit_message_text("📤 Отправляю видео...")
-                        try:
-                            with open(video_path, 'rb') as video_file:
-                                await context.bot.send_video(
-                                    chat_id=query.message.chat_id,
-                                    video=video_file,
-                                    caption=f"📹 {title}",
-                                    supports_streaming=True,
-                                    read_timeout=600,
-                                    write_timeout=600,
-                                    connect_timeout=120,
-                                    pool_timeout=120
-                                )
-                        except Exception as e:
-                            logger.error(f"Error sending video: {e}")
-                            await query.edit_message_text("❌ Ошибка при отправке видео")
-                            return
-                    
-                    self.downloader.cleanup_file(video_path)
-                    return
-                
-                # Если файл не большой, отправляем как обычно
                 await query.edit_message_text("📤 Отправляю видео...")
-                
-                # Retry логика для отправки видео
-                for attempt in range(3):  # 3 попытки
-                    try:
-                        with open(video_path, 'rb') as video_file:
-                            await context.bot.send_video(
-                                chat_id=query.message.chat_id,
-                                video=video_file,
-                                caption=f"📹 {title}",
-                                supports_streaming=True,
-                                read_timeout=600,  # Увеличиваем таймауты
-                                write_timeout=600,
-                                connect_timeout=120,
-                                pool_timeout=120
-                            )
-                        break  # Успешно отправили, выходим из цикла
-                    except Exception as send_error:
-                        logger.error(f"Video send attempt {attempt + 1} failed: {send_error}")
-                        if attempt == 2:  # Последняя попытка
-                            raise  # Перебрасываем исключение
-                        await asyncio.sleep(5)  # Пауза перед повторной попыткой
-                
-                self.downloader.cleanup_file(video_path)
+                await bot.send_video(
+                    chat_id=query.message.chat_id,
+                    video=media_url,
+                    caption=f"📹 {stream.title}",
+                    supports_streaming=True,
+                    **media.send_kwargs(),
+                    read_timeout=600,
+                    write_timeout=600,
+                    connect_timeout=120,
+                    pool_timeout=120
+                )
                 await query.edit_message_text("✅ Видео отправлено!")
-            
-            context.user_data.pop('video_info', None)
-            
+            route = 'direct URL' if media_url == stream.url else 'proxy'
+            logger.info(f"Passthrough delivery via {route}: {stream.size} bytes")
+            return True
         except Exception as e:
-            logger.error(f"Error in download_and_send_callback: {e}")
-            await query.edit_message_text("❌ Произошла ошибка при скачивании.")
+            logger.warning(f"Passthrough delivery failed, falling back to download: {e}")
+            return False
+    
+    def restore_stored(self, url: str, resolution: str, clip, audio_only: bool):
+        """Готовый файл из общего хранилища: сначала MP3 для аудио, затем исходная загрузка"""
+        transforms = ('mp3', None) if audio_only else (None,)
+        for transform in transforms:
+            key = self.downloader.storage_key(url, resolution, clip, transform)
+            stored = restore(self.downloader.storage, key, self.downloader.download_dir)
+            if stored:
+                return stored
+        return None
+    
+    def stored_transform(self, url: str, resolution: str, clip, transform: str, title: str,
+                         produce) -> Optional[str]:
+        """Результат преобразования (MP3, сжатие) из общего хранилища или produce() с сохранением"""
+        key = self.downloader.storage_key(url, resolution, clip, transform)
+        stored = restore(self.downloader.storage, key, self.downloader.download_dir)
+        if stored:
+            return stored[0]
+        path = produce()
+        save(self.downloader.storage, key, (path, title) if path else None)
+        return path
     
-    async def download_and_send(self, update: Update, context: ContextTypes.DEFAULT_TYPE, 
-                               resolution: str = None, audio_only: bool = False):
+    def error_reason(self, url: str) -> str:
+        error = self.downloader.last_error(url)
+        return f"\n{error.user_message}" if error else ""
+    
+    def retry_from_disk(self, delivery: Delivery) -> str:
+        """Отправить из памяти не вышло - качаем заново через диск"""
+        delivery.buffered = None
+        delivery.audio_data = None
+        delivery.media = None
+        delivery.thumbnail = None
+        delivery.disk_only = True
+        return 'fetch'
+    
+    async def publish_link(self, delivery: Delivery) -> bool:
+        """Файл больше лимита Telegram - отдаем его встроенным сервером по ссылке"""
+        if not (self.media_server and self.media_server.files_dir):
+            return False
+        filename = f"{delivery.title}{os.path.splitext(delivery.path)[1]}"
+        # Файл переносится в раздачу, поэтому очистка задачи его уже не найдет
+        delivery.link, delivery.link_expires = await asyncio.to_thread(
+            self.media_server.publish_file, delivery.path, filename
+        )
+        return True
+    
+    async def stage_fetch(self, job: Job):
+        """Сеть: passthrough, общее хранилище, заранее начатая загрузка, память или диск"""
+        delivery = job.payload
+        query = delivery.query
+        result = None
+        prefetched = None
+        if delivery.disk_only:
+            await query.edit_message_text("⏬ Повторяю скачивание...")
+        else:
+            if not delivery.clip and self.passthrough and await self.send_passthrough(delivery):
+                if self.prefetcher:
+                    self.prefetcher.cancel(delivery.user_id)
+                return DONE
+            
+            # Этот файл мог уже скачать или сконвертировать любой узел
+            result = await asyncio.to_thread(
+                self.restore_stored, delivery.url, delivery.resolution, delivery.clip, delivery.audio_only
+            )
+            if self.prefetcher:
+                if result:
+                    self.prefetcher.cancel(delivery.user_id)
+                else:
+                    prefetched = self.prefetcher.claim(delivery.user_id, delivery.url, delivery.resolution)
+        
+        progress_callback = self.create_progress_callback(query, None)
+        
+        # Запускаем периодическое обновление прогресса
+        progress_task = asyncio.create_task(self.update_progress_periodically(progress_callback, query))
         try:
-            video_info = context.user_data.get('video_info')
-            if not video_info:
-                await update.message.reply_text("❌ Сначала отправь ссылку на видео.")
-                return
+            if delivery.clip and not result:
+                # Только нужные диапазоны байт вместо всего файла
+                result = await asyncio.to_thread(
+                    self.downloader.download_clip, delivery.url, delivery.resolution, *delivery.clip,
+                    selection=await self.select_streams(delivery)
+                )
+                if not result:
+                    raise DeliveryFailed(f"❌ Не удалось вырезать фрагмент.{self.error_reason(delivery.url)}")
             
-            status_message = video_info['status_message']
-            await status_message.edit_text("⏬ Начинаю скачивание...")
+            if prefetched and not result:
+                # Этот формат уже качается заранее - подключаемся к загрузке
+                prefetched.attach(progress_callback)
+                result = await prefetched.wait(self.downloader.download_dir)
             
-            progress_callback = self.create_progress_callback(status_message)
+            # Небольшие потоки скачиваем сразу в память, минуя диск
+            if not result and not delivery.disk_only:
+                try:
+                    delivery.buffered = await asyncio.to_thread(
+                        self.downloader.download_to_buffer,
+                        delivery.url,
+                        delivery.resolution,
+                        progress_callback,
+                        selection=await self.select_streams(delivery),
+                        cancel_event=delivery.cancel_event
+                    )
+                except asyncio.CancelledError:
+                    delivery.cancel_event.set()
+                    raise
+            if not result and not delivery.buffered:
+                result = await self.downloader.download_video_async(
+                    delivery.url, delivery.resolution, progress_callback,
+                    selection=await self.select_streams(delivery)
+                )
+        finally:
+            # Останавливаем задачу обновления прогресса
+            progress_task.cancel()
+            try:
+                await progress_task
+            except asyncio.CancelledError:
+                pass
+        
+        if delivery.buffered:
+            job.add_cleanup(delivery.buffered[0].close)
+            return None
+        if not result:
+            raise DeliveryFailed(f"❌ Ошибка при скачивании видео.{self.error_reason(delivery.url)}")
+        
+        delivery.path, delivery.title = result
+        job.add_cleanup(functools.partial(remove_files, delivery.path))
+        return None
+    
+    async def stage_process(self, job: Job):
+        """CPU и диск: MP3, проверка размера, сжатие под лимит, нарезка на части"""
+        delivery = job.payload
+        query = delivery.query
+        
+        if delivery.buffered:
+            if delivery.audio_only:
+                await query.edit_message_text("🎵 Конвертирую в MP3...")
+                buffer = delivery.buffered[0]
+                delivery.audio_data = await asyncio.to_thread(
+                    lambda: self.downloader.convert_to_mp3_bytes(buffer.getvalue(), delivery.duration)
+                )
+                if not delivery.audio_data or len(delivery.audio_data) > UPLOAD_LIMIT:
+                    return self.retry_from_disk(delivery)
+            return None
+        
+        if delivery.audio_only:
+            # Проверяем, уже ли это MP3 файл
+            if not delivery.path.endswith('.mp3'):
+                await query.edit_message_text("🎵 Конвертирую в MP3...")
+                audio_path = await asyncio.to_thread(
+                    self.stored_transform, delivery.url, delivery.resolution, delivery.clip, 'mp3',
+                    delivery.title,
+                    functools.partial(self.downloader.convert_to_mp3, delivery.path, delivery.duration)
+                )
+                if not audio_path:
+                    raise DeliveryFailed("❌ Ошибка при конвертации в MP3.")
+                job.add_cleanup(functools.partial(remove_files, audio_path))
+                delivery.path = audio_path
             
-            # Запускаем скачивание в отдельном потоке
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                None, 
-                self.downloader.download_video,
-                video_info['url'], 
-                resolution,
-                progress_callback
+            delivery.file_size = await asyncio.to_thread(os.path.getsize, delivery.path)
+            if delivery.file_size > UPLOAD_LIMIT and not await self.publish_link(delivery):
+                raise DeliveryFailed(
+                    f"❌ Аудио файл слишком большой ({delivery.file_size / (1024 * 1024):.1f} MB).\n"
+                    f"Максимальный размер для аудио: 50 MB.\n"
+                    f"Попробуйте выбрать видео вместо аудио."
+                )
+            return None
+        
+        delivery.file_size = await asyncio.to_thread(os.path.getsize, delivery.path)
+        size_mb = delivery.file_size / (1024 * 1024)
+        
+        if self.fit_to_limit and UPLOAD_LIMIT < delivery.file_size <= UPLOAD_LIMIT * FIT_MAX_OVERSHOOT:
+            # Немного больше лимита - один сжатый файл удобнее нарезки на части
+            await query.edit_message_text(
+                f"🗜 Видео немного больше лимита ({size_mb:.1f} MB). Сжимаю до 50 MB..."
             )
+            fitted_path = await asyncio.to_thread(
+                self.stored_transform, delivery.url, delivery.resolution, delivery.clip, f'fit{UPLOAD_LIMIT}',
+                delivery.title, functools.partial(self.downloader.fit_to_limit, delivery.path, UPLOAD_LIMIT)
+            )
+            if fitted_path:
+                await remove_files(delivery.path)
+                job.add_cleanup(functools.partial(remove_files, fitted_path))
+                delivery.path = fitted_path
+                delivery.file_size = await asyncio.to_thread(os.path.getsize, delivery.path)
+                size_mb = delivery.file_size / (1024 * 1024)
+        
+        if delivery.file_size > UPLOAD_LIMIT and await self.publish_link(delivery):
+            return None
+        
+        if delivery.file_size > UPLOAD_LIMIT:
+            await query.edit_message_text(
+                f"📁 Видео файл большой ({size_mb:.1f} MB).\n"
+                f"Разбиваю на части для отправки..."
+            )
+            # Копирование до 2 GB - в отдельном потоке, чтобы не останавливать другие чаты
+            part_files = await asyncio.to_thread(self.split_large_file, delivery.path, UPLOAD_LIMIT)
+            if len(part_files) > 1:
+                job.add_cleanup(functools.partial(remove_files, *part_files))
+                delivery.parts = part_files
+                # Исходник больше не нужен, пока части ждут отправки
+                await remove_files(delivery.path)
+        return None
+    
+    async def stage_prepare(self, job: Job):
+        """Перед отправкой: moov в начало файла, миниатюра и метаданные для плеера Telegram"""
+        delivery = job.payload
+        if delivery.link or delivery.parts:
+            return None
+        if delivery.audio_only:
+            # MP3 длится столько же, сколько источник - пробовать файл не нужно
+            delivery.media = self.source_media(delivery)
+            return None
+        
+        if delivery.buffered:
+            buffer, filename, title = delivery.buffered
+            streamable = mp4_faststart(buffer)
+            buffer.seek(0)
+            if streamable is not False:
+                delivery.media = self.source_media(delivery)
+                delivery.thumbnail = await asyncio.to_thread(
+                    make_thumbnail, filename, thumbnail_time(delivery.duration), buffer.getvalue()
+                )
+                return None
+            # moov в конце: переносить его в начало можно только в файле
+            path = os.path.join(self.downloader.download_dir, f"{uuid.uuid4().hex[:8]}_{filename}")
+            job.add_cleanup(functools.partial(remove_files, path))
+            await asyncio.to_thread(self.write_buffer, buffer, path)
+            delivery.path, delivery.title = path, title
+            delivery.file_size = buffer.getbuffer().nbytes
+            delivery.buffered = None
+            buffer.close()
+        
+        media = await asyncio.to_thread(probe_media, delivery.path, delivery.duration)
+        if media.faststart is False:
+            remuxed_path = await asyncio.to_thread(
+                self.stored_transform, delivery.url, delivery.resolution, delivery.clip, 'faststart',
+                delivery.title, functools.partial(remux_faststart, delivery.path)
+            )
+            if remuxed_path:
+                job.add_cleanup(functools.partial(remove_files, remuxed_path))
+                await remove_files(delivery.path)
+                delivery.path = remuxed_path
+                media.faststart = True
+        delivery.media = media
+        delivery.thumbnail = await asyncio.to_thread(make_thumbnail, delivery.path, thumbnail_time(media.duration))
+        return None
+    
+    @staticmethod
+    def write_buffer(buffer, path: str):
+        with open(path, 'wb') as f:
+            f.write(buffer.getbuffer())
+    
+    async def stage_upload(self, job: Job):
+        """Сеть: отправка в Telegram"""
+        delivery = job.payload
+        query = delivery.query
+        
+        if delivery.link:
+            hours = max(1, round((delivery.link_expires - time.time()) / 3600))
+            await query.edit_message_text(
+                f"🔗 Файл больше лимита Telegram ({delivery.file_size / (1024 * 1024):.1f} MB).\n"
+                f"Скачать или смотреть: {delivery.link}\n"
+                f"Ссылка действует {hours} ч."
+            )
+            return DONE
+        
+        if delivery.buffered:
+            if await self.send_from_memory(delivery):
+                return DONE
+            return self.retry_from_disk(delivery)
+        
+        if delivery.audio_only:
+            await query.edit_message_text("📤 Отправляю аудио...")
+            await pace_upload(delivery.file_size)
+            await delivery.bot.send_audio(
+                chat_id=delivery.chat_id,
+                audio=await read_file(delivery.path),
+                filename=os.path.basename(delivery.path),
+                title=delivery.title[:50],
+                **delivery.media.send_kwargs(),
+                caption=f"🎵 {delivery.title}",
+                read_timeout=300,
+                write_timeout=300,
+                connect_timeout=60,
+                pool_timeout=60
+            )
+            await query.edit_message_text("✅ Аудио отправлено!")
+            return DONE
+        
+        if delivery.parts:
+            total = len(delivery.parts)
+            await query.edit_message_text(f"📤 Отправляю видео ({total} частей)...")
             
-            if not result:
-                await status_message.edit_text("❌ Ошибка при скачивании видео.")
-                return
-            
-            video_path, title = result
-            
-            if audio_only:
-                await status_message.edit_text("🎵 Конвертирую в MP3...")
-                audio_path = await loop.run_in_executor(None, self.downloader.convert_to_mp3, video_path)
-                
-                if audio_path:
-                    await status_message.edit_text("📤 Отправляю аудио...")
-                    
-                    with open(audio_path, 'rb') as audio_file:
-                        await context.bot.send_audio(
-                            chat_id=update.effective_chat.id,
-                            audio=audio_file,
-                            title=title[:50],  # Ограничиваем длину названия
-                            caption=f"🎵 {title}"
-                        )
-                    
-                    self.downloader.cleanup_file(video_path)
-                    self.downloader.cleanup_file(audio_path)
-                    await status_message.edit_text("✅ Аудио отправлено!")
-                else:
-                    await status_message.edit_text("❌ Ошибка при конвертации в MP3.")
-            else:
-                # Проверяем размер видео файла
-                file_size = os.path.getsize(video_path)
-                size_mb = file_size / (1024 * 1024)
-                
-                # Более строгий лимит для надежной отправки
-                max_size = 50 * 1024 * 1024  # 50 MB лимит для надежной отправки
-                
-                if file_size > max_size:
-                    # Предлагаем разбить файл на части
-                    await status_message.edit_text(
-                        f"📁 Видео файл большой ({size_mb:.1f} MB).\n"
-                        f"Разбиваю на части для отправки..."
-                    )
-                    
-                    part_files = self.split_large_file(video_path)
-                    
-                    if len(part_files) > 1:
-                        await status_message.edit_text(f"📤 Отправляю видео ({len(part_files)} частей)...")
-                        
-                        for i, part_path in enumerate(part_files, 1):
-                            try:
-                                with open(part_path, 'rb') as part_file:
-                                    await context.bot.send_document(
-                                        chat_id=update.effective_chat.id,
-                                        document=part_file,
-                                        caption=f"📹 {title} (часть {i}/{len(part_files)})",
-                                        read_timeout=600,
-                                        write_timeout=600,
-                                        connect_timeout=120,
-                                        pool_timeout=120
-                                    )
-                                # Удаляем часть после отправки
-                                os.remove(part_path)
-                            except Exception as e:
-                                logger.error(f"Error sending part {i}: {e}")
-                                await status_message.edit_text(f"❌ Ошибка при отправке части {i}")
-                                return
-                        
-                        await status_message.edit_text(f"✅ Видео отправлено ({len(part_files)} частей)!")
-                    else:
-                        # Если не удалось разбить, отправляем как обычно
-                        await status_message.edit_text("📤 Отправляю видео...")
-                        try:
-                            with open(video_path, 'rb') as video_file:
-                                await context.bot.send_video(
-                                    chat_id=update.effective_chat.id,
-                                    video=video_file,
-                                    caption=f"📹 {title}",
-                                    supports_streaming=True,
-                                    read_timeout=600,
-                                    write_timeout=600,
-                                    connect_timeout=120,
-                                    pool_timeout=120
-                                )
-                        except Exception as e:
-                            logger.error(f"Error sending video: {e}")
-                            await status_message.edit_text("❌ Ошибка при отправке видео")
-                            return
-                    
-                    self.downloader.cleanup_file(video_path)
-                    return
-                
-                await status_message.edit_text("📤 Отправляю видео...")
-                
-                # Retry логика для отправки видео
-                for attempt in range(3):  # 3 попытки
-                    try:
-                        with open(video_path, 'rb') as video_file:
-                            await context.bot.send_video(
-                                chat_id=update.effective_chat.id,
-                                video=video_file,
-                                caption=f"📹 {title}",
-                                supports_streaming=True,
-                                read_timeout=600,  # Увеличиваем таймауты
-                                write_timeout=600,
-                                connect_timeout=120,
-                                pool_timeout=120
-                            )
-                        break  # Успешно отправили, выходим из цикла
-                    except Exception as send_error:
-                        logger.error(f"Video send attempt {attempt + 1} failed: {send_error}")
-                        if attempt == 2:  # Последняя попытка
-                            raise  # Перебрасываем исключение
-                        await asyncio.sleep(5)  # Пауза перед повторной попыткой
-                
-                self.downloader.cleanup_file(video_path)
-                await status_message.edit_text("✅ Видео отправлено!")
+            async def report_parts(done_parts, total_parts, done_bytes, total_bytes):
+                await query.edit_message_text(
+                    f"📤 Отправлено {done_parts}/{total_parts} частей "
+                    f"({done_bytes / (1024 * 1024):.0f}/{total_bytes / (1024 * 1024):.0f} MB)..."
+                )
             
+            # Части отправляются параллельно, неудачные повторяются отдельно
+            uploader = MultipartUploader(delivery.bot, concurrency=self.upload_concurrency)
+            failed_parts = await uploader.deliver(delivery.chat_id, delivery.parts, delivery.title,
+                                                  progress=report_parts)
+            if failed_parts:
+                raise DeliveryFailed(f"❌ Ошибка при отправке частей: {', '.join(map(str, failed_parts))}")
+            await query.edit_message_text(f"✅ Видео отправлено ({total} частей)!")
+            return DONE
+        
+        await query.edit_message_text("📤 Отправляю видео...")
+        
+        # Retry логика для отправки видео
+        for attempt in range(3):  # 3 попытки
+            try:
+                await pace_upload(delivery.file_size)
+                await delivery.bot.send_video(
+                    chat_id=delivery.chat_id,
+                    video=await read_file(delivery.path),
+                    filename=os.path.basename(delivery.path),
+                    caption=f"📹 {delivery.title}",
+                    supports_streaming=True,
+                    thumbnail=delivery.thumbnail,
+                    **delivery.media.send_kwargs(),
+                    read_timeout=600,  # Увеличиваем таймауты
+                    write_timeout=600,
+                    connect_timeout=120,
+                    pool_timeout=120
+                )
+                break  # Успешно отправили, выходим из цикла
+            except Exception as send_error:
+                logger.error(f"Video send attempt {attempt + 1} failed: {send_error}")
+                if attempt == 2:  # Последняя попытка
+                    raise DeliveryFailed("❌ Ошибка при отправке видео")
+                await asyncio.sleep(5)  # Пауза перед повторной попыткой
+        
+        await query.edit_message_text("✅ Видео отправлено!")
+        return DONE
+    
+    async def download_and_send_callback(self, query, context: ContextTypes.DEFAULT_TYPE,
+                                        resolution: str = None, audio_only: bool = False):
+        video_info = context.user_data.get('video_info')
+        if not video_info:
+            await query.edit_message_text("❌ Сначала отправь ссылку на видео.")
+            return
+        
+        clip = video_info.get('clip')
+        if clip:
+            await query.edit_message_text(
+                f"✂️ Скачиваю фрагмент {format_timestamp(clip[0])}–{format_timestamp(clip[1])}..."
+            )
+        else:
+            await query.edit_message_text("⏬ Начинаю скачивание...")
+        
+        info = video_info.get('info') or {}
+        duration = clip[1] - clip[0] if clip else info.get('duration')
+        delivery = Delivery(query, context.bot, video_info['url'], resolution, audio_only, clip, duration, info)
+        job = await self.pipeline.submit(delivery, name=job_id_var.get() or '')
+        self.active_jobs[delivery.user_id] = job
+        try:
+            await job.wait()
             context.user_data.pop('video_info', None)
-            
+        except JobCancelled:
+            await query.edit_message_text("🚫 Загрузка отменена: получена новая ссылка.")
+        except DeliveryFailed as e:
+            await query.edit_message_text(str(e))
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
         except Exception as e:
-            logger.error(f"Error in download_and_send: {e}")
-            await update.message.reply_text("❌ Произошла ошибка при скачивании.")
+            logger.error(f"Error in download_and_send_callback: {e}")
+            await query.edit_message_text("❌ Произошла ошибка при скачивании.")
+        finally:
+            if self.active_jobs.get(delivery.user_id) is job:
+                del self.active_jobs[delivery.user_id]
     
     def run(self):
         self.application.run_polling()
 
 def main():
+    setup_logging()
     token = os.getenv('TELEGRAM_BOT_TOKEN')
     if not token:
         print("❌ Установите переменную окружения TELEGRAM_BOT_TOKEN")
@@ -0,0 +1,339 @@
+import time
+import random
+import logging
+import threading
+from typing import Optional, Callable, Iterable, Dict, Tuple, Any
+
+from youtube_utils import extract_video_id
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadCancelled(Exception):
+    """Загрузку остановил сам бот (например, спекулятивную) - это не ошибка бэкенда"""
+
+
+class DownloadError(Exception):
+    """Базовая ошибка получения информации или скачивания видео"""
+    user_message = "Произошла ошибка при скачивании."
+    retryable = False
+    # Ошибка говорит о проблеме с YouTube/куками, а не с конкретным видео
+    trips_breaker = False
+
+    def __init__(self, message: str, cause: Optional[BaseException] = None):
+        super().__init__(message)
+        self.cause = cause
+
+
+class TransientError(DownloadError):
+    """Временная сетевая ошибка"""
+    user_message = "Временная ошибка сети, попробуйте еще раз."
+    retryable = True
+    trips_breaker = True
+
+
+class ThrottledError(TransientError):
+    """YouTube ограничивает запросы (429, проверка на бота, 403 на потоке)"""
+    user_message = "YouTube временно ограничивает запросы, попробуйте позже."
+
+
+class AuthError(DownloadError):
+    """Куки устарели или аккаунт не принят YouTube"""
+    user_message = "Проблема с авторизацией на YouTube, попробуйте позже."
+    trips_breaker = True
+
+
+class PermanentError(DownloadError):
+    """Видео невозможно скачать, повторы бесполезны"""
+    user_message = "Это видео невозможно скачать."
+
+
+class VideoUnavailableError(PermanentError):
+    user_message = "Видео недоступно: оно удалено, приватное или заблокировано."
+
+
+class AgeRestrictedError(PermanentError):
+    user_message = "Видео с возрастным ограничением недоступно для скачивания."
+
+
+class CircuitOpenError(DownloadError):
+    """Бэкенд временно отключен после серии ошибок"""
+    user_message = "YouTube временно ограничивает запросы, попробуйте через пару минут."
+
+
+# Имена исключений pytubefix и yt-dlp, сопоставленные с классами ошибок
+_EXCEPTION_NAMES = {
+    'VideoUnavailable': VideoUnavailableError,
+    'VideoPrivate': VideoUnavailableError,
+    'VideoRegionBlocked': VideoUnavailableError,
+    'MembersOnly': VideoUnavailableError,
+    'LiveStreamError': VideoUnavailableError,
+    'AgeRestrictedError': AgeRestrictedError,
+    'AgeCheckRequiredError': AgeRestrictedError,
+    'AgeCheckRequiredAccountError': AgeRestrictedError,
+    'BotDetection': ThrottledError,
+    'LoginRequired': AuthError,
+    'RegexMatchError': TransientError,
+}
+
+# Фрагменты текста ошибок: первый совпавший определяет класс
+_MESSAGE_PATTERNS = (
+    ('sign in to confirm your age', AgeRestrictedError),
+    ('age-restricted', AgeRestrictedError),
+    ('inappropriate for some users', AgeRestrictedError),
+    ('cookies are no longer valid', AuthError),
+    ('sign in to confirm you', ThrottledError),
+    ('too many requests', ThrottledError),
+    ('http error 429', ThrottledError),
+    ('http error 403', ThrottledError),
+    ('video unavailable', VideoUnavailableError),
+    ('private video', VideoUnavailableError),
+    ('has been removed', VideoUnavailableError),
+    ('not available in your country', VideoUnavailableError),
+    ('members-only', VideoUnavailableError),
+    ('is not a valid url', PermanentError),
+    ('unsupported url', PermanentError),
+    ('timed out', TransientError),
+    ('connection reset', TransientError),
+    ('temporary failure in name resolution', TransientError),
+    ('http error 5', TransientError),
+)
+
+
+def find_cancellation(exc: BaseException) -> Optional[DownloadCancelled]:
+    """Отмена, даже если бэкенд завернул ее в свое исключение (yt-dlp хранит исходное в exc_info)"""
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        if isinstance(exc, DownloadCancelled):
+            return exc
+        seen.add(id(exc))
+        exc_info = getattr(exc, 'exc_info', None)
+        wrapped = exc_info[1] if isinstance(exc_info, tuple) and len(exc_info) > 1 else None
+        exc = wrapped or exc.__cause__ or exc.__context__
+    return None
+
+
+def classify_exception(exc: BaseException) -> DownloadError:
+    """Превращает исключение бэкенда в ошибку из таксономии"""
+    if isinstance(exc, DownloadError):
+        return exc
+
+    for cls in type(exc).__mro__:
+        if cls.__name__ in _EXCEPTION_NAMES:
+            return _EXCEPTION_NAMES[cls.__name__](str(exc), exc)
+
+    text = str(exc).lower()
+    for pattern, error_cls in _MESSAGE_PATTERNS:
+        if pattern in text:
+            return error_cls(str(exc), exc)
+
+    if isinstance(exc, (TimeoutError, ConnectionError, OSError)):
+        return TransientError(str(exc), exc)
+    return DownloadError(str(exc), exc)
+
+
+class RetryPolicy:
+    """Экспоненциальная задержка с полным джиттером"""
+
+    def __init__(self, max_attempts: int = 1, base_delay: float = 1.0, max_delay: float = 30.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+NO_RETRY = RetryPolicy(max_attempts=1)
+
+# Политика повторов для каждого класса ошибок (ищется по MRO)
+RETRY_POLICIES = {
+    ThrottledError: RetryPolicy(max_attempts=2, base_delay=5, max_delay=30),
+    TransientError: RetryPolicy(max_attempts=3, base_delay=1, max_delay=10),
+    DownloadError: NO_RETRY,
+}
+
+
+def policy_for(error: DownloadError) -> RetryPolicy:
+    for cls in type(error).__mro__:
+        if cls in RETRY_POLICIES:
+            return RETRY_POLICIES[cls]
+    return NO_RETRY
+
+
+class CircuitBreaker:
+    """Размыкается после серии ошибок и пропускает один пробный запрос после паузы"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 60,
+                 clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        # Когда выпущен пробный запрос; None - пробы нет
+        self.probe_started: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = self.clock()
+            if self.state == self.OPEN and now - self.opened_at < self.reset_timeout:
+                return False
+            # Пока проба не вернулась, остальным отказываем. Проба, не сообщившая
+            # результат за reset_timeout, считается потерянной
+            if self.probe_started is not None and now - self.probe_started < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self.probe_started = now
+            return True
+
+    def release_probe(self):
+        """Проба закончилась без вывода о бэкенде (отмена, ошибка самого видео) - выпускаем следующую"""
+        with self._lock:
+            self.probe_started = None
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probe_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probe_started = None
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"Circuit breaker '{self.name}' opened after {self.failures} failures")
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+
+class TTLCache:
+    """Небольшой словарь с временем жизни записей"""
+
+    def __init__(self, ttl: float, max_items: int = 10000, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.clock = clock
+        self._items: Dict[str, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            if len(self._items) >= self.max_items:
+                self._items.pop(next(iter(self._items)))
+            self._items[key] = (self.clock() + self.ttl, value)
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            item = self._items.get(key)
+            if not item:
+                return None
+            expires_at, value = item
+            if expires_at < self.clock():
+                del self._items[key]
+                return None
+            return value
+
+
+class RetryManager:
+    """Повторы по классам ошибок, предохранители по бэкендам и негативный кэш ID видео"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 60, negative_ttl: float = 600):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.negative_cache = TTLCache(negative_ttl)
+        self.last_errors = TTLCache(negative_ttl)
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, name: str) -> CircuitBreaker:
+        with self._lock:
+            if name not in self._breakers:
+                self._breakers[name] = CircuitBreaker(name, self.failure_threshold, self.reset_timeout)
+            return self._breakers[name]
+
+    def last_error(self, url: str) -> Optional[DownloadError]:
+        """Последняя ошибка для видео - чтобы бот мог показать понятную причину"""
+        return self.last_errors.get(extract_video_id(url) or url)
+
+    def call(self, operation: Callable[[], Any], url: str, breakers: Iterable[str] = ()) -> Any:
+        """Выполняет операцию с повторами. Бросает DownloadError при окончательной неудаче"""
+        key = extract_video_id(url) or url
+        breakers = [self.breaker(name) for name in breakers]
+
+        cached = self.negative_cache.get(key)
+        if cached:
+            logger.info(f"Negative cache hit for {key}: {cached}")
+            self.last_errors.set(key, cached)
+            raise cached
+
+        attempt = 0
+        while True:
+            attempt += 1
+            closed = [b for b in breakers if not b.allow()]
+            if closed:
+                # Пробы, выданные другими предохранителями этому вызову, возвращаем
+                for b in breakers:
+                    if b not in closed:
+                        b.release_probe()
+                error = CircuitOpenError(f"Circuit '{closed[0].name}' is open")
+                self.last_errors.set(key, error)
+                raise error
+
+            try:
+                result = operation()
+            except Exception as e:
+                cancelled = find_cancellation(e)
+                if cancelled:
+                    # Отмена не ошибка: без повторов, предохранителей и last_errors
+                    for b in breakers:
+                        b.release_probe()
+                    raise cancelled
+                error = classify_exception(e)
+            else:
+                for b in breakers:
+                    b.record_success()
+                return result
+
+            for b in breakers:
+                if error.trips_breaker:
+                    b.record_failure()
+                else:
+                    b.release_probe()
+            if isinstance(error, PermanentError):
+                self.negative_cache.set(key, error)
+            self.last_errors.set(key, error)
+
+            policy = policy_for(error)
+            if attempt >= policy.max_attempts:
+                logger.error(f"{type(error).__name__} for {key} after {attempt} attempt(s): {error}")
+                raise error
+
+            delay = policy.delay(attempt)
+            logger.warning(f"{type(error).__name__} for {key}, retry {attempt}/{policy.max_attempts - 1} "
+                           f"in {delay:.1f}s: {error}")
+            time.sleep(delay)
+
+
+_retry_manager = None
+_retry_manager_lock = threading.Lock()
+
+
+def get_retry_manager() -> RetryManager:
+    """Общий менеджер повторов: состояние предохранителей разделяют все экземпляры загрузчиков"""
+    global _retry_manager
+    with _retry_manager_lock:
+        if _retry_manager is None:
+            _retry_manager = RetryManager()
+        return _retry_manager
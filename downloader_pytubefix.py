@@ -1,62 +1,206 @@
+import io
 import os
+import time
+import asyncio
 import logging
+import threading
 import ffmpeg
-from pytubefix import YouTube
+import httpx
+from pytubefix import YouTube, Stream, StreamQuery
+from pytubefix.monostate import Monostate
 from typing import Optional, Tuple, List
+from concurrent.futures import ThreadPoolExecutor
+from download_errors import DownloadError, DownloadCancelled, get_retry_manager
+from metadata_cache import MetadataCache, stream_urls_expire_at, STREAM_URL_MARGIN
+from youtube_utils import extract_video_id
+from log_setup import setup_logging
+from progress import STAGE_MERGE
+from bandwidth import get_bandwidth_scheduler, INGRESS
+from passthrough import DirectStream
+from async_download import fetch_to_file, remove_files
+from storage import MediaStorage, get_storage, media_key, restore, save
+from transcoder import (get_transcoder, TranscodeError, PRIORITY_AUDIO, PRIORITY_VIDEO,
+                        probe_codec, mp4_merge_codecs, codec_family, plan_fit_to_limit, compress_to_limit,
+                        FASTSTART_MOVFLAGS, FRAGMENTED_MOVFLAGS, encode_mp3, encode_mp3_bytes, mp3_bitrate)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('downloader.log'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
+# Максимальный размер потока, который скачивается в память без записи на диск
+STREAMING_MAX_BYTES = 50 * 1024 * 1024
+
+RESOLUTION_ORDER = ('144p', '240p', '360p', '480p', '720p', '1080p', '1440p', '2160p')
+
+
+class _CombinedProgress:
+    """Сводный прогресс нескольких потоков в сигнатуре колбэка pytubefix"""
+    
+    def __init__(self, streams, callback=None):
+        self.filesize = sum(stream.filesize or 0 for stream in streams)
+        self._remaining = {stream.itag: stream.filesize or 0 for stream in streams}
+        self._callback = callback
+        self._lock = threading.Lock()
+    
+    def __call__(self, stream, chunk, bytes_remaining):
+        with self._lock:
+            self._remaining[stream.itag] = bytes_remaining
+            total_remaining = sum(self._remaining.values())
+        if self._callback:
+            self._callback(self, chunk, total_remaining)
+
+class _BoundedBuffer(io.BytesIO):
+    """Буфер в памяти, который не дает записать больше лимита"""
+    
+    def __init__(self, max_size: int):
+        super().__init__()
+        self.max_size = max_size
+    
+    def write(self, data) -> int:
+        if self.tell() + len(data) > self.max_size:
+            raise ValueError(f"In-memory buffer limit of {self.max_size} bytes exceeded")
+        return super().write(data)
+
+class _CachedVideo:
+    """Замена YouTube для потоков из кэша ссылок: название, длительность и общий колбэк прогресса"""
+    
+    def __init__(self, title: str, length: Optional[int]):
+        self.title = title
+        self.length = length
+        self.stream_monostate = Monostate(on_progress=None, on_complete=None, title=title, duration=length)
+    
+    def register_on_progress_callback(self, func):
+        self.stream_monostate.on_progress = func
+
+
+def _stream_record(stream: Stream) -> dict:
+    """Поля формата, из которых pytubefix собирает Stream, - для уровня ссылок MetadataCache"""
+    record = {
+        'url': stream.url,
+        'itag': stream.itag,
+        'mimeType': f'{stream.mime_type}; codecs="{", ".join(stream.codecs)}"',
+        'is_otf': stream.is_otf,
+        'bitrate': stream.bitrate,
+        # Размер без HEAD-запроса: 0, если YouTube его не сообщил
+        'contentLength': str(getattr(stream, '_filesize', 0) or 0),
+        'approxDurationMs': stream.durationMs,
+        'lastModified': stream.last_Modified,
+        'isDrc': stream.is_drc,
+    }
+    for key in ('fps', 'width', 'height'):
+        value = getattr(stream, key, None)
+        if value:
+            record[key] = value
+    return record
+
+
+class StreamSelection:
+    """Потоки, выбранные из одного извлечения.
+
+    Передается между шагами доставки (passthrough, память, диск, фрагмент), чтобы
+    не вызывать YouTube(url) заново на каждом из них.
+    """
+
+    def __init__(self, yt: YouTube, title: str, streams: list):
+        self.yt = yt
+        self.title = title
+        self.streams = streams  # один поток либо видео + аудио для слияния; пустой - ничего не подошло
+
+    def frame_size(self) -> Tuple[Optional[int], Optional[int]]:
+        """Размер кадра выбранного видеопотока; (None, None) для аудио или если YouTube его не сообщил"""
+        for stream in self.streams:
+            if getattr(stream, 'width', None) and getattr(stream, 'height', None):
+                return stream.width, stream.height
+        return None, None
+
+
 class YouTubeDownloader:
-    def __init__(self, download_dir: str = "./downloads"):
+    def __init__(self, download_dir: str = "./downloads", metadata_cache: Optional[MetadataCache] = None,
+                 storage: Optional[MediaStorage] = None):
         self.download_dir = download_dir
         os.makedirs(download_dir, exist_ok=True)
+        
+        if metadata_cache is None and os.getenv('METADATA_CACHE_ENABLED', '1') == '1':
+            metadata_cache = MetadataCache()
+        self.metadata_cache = metadata_cache
+        # Общее для всех узлов хранилище готовых файлов (MEDIA_STORAGE)
+        self.storage = storage if storage is not None else get_storage()
+        self._http_client = None
+    
+    def storage_key(self, url: str, resolution: str = None, clip: Optional[Tuple[float, float]] = None,
+                    transform: Optional[str] = None) -> Optional[str]:
+        """Ключ результата в общем хранилище; None, если хранилище не настроено"""
+        video_id = extract_video_id(url)
+        return media_key(video_id, resolution, clip, transform) if self.storage and video_id else None
     
     def get_video_info(self, url: str) -> Optional[dict]:
+        video_id = extract_video_id(url)
+        if video_id and self.metadata_cache:
+            cached = self.metadata_cache.get(video_id, 'pytubefix')
+            if cached:
+                info, stale = cached
+                if stale:
+                    # Отдаем устаревшие данные сразу и обновляем их в фоне
+                    self.metadata_cache.refresh_in_background(
+                        video_id, 'pytubefix', lambda: self._fetch_video_info(url, video_id)
+                    )
+                logger.info(f"Video found in cache: {info.get('title', 'Unknown')}")
+                return info
+        
         try:
-            yt = YouTube(url)
-            info = {
-                'title': yt.title,
-                'duration': yt.length,
-                'view_count': yt.views,
-                'streams': yt.streams
-            }
-            logger.info(f"Video found: {info.get('title', 'Unknown')}")
-            return info
-        except Exception as e:
+            return self._fetch_video_info(url, video_id)
+        except DownloadError as e:
             logger.error(f"Error getting video info: {e}")
             return None
     
+    def _fetch_video_info(self, url: str, video_id: Optional[str]) -> dict:
+        info = get_retry_manager().call(lambda: self._get_video_info(url), url, breakers=['pytubefix'])
+        if video_id and self.metadata_cache:
+            try:
+                resolutions = self.get_available_resolutions(info)
+                self.metadata_cache.put(video_id, 'pytubefix', {
+                    'title': info['title'],
+                    'duration': info['duration'],
+                    'view_count': info['view_count'],
+                    'resolutions': resolutions,
+                    'sizes': {res: self.estimate_size(info, res) for res in resolutions}
+                })
+            except Exception as e:
+                logger.error(f"Error caching video info: {e}")
+            self._cache_stream_urls(video_id, info['youtube'], info['streams'])
+        return info
+    
+    def _get_video_info(self, url: str) -> dict:
+        yt = YouTube(url)
+        info = {
+            'title': yt.title,
+            'duration': yt.length,
+            'view_count': yt.views,
+            'streams': yt.streams,
+            # Объект извлечения: выбор потоков для загрузки обойдется без повторного YouTube(url)
+            'youtube': yt
+        }
+        logger.info(f"Video found: {info.get('title', 'Unknown')}")
+        return info
+    
+    def last_error(self, url: str) -> Optional[DownloadError]:
+        """Классифицированная причина последней неудачи для этого видео"""
+        return get_retry_manager().last_error(url)
+    
     def get_available_resolutions(self, info: dict) -> List[str]:
         try:
+            # Данные из кэша метаданных уже содержат список разрешений
+            if 'resolutions' in info:
+                return list(info['resolutions'])
+            
             streams = info.get('streams')
             if not streams:
                 return ['audio']
             
-            # Получаем видео разрешения
-            video_streams = streams.filter(progressive=True).order_by('resolution')
-            resolutions = set()
-            
-            for stream in video_streams:
-                if stream.resolution:
-                    resolutions.add(stream.resolution)
-            
-            # Также проверяем адаптивные потоки
-            adaptive_video = streams.filter(adaptive=True, only_video=True).order_by('resolution')
-            for stream in adaptive_video:
-                if stream.resolution:
-                    resolutions.add(stream.resolution)
+            # Разрешение есть только у потоков с видео: прогрессивных и адаптивных видео,
+            # поэтому хватает одного прохода без filter/order_by
+            resolutions = {stream.resolution for stream in streams if stream.resolution}
             
             # Сортируем по качеству
-            resolution_order = ['144p', '240p', '360p', '480p', '720p', '1080p', '1440p', '2160p']
-            sorted_resolutions = [res for res in resolution_order if res in resolutions]
+            sorted_resolutions = [res for res in RESOLUTION_ORDER if res in resolutions]
             
             # Добавляем аудио опцию
             result = sorted_resolutions + ['audio']
@@ -67,6 +211,31 @@ class YouTubeDownloader:
             logger.error(f"Error getting resolutions: {e}")
             return ['audio']
     
+    def estimate_size(self, info: dict, resolution: str) -> Optional[int]:
+        """Оценивает размер результата для выбранного качества по данным get_video_info"""
+        try:
+            if 'sizes' in info:
+                return info['sizes'].get(resolution)
+            
+            streams = info.get('streams')
+            if not streams:
+                return None
+            
+            audio_stream = streams.filter(only_audio=True).order_by('abr').desc().first()
+            if resolution == 'audio':
+                return audio_stream.filesize if audio_stream else None
+            
+            progressive = streams.filter(progressive=True, res=resolution).first()
+            if progressive:
+                return progressive.filesize
+            
+            video_stream = streams.filter(adaptive=True, only_video=True, res=resolution).first()
+            if video_stream and audio_stream:
+                return video_stream.filesize + audio_stream.filesize
+        except Exception as e:
+            logger.error(f"Error estimating size for {resolution}: {e}")
+        return None
+    
     def check_file_size(self, stream, max_size_gb: float = 1.9) -> bool:
         try:
             if hasattr(stream, 'filesize') and stream.filesize:
@@ -81,132 +250,534 @@ class YouTubeDownloader:
     
     def download_video(self, url: str, resolution: str = None, 
                       progress_callback=None) -> Optional[Tuple[str, str]]:
+        key = self.storage_key(url, resolution)
+        stored = restore(self.storage, key, self.download_dir)
+        if stored:
+            return stored
+        # Загрузка получает свою долю общей входящей полосы
+        bandwidth_job = get_bandwidth_scheduler().register(INGRESS)
         try:
-            yt = YouTube(url, on_progress_callback=progress_callback)
-            title = yt.title
+            return save(self.storage, key, get_retry_manager().call(
+                lambda: self._download_video(url, resolution, bandwidth_job.wrap_callback(progress_callback)),
+                url,
+                breakers=['pytubefix']
+            ))
+        except DownloadError as e:
+            logger.error(f"Error downloading video: {e}")
+            return None
+        finally:
+            bandwidth_job.close()
+    
+    def _download_video(self, url: str, resolution: str = None,
+                        progress_callback=None) -> Optional[Tuple[str, str]]:
+        yt = YouTube(url, on_progress_callback=progress_callback)
+        title = yt.title
+        
+        logger.info(f"Starting download: {title}")
+        
+        if resolution == 'audio':
+            # Скачиваем аудио
+            stream = yt.streams.filter(only_audio=True).order_by('abr').desc().first()
+            if not stream:
+                logger.error("No audio stream found")
+                return None
+                
+            if not self.check_file_size(stream):
+                return None
+                
+            file_path = stream.download(output_path=self.download_dir)
+            logger.info(f"Audio download completed: {file_path}")
+            return file_path, title
             
-            logger.info(f"Starting download: {title}")
+        elif resolution:
+            # Скачиваем видео определенного качества
+            target_height = int(resolution.replace('p', ''))
             
-            if resolution == 'audio':
-                # Скачиваем аудио
-                stream = yt.streams.filter(only_audio=True).order_by('abr').desc().first()
-                if not stream:
-                    logger.error("No audio stream found")
-                    return None
-                    
-                if not self.check_file_size(stream):
-                    return None
-                    
-                file_path = stream.download(output_path=self.download_dir)
-                logger.info(f"Audio download completed: {file_path}")
+            # Сначала пробуем прогрессивный поток (работает только до 720p)
+            if target_height <= 720:
+                progressive_stream = yt.streams.filter(progressive=True, res=resolution).first()
+                if progressive_stream and self.check_file_size(progressive_stream):
+                    file_path = progressive_stream.download(output_path=self.download_dir)
+                    logger.info(f"Progressive video download completed: {file_path}")
+                    return file_path, title
+            
+            # Нужного прогрессивного потока нет - качаем адаптивные видео и аудио и объединяем
+            result = self._download_adaptive(yt, resolution, title, progress_callback)
+            if result:
+                return result
+            
+            if target_height <= 720:
+                # Попробуем ближайшее прогрессивное качество
+                all_progressive = yt.streams.filter(progressive=True).order_by('resolution').desc()
+                for stream in all_progressive:
+                    if stream.resolution:
+                        stream_height = int(stream.resolution.replace('p', ''))
+                        if stream_height <= target_height and self.check_file_size(stream):
+                            file_path = stream.download(output_path=self.download_dir)
+                            logger.info(f"Best progressive video ({stream.resolution}) download completed: {file_path}")
+                            return file_path, title
+            
+            # Если адаптивная загрузка не удалась, скачиваем лучший доступный прогрессивный поток
+            best_progressive = yt.streams.filter(progressive=True).order_by('resolution').desc().first()
+            if best_progressive and self.check_file_size(best_progressive):
+                file_path = best_progressive.download(output_path=self.download_dir)
+                logger.info(f"Best available video ({best_progressive.resolution}) download completed: {file_path}")
                 return file_path, title
+            
+            logger.error(f"No suitable streams found for resolution {resolution}")
+            return None
+        else:
+            # Скачиваем лучшее доступное прогрессивное качество
+            best_stream = yt.streams.filter(progressive=True).order_by('resolution').desc().first()
+            if not best_stream:
+                logger.error("No progressive streams found")
+                return None
                 
-            elif resolution:
-                # Скачиваем видео определенного качества
-                target_height = int(resolution.replace('p', ''))
-                
-                # Сначала пробуем прогрессивный поток (работает только до 720p)
-                if target_height <= 720:
-                    progressive_stream = yt.streams.filter(progressive=True, res=resolution).first()
-                    if progressive_stream and self.check_file_size(progressive_stream):
-                        file_path = progressive_stream.download(output_path=self.download_dir)
-                        logger.info(f"Progressive video download completed: {file_path}")
-                        return file_path, title
-                    
-                    # Попробуем ближайшее прогрессивное качество
-                    all_progressive = yt.streams.filter(progressive=True).order_by('resolution').desc()
-                    for stream in all_progressive:
-                        if stream.resolution:
-                            stream_height = int(stream.resolution.replace('p', ''))
-                            if stream_height <= target_height and self.check_file_size(stream):
-                                file_path = stream.download(output_path=self.download_dir)
-                                logger.info(f"Best progressive video ({stream.resolution}) download completed: {file_path}")
-                                return file_path, title
-                
-                # Для высоких разрешений используем адаптивные потоки без FFmpeg
-                # Просто скачиваем лучший доступный прогрессивный поток
-                best_progressive = yt.streams.filter(progressive=True).order_by('resolution').desc().first()
-                if best_progressive and self.check_file_size(best_progressive):
-                    file_path = best_progressive.download(output_path=self.download_dir)
-                    logger.info(f"Best available video ({best_progressive.resolution}) download completed: {file_path}")
-                    return file_path, title
+            if not self.check_file_size(best_stream):
+                return None
                 
-                logger.error(f"No suitable streams found for resolution {resolution}")
+            file_path = best_stream.download(output_path=self.download_dir)
+            logger.info(f"Best quality download ({best_stream.resolution}) completed: {file_path}")
+            return file_path, title
+    
+    def download_to_buffer(self, url: str, resolution: str = None, progress_callback=None,
+                           max_size: int = STREAMING_MAX_BYTES,
+                           selection: Optional[StreamSelection] = None,
+                           cancel_event: Optional[threading.Event] = None) -> Optional[Tuple[io.BytesIO, str, str]]:
+        """Скачивает небольшой поток в память без записи на диск.
+        
+        Возвращает (буфер, имя файла, название) или None, если нужен обычный путь через диск:
+        размер неизвестен, больше лимита или поток требует объединения. Установленный
+        cancel_event останавливает загрузку на следующем куске.
+        """
+        bandwidth_job = get_bandwidth_scheduler().register(INGRESS)
+        try:
+            if selection is None:
+                selection = self.select_streams(url, resolution)
+            if len(selection.streams) != 1:
                 return None
+            stream = selection.streams[0]
+            filesize = stream.filesize
+            if not filesize or filesize > max_size:
+                logger.info(f"Stream size {filesize} is not suitable for in-memory delivery")
+                return None
+            
+            logger.info(f"Streaming {stream.itag} ({filesize} bytes) into memory: {selection.title}")
+            
+            def on_progress(stream, chunk, bytes_remaining):
+                # Исключение из колбэка прерывает загрузку pytubefix
+                if cancel_event and cancel_event.is_set():
+                    raise DownloadCancelled(url)
+                if progress_callback:
+                    progress_callback(stream, chunk, bytes_remaining)
+            
+            selection.yt.register_on_progress_callback(bandwidth_job.wrap_callback(on_progress))
+            buffer = _BoundedBuffer(max_size)
+            stream.stream_to_buffer(buffer)
+            buffer.seek(0)
+            
+            logger.info(f"In-memory download completed: {buffer.getbuffer().nbytes} bytes")
+            return buffer, stream.default_filename, selection.title
+            
+        except DownloadCancelled:
+            logger.info(f"In-memory download cancelled: {url}")
+            return None
+        except Exception as e:
+            logger.error(f"Error streaming video into memory: {e}")
+            return None
+        finally:
+            bandwidth_job.close()
+    
+    def select_streams(self, url: str, resolution: str = None, info: Optional[dict] = None) -> StreamSelection:
+        """Выбор потоков для загрузки; потоки из info переиспользуются, пока их ссылки действительны.
+        
+        Без пригодного info потоки берутся из кэша ссылок, затем видео извлекается заново
+        с повторами; DownloadError, если не удалось.
+        """
+        if info and info.get('youtube') and info.get('streams') is not None:
+            try:
+                selection = self._choose_streams(info['youtube'], info['streams'], resolution)
+                expires_at = stream_urls_expire_at(stream.url for stream in selection.streams)
+                if not expires_at or expires_at - STREAM_URL_MARGIN > time.time():
+                    return selection
+                logger.info("Stream URLs from video info are about to expire, extracting again")
+            except Exception as e:
+                logger.warning(f"Cannot reuse streams from video info: {e}")
+        cached = self._cached_streams(url)
+        if cached:
+            try:
+                return self._choose_streams(*cached, resolution)
+            except Exception as e:
+                logger.warning(f"Cannot reuse cached streams: {e}")
+        return get_retry_manager().call(lambda: self._select_streams(url, resolution), url, breakers=['pytubefix'])
+    
+    def _select_streams(self, url: str, resolution: str = None) -> StreamSelection:
+        yt = YouTube(url)
+        streams = yt.streams
+        video_id = extract_video_id(url)
+        if video_id and self.metadata_cache:
+            self._cache_stream_urls(video_id, yt, streams)
+        return self._choose_streams(yt, streams, resolution)
+    
+    def _cache_stream_urls(self, video_id: str, yt: YouTube, streams):
+        """Сохраняет подписанные ссылки потоков до срока их действия"""
+        try:
+            # SABR-потокам нужны данные плеера, которых в записи нет
+            records = [_stream_record(stream) for stream in streams if not stream.is_sabr]
+            self.metadata_cache.put_streams(video_id, 'pytubefix',
+                                            {'title': yt.title, 'duration': yt.length, 'streams': records},
+                                            [record['url'] for record in records])
+        except Exception as e:
+            logger.error(f"Error caching stream URLs: {e}")
+    
+    def _cached_streams(self, url: str) -> Optional[Tuple[_CachedVideo, StreamQuery]]:
+        """Потоки из кэша ссылок, пока подписи действительны: выбор без повторного извлечения"""
+        video_id = extract_video_id(url)
+        if not video_id or not self.metadata_cache:
+            return None
+        data = self.metadata_cache.get_streams(video_id, 'pytubefix')
+        if not data:
+            return None
+        try:
+            video = _CachedVideo(data['title'], data['duration'])
+            streams = [Stream(record, video.stream_monostate, po_token=None, video_playback_ustreamer_config=None)
+                       for record in data['streams']]
+        except Exception as e:
+            # Другая версия pytubefix может собирать Stream иначе - тогда извлекаем заново
+            logger.warning(f"Cannot restore cached streams: {e}")
+            return None
+        logger.info(f"Stream URLs found in cache: {video.title}")
+        return video, StreamQuery(streams)
+    
+    def _choose_streams(self, yt: YouTube, streams, resolution: str = None) -> StreamSelection:
+        """Блокирующая часть загрузки: выбор одного потока либо пары видео + аудио для слияния"""
+        best_audio = streams.filter(only_audio=True).order_by('abr').desc().first()
+        progressive = streams.filter(progressive=True).order_by('resolution').desc()
+        
+        if resolution == 'audio':
+            selected = [best_audio]
+        elif resolution:
+            target_height = int(resolution.replace('p', ''))
+            exact = streams.filter(progressive=True, res=resolution).first() if target_height <= 720 else None
+            video_streams = streams.filter(adaptive=True, only_video=True, res=resolution)
+            video = video_streams.filter(subtype='mp4').first() or video_streams.first()
+            audio = streams.filter(only_audio=True, subtype='mp4').order_by('abr').desc().first() or best_audio
+            if exact:
+                selected = [exact]
+            elif video and audio:
+                selected = [video, audio]
             else:
-                # Скачиваем лучшее доступное прогрессивное качество
-                best_stream = yt.streams.filter(progressive=True).order_by('resolution').desc().first()
-                if not best_stream:
-                    logger.error("No progressive streams found")
-                    return None
-                    
-                if not self.check_file_size(best_stream):
-                    return None
-                    
-                file_path = best_stream.download(output_path=self.download_dir)
-                logger.info(f"Best quality download ({best_stream.resolution}) completed: {file_path}")
-                return file_path, title
+                nearest = next((stream for stream in progressive
+                                if stream.resolution and int(stream.resolution[:-1]) <= target_height), None)
+                selected = [nearest or progressive.first()]
+        else:
+            selected = [progressive.first()]
+        
+        if None in selected:
+            return StreamSelection(yt, yt.title, [])
+        for stream in selected:
+            self._resolve_stream_properties(stream)
+        return StreamSelection(yt, yt.title, selected)
+    
+    @staticmethod
+    def _resolve_stream_properties(stream) -> Tuple[str, int, str]:
+        """Заранее вычисляет ленивые свойства потока pytubefix.
+        
+        Подпись ссылки и размер (может потребовать HEAD) считаются при первом обращении.
+        Вызывается в рабочем потоке, чтобы асинхронная загрузка не блокировала цикл событий.
+        """
+        return stream.url, stream.filesize, stream.default_filename
+    
+    def _get_http_client(self) -> httpx.AsyncClient:
+        if self._http_client is None:
+            self._http_client = httpx.AsyncClient(follow_redirects=True, timeout=httpx.Timeout(30, read=60))
+        return self._http_client
+    
+    async def download_video_async(self, url: str, resolution: str = None, progress_callback=None,
+                                   selection: Optional[StreamSelection] = None) -> Optional[Tuple[str, str]]:
+        """Асинхронная версия download_video.
+        
+        В потоке выполняется только извлечение; байты качаются через httpx на цикле событий
+        и пишутся отдельной стадией записи. Отмена корутины прерывает загрузку и слияние
+        и удаляет частичные файлы.
+        """
+        key = self.storage_key(url, resolution)
+        stored = await asyncio.to_thread(restore, self.storage, key, self.download_dir)
+        if stored:
+            return stored
+        bandwidth_job = get_bandwidth_scheduler().register(INGRESS)
+        merge_parts = []
+        try:
+            if selection is None:
+                selection = await asyncio.to_thread(self.select_streams, url, resolution)
+            title, streams = selection.title, selection.streams
+            if not streams:
+                logger.error(f"No suitable streams found for resolution {resolution}")
+                return None
+            
+            combined = _CombinedProgress(streams, progress_callback) if len(streams) > 1 else None
+            if not self.check_file_size(combined or streams[0]):
+                return None
+            
+            logger.info(f"Starting async download: {title} ({', '.join(str(s.itag) for s in streams)})")
+            client = self._get_http_client()
+            
+            async def fetch(stream, prefix: str) -> str:
+                remaining = stream.filesize
                 
-        except Exception as e:
+                def on_chunk(chunk: bytes):
+                    nonlocal remaining
+                    remaining -= len(chunk)
+                    callback = combined or progress_callback
+                    if callback:
+                        callback(stream, chunk, remaining)
+                
+                path = os.path.join(self.download_dir, prefix + stream.default_filename)
+                return await fetch_to_file(client, stream.url, path, stream.filesize, on_chunk, bandwidth_job)
+            
+            if not combined:
+                file_path = await fetch(streams[0], '')
+                logger.info(f"Async download completed: {file_path}")
+                return await asyncio.to_thread(save, self.storage, key, (file_path, title))
+            
+            # Видео и аудио качаем одновременно; при ошибке одного останавливаем второй
+            tasks = [asyncio.create_task(fetch(stream, prefix))
+                     for stream, prefix in zip(streams, ('video_', 'audio_'))]
+            try:
+                merge_parts = await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            
+            if hasattr(progress_callback, 'set_stage'):
+                progress_callback.set_stage(STAGE_MERGE)
+            output_path = os.path.join(self.download_dir, self._clean_filename(title) + '.mp4')
+            await self._merge_video_audio_async(merge_parts[0], merge_parts[1], output_path)
+            logger.info(f"Async adaptive download completed: {output_path}")
+            return await asyncio.to_thread(save, self.storage, key, (output_path, title))
+            
+        except DownloadError as e:
             logger.error(f"Error downloading video: {e}")
             return None
+        except asyncio.CancelledError:
+            logger.info(f"Async download cancelled: {url}")
+            raise
+        except Exception as e:
+            logger.error(f"Error in async download: {e}")
+            return None
+        finally:
+            bandwidth_job.close()
+            await remove_files(*merge_parts)
+    
+    def download_clip(self, url: str, resolution: str, start: float, end: float,
+                      selection: Optional[StreamSelection] = None) -> Optional[Tuple[str, str]]:
+        """Скачивает только фрагмент [start, end].
+        
+        ffmpeg читает ссылки потоков сам и запрашивает лишь диапазоны байт около фрагмента;
+        видео режется по ключевым кадрам без перекодирования, аудио сразу кодируется в MP3.
+        """
+        key = self.storage_key(url, resolution, (start, end))
+        stored = restore(self.storage, key, self.download_dir)
+        if stored:
+            return stored
+        try:
+            if selection is None:
+                selection = self.select_streams(url, resolution)
+            title, streams = selection.title, selection.streams
+        except DownloadError as e:
+            logger.error(f"Error resolving streams for clip: {e}")
+            return None
+        if not streams:
+            logger.error(f"No suitable streams found for resolution {resolution}")
+            return None
+        
+        base_path = os.path.join(self.download_dir, f"{self._clean_filename(title)}_{int(start)}-{int(end)}")
+        inputs = [ffmpeg.input(stream.url, ss=start, t=end - start) for stream in streams]
+        output_path = None
+        try:
+            if resolution == 'audio':
+                output_path = base_path + '.mp3'
+                # Битрейт по длительности фрагмента, как у целых записей: MP3 сразу влезает в лимит
+                command = inputs[0].output(output_path, acodec='mp3', audio_bitrate=f"{mp3_bitrate(end - start)}k")
+                priority = PRIORITY_AUDIO
+            else:
+                output_path = base_path + '.mp4'
+                video, audio = streams[0], streams[-1]
+                codec_params = mp4_merge_codecs(codec_family(video.video_codec), codec_family(audio.audio_codec))
+                command = ffmpeg.output(inputs[0]['v:0'], inputs[-1]['a:0'], output_path,
+                                        movflags=FASTSTART_MOVFLAGS, **codec_params)
+                priority = PRIORITY_AUDIO if codec_params['vcodec'] == 'copy' else PRIORITY_VIDEO
+            
+            logger.info(f"Cutting clip {start:.0f}-{end:.0f}s from {title} ({resolution})")
+            get_transcoder().run(command.overwrite_output(), priority=priority)
+            self._check_merged(output_path)
+            return save(self.storage, key, (output_path, title))
+        except Exception as e:
+            logger.error(f"Error downloading clip: {e}")
+            if output_path:
+                self.cleanup_file(output_path)
+            return None
+    
+    def resolve_direct_stream(self, url: str, resolution: str = None,
+                              selection: Optional[StreamSelection] = None) -> Optional[DirectStream]:
+        """Прямая ссылка на выбранный поток без скачивания, если он один (без слияния)"""
+        try:
+            if selection is None:
+                selection = self.select_streams(url, resolution)
+            if len(selection.streams) != 1:
+                return None
+            stream = selection.streams[0]
+            if not stream.filesize:
+                return None
+            return DirectStream(
+                url=stream.url,
+                size=stream.filesize,
+                mime_type=stream.mime_type,
+                kind='audio' if resolution == 'audio' else 'video',
+                filename=stream.default_filename,
+                title=selection.title
+            )
+        except Exception as e:
+            logger.error(f"Error resolving direct stream: {e}")
+            return None
+    
+    def _download_adaptive(self, yt: YouTube, resolution: str, title: str,
+                           progress_callback=None) -> Optional[Tuple[str, str]]:
+        """Параллельно скачивает адаптивные видео и аудио потоки и объединяет их"""
+        part_paths = []
+        try:
+            video_streams = yt.streams.filter(adaptive=True, only_video=True, res=resolution)
+            # MP4 (H.264) можно объединить без перекодирования
+            video_stream = video_streams.filter(subtype='mp4').first() or video_streams.first()
+            if not video_stream:
+                logger.info(f"No adaptive video stream for {resolution}")
+                return None
+            
+            audio_streams = yt.streams.filter(only_audio=True)
+            audio_stream = (audio_streams.filter(subtype='mp4').order_by('abr').desc().first()
+                            or audio_streams.order_by('abr').desc().first())
+            if not audio_stream:
+                logger.error("No audio stream found for adaptive download")
+                return None
+            
+            combined = _CombinedProgress([video_stream, audio_stream], progress_callback)
+            if not self.check_file_size(combined):
+                return None
+            yt.register_on_progress_callback(combined)
+            
+            logger.info(f"Adaptive download: video {video_stream.itag} ({video_stream.resolution}, "
+                        f"{video_stream.subtype}) + audio {audio_stream.itag} ({audio_stream.abr})")
+            
+            # Видео и аудио качаем одновременно: общее время = max, а не сумма
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                video_future = executor.submit(video_stream.download, output_path=self.download_dir,
+                                               filename_prefix='video_')
+                audio_future = executor.submit(audio_stream.download, output_path=self.download_dir,
+                                               filename_prefix='audio_')
+                for future in (video_future, audio_future):
+                    try:
+                        part_paths.append(future.result())
+                    except Exception as e:
+                        logger.error(f"Adaptive stream download failed: {e}")
+                        part_paths.append(None)
+            
+            if None in part_paths:
+                return None
+            
+            if hasattr(progress_callback, 'set_stage'):
+                progress_callback.set_stage(STAGE_MERGE)
+            output_path = os.path.join(self.download_dir, self._clean_filename(title) + '.mp4')
+            self._merge_video_audio(part_paths[0], part_paths[1], output_path)
+            logger.info(f"Adaptive video ({video_stream.resolution}) download completed: {output_path}")
+            return output_path, title
+            
+        except Exception as e:
+            logger.error(f"Error downloading adaptive streams: {e}")
+            return None
+        finally:
+            for path in part_paths:
+                if path:
+                    self.cleanup_file(path)
     
     def _clean_filename(self, filename: str) -> str:
         """Очищает имя файла от недопустимых символов"""
         import re
         return re.sub(r'[<>:"/\\|?*]', '_', filename)
     
-    def _merge_video_audio(self, video_path: str, audio_path: str, output_path: str):
-        """Объединяет видео и аудио файлы"""
-        try:
-            # Проверяем что исходные файлы существуют и не пустые
-            if not os.path.exists(video_path) or os.path.getsize(video_path) == 0:
-                raise Exception(f"Video file is missing or empty: {video_path}")
-            if not os.path.exists(audio_path) or os.path.getsize(audio_path) == 0:
-                raise Exception(f"Audio file is missing or empty: {audio_path}")
-            
-            logger.info(f"Merging video ({os.path.getsize(video_path)} bytes) with audio ({os.path.getsize(audio_path)} bytes)")
-            
-            # Используем более безопасные параметры ffmpeg
-            (
-                ffmpeg
-                .input(video_path)
-                .input(audio_path)
-                .output(
-                    output_path,
-                    vcodec='copy',
-                    acodec='aac',  # Конвертируем аудио в AAC для совместимости
-                    strict='experimental'
-                )
-                .overwrite_output()
-                .run(quiet=False, capture_stdout=True, capture_stderr=True)
-            )
-            
-            # Проверяем что результат не пустой
-            if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
-                raise Exception(f"Merged file is empty or wasn't created: {output_path}")
-                
-            logger.info(f"Successfully merged to {output_path} ({os.path.getsize(output_path)} bytes)")
-            
-        except ffmpeg.Error as e:
-            logger.error(f"FFmpeg error: {e.stderr.decode() if e.stderr else str(e)}")
+    def _merge_video_audio(self, video_path: str, audio_path: str, output_path: str,
+                           fragmented: bool = False):
+        """Объединяет видео и аудио файлы, перекодируя только несовместимые с MP4 дорожки"""
+        try:
+            stream, priority = self._merge_command(video_path, audio_path, output_path, fragmented)
+            get_transcoder().run(stream, priority=priority)
+            self._check_merged(output_path)
+        except TranscodeError as e:
+            logger.error(f"FFmpeg error ({e.reason}): {e.summary or e}")
             raise
         except Exception as e:
             logger.error(f"Error merging video and audio: {e}")
             raise
     
-    def convert_to_mp3(self, video_path: str) -> Optional[str]:
+    async def _merge_video_audio_async(self, video_path: str, audio_path: str, output_path: str):
+        """Асинхронное слияние: отмена корутины убивает ffmpeg"""
+        try:
+            stream, priority = await asyncio.to_thread(self._merge_command, video_path, audio_path, output_path)
+            await get_transcoder().run_async(stream, priority=priority)
+            await asyncio.to_thread(self._check_merged, output_path)
+        except TranscodeError as e:
+            logger.error(f"FFmpeg error ({e.reason}): {e.summary or e}")
+            raise
+    
+    def _merge_command(self, video_path: str, audio_path: str, output_path: str,
+                       fragmented: bool = False):
+        """Команда ffmpeg для слияния и ее приоритет в пуле"""
+        # Проверяем что исходные файлы существуют и не пустые
+        if not os.path.exists(video_path) or os.path.getsize(video_path) == 0:
+            raise Exception(f"Video file is missing or empty: {video_path}")
+        if not os.path.exists(audio_path) or os.path.getsize(audio_path) == 0:
+            raise Exception(f"Audio file is missing or empty: {audio_path}")
+        
+        logger.info(f"Merging video ({os.path.getsize(video_path)} bytes) with audio ({os.path.getsize(audio_path)} bytes)")
+        
+        # Смотрим кодеки, чтобы копировать дорожки без перекодирования где возможно
+        video_codec = probe_codec(video_path, 'video')
+        audio_codec = probe_codec(audio_path, 'audio')
+        codec_params = mp4_merge_codecs(video_codec, audio_codec)
+        logger.info(f"Merge codecs: video {video_codec} -> {codec_params['vcodec']}, "
+                    f"audio {audio_codec} -> {codec_params['acodec']}")
+        
+        # moov в начале файла, чтобы Telegram мог играть видео до полной загрузки
+        movflags = FRAGMENTED_MOVFLAGS if fragmented else FASTSTART_MOVFLAGS
+        
+        stream = (
+            ffmpeg
+            .output(
+                ffmpeg.input(video_path)['v:0'],
+                ffmpeg.input(audio_path)['a:0'],
+                output_path,
+                movflags=movflags,
+                **codec_params
+            )
+            .overwrite_output()
+        )
+        # Копирование дорожек почти не нагружает CPU
+        return stream, PRIORITY_AUDIO if codec_params['vcodec'] == 'copy' else PRIORITY_VIDEO
+    
+    def _check_merged(self, output_path: str):
+        # Проверяем что результат не пустой
+        if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+            raise Exception(f"Merged file is empty or wasn't created: {output_path}")
+        logger.info(f"Successfully merged to {output_path} ({os.path.getsize(output_path)} bytes)")
+    
+    def convert_to_mp3(self, video_path: str, duration: Optional[float] = None) -> Optional[str]:
+        """MP3 с битрейтом, при котором файл влезает в лимит отправки; duration - из метаданных источника"""
         try:
             audio_path = video_path.rsplit('.', 1)[0] + '.mp3'
             
             logger.info(f"Converting to MP3: {video_path}")
-            (
-                ffmpeg
-                .input(video_path)
-                .output(audio_path, acodec='mp3', audio_bitrate='64k')
-                .overwrite_output()
-                .run(quiet=True)
-            )
+            encode_mp3(video_path, audio_path, duration, priority=PRIORITY_AUDIO)
             
             logger.info(f"Conversion completed: {audio_path}")
             return audio_path
@@ -215,6 +786,38 @@ class YouTubeDownloader:
             logger.error(f"Error converting to MP3: {e}")
             return None
     
+    def convert_to_mp3_bytes(self, data: bytes, duration: Optional[float] = None) -> Optional[bytes]:
+        """Конвертирует аудио в MP3 через pipe, не создавая файлов; битрейт - как у convert_to_mp3"""
+        try:
+            logger.info(f"Converting {len(data)} bytes to MP3 in memory")
+            audio_data = encode_mp3_bytes(data, duration, priority=PRIORITY_AUDIO)
+            if not audio_data:
+                logger.error("In-memory MP3 conversion produced no data")
+                return None
+            
+            logger.info(f"In-memory conversion completed: {len(audio_data)} bytes")
+            return audio_data
+            
+        except Exception as e:
+            logger.error(f"Error converting to MP3 in memory: {e}")
+            return None
+    
+    def fit_to_limit(self, video_path: str, max_size: int = 50 * 1024 * 1024) -> Optional[str]:
+        """Сжимает видео, немного превышающее лимит, в один файл вместо нарезки на части"""
+        plan = plan_fit_to_limit(video_path, max_size)
+        if not plan:
+            return None
+        output_path = video_path.rsplit('.', 1)[0] + '.fit.mp4'
+        try:
+            logger.info(f"Compressing {video_path} to {plan.video_bitrate // 1000} kbps")
+            if compress_to_limit(video_path, output_path, plan, max_size):
+                return output_path
+            logger.warning(f"Compressed file still exceeds {max_size} bytes")
+        except Exception as e:
+            logger.error(f"Error compressing to limit: {e}")
+            self.cleanup_file(output_path)
+        return None
+    
     def cleanup_file(self, file_path: str):
         try:
             if os.path.exists(file_path):
@@ -224,6 +827,7 @@ class YouTubeDownloader:
             logger.error(f"Error deleting file {file_path}: {e}")
 
 if __name__ == "__main__":
+    setup_logging(log_file=os.getenv('LOG_FILE', 'downloader.log'))
     downloader = YouTubeDownloader()
     
     url = input("Enter YouTube URL: ")
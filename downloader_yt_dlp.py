@@ -1,27 +1,31 @@
 import os
 import logging
 import yt_dlp
-import ffmpeg
 from typing import Optional, Tuple, List
+from transcoder import PRIORITY_AUDIO, plan_fit_to_limit, compress_to_limit, encode_mp3
+from download_errors import DownloadError, get_retry_manager, classify_exception
+from identity_pool import IdentityPool, Identity
+from ydl_pool import YDLPool
+from metadata_cache import MetadataCache
+from youtube_utils import extract_video_id
+from log_setup import setup_logging
+from progress import ProgressTracker, SizedStream
+from bandwidth import get_bandwidth_scheduler, BandwidthJob, INGRESS
+from format_selection import available_resolutions, select_format
+from passthrough import DirectStream
+from storage import MediaStorage, get_storage, media_key, restore, save
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('downloader.log'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
+# Поля формата, которые содержат подписанные ссылки и быстро устаревают
+UNSTABLE_FORMAT_FIELDS = ('url', 'manifest_url', 'fragment_base_url', 'fragments', 'http_headers')
+
 class YouTubeDownloader:
-    def __init__(self, download_dir: str = "./downloads"):
+    def __init__(self, download_dir: str = "./downloads", identity_pool: Optional[IdentityPool] = None,
+                 metadata_cache: Optional[MetadataCache] = None, storage: Optional[MediaStorage] = None):
         self.download_dir = download_dir
         os.makedirs(download_dir, exist_ok=True)
         
-        # Путь к файлу с куками
-        cookies_path = os.path.join(download_dir, 'youtube_cookies.txt')
-        
         self.ydl_opts = {
             'outtmpl': f'{download_dir}/%(title)s.%(ext)s',
             'format': 'best',  # Будем задавать конкретный формат в download_video
@@ -29,56 +33,103 @@ class YouTubeDownloader:
             'writesubtitles': False,
             'writeautomaticsub': False,
             'merge_output_format': 'mp4',  # Объединяем в mp4
+            'quiet': True,
         }
+        # Готовые экземпляры YoutubeDL переиспользуются между запросами
+        self.ydl_pool = YDLPool(self.ydl_opts)
         
-        # Добавляем куки если файл существует
-        if os.path.exists(cookies_path):
-            self.ydl_opts['cookiefile'] = cookies_path
-            logger.info(f"Using cookies from {cookies_path}")
-        else:
-            logger.warning(f"No cookies file found at {cookies_path}")
+        # Куки и исходящие адреса: youtube_cookies.txt, cookies/*.txt и YT_SOURCE_ADDRESSES
+        if identity_pool is None:
+            source_addresses = [a.strip() for a in os.getenv('YT_SOURCE_ADDRESSES', '').split(',') if a.strip()]
+            identity_pool = IdentityPool.from_directory(download_dir, source_addresses)
+        self.identity_pool = identity_pool
+        
+        if metadata_cache is None and os.getenv('METADATA_CACHE_ENABLED', '1') == '1':
+            metadata_cache = MetadataCache()
+        self.metadata_cache = metadata_cache
+        # Общее для всех узлов хранилище готовых файлов (MEDIA_STORAGE)
+        self.storage = storage if storage is not None else get_storage()
+    
+    def storage_key(self, url: str, resolution: str = None, clip: Optional[Tuple[float, float]] = None,
+                    transform: Optional[str] = None) -> Optional[str]:
+        """Ключ результата в общем хранилище; None, если хранилище не настроено"""
+        video_id = extract_video_id(url)
+        return media_key(video_id, resolution, clip, transform) if self.storage and video_id else None
     
     def get_video_info(self, url: str) -> Optional[dict]:
-        try:
-            opts = {'quiet': True}
-            # Добавляем куки если они есть
-            if 'cookiefile' in self.ydl_opts:
-                opts['cookiefile'] = self.ydl_opts['cookiefile']
-                
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                logger.info(f"Video found: {info.get('title', 'Unknown')}")
+        video_id = extract_video_id(url)
+        if video_id and self.metadata_cache:
+            # Пока подписанные ссылки действуют, кэш содержит полную информацию
+            streams = self.metadata_cache.get_streams(video_id, 'yt_dlp')
+            if streams:
+                logger.info(f"Video found in cache with stream URLs: {streams.get('title', 'Unknown')}")
+                return streams
+            
+            cached = self.metadata_cache.get(video_id, 'yt_dlp')
+            if cached:
+                info, stale = cached
+                if stale:
+                    self.metadata_cache.refresh_in_background(
+                        video_id, 'yt_dlp',
+                        lambda: get_retry_manager().call(lambda: self._get_video_info(url), url, breakers=['yt_dlp'])
+                    )
+                logger.info(f"Video found in cache: {info.get('title', 'Unknown')}")
                 return info
-        except Exception as e:
+        
+        try:
+            return get_retry_manager().call(lambda: self._get_video_info(url), url, breakers=['yt_dlp'])
+        except DownloadError as e:
             logger.error(f"Error getting video info: {e}")
             return None
     
+    def _get_video_info(self, url: str) -> dict:
+        with self.identity_pool.use(classify_exception) as identity:
+            return self._extract_info(url, identity)
+    
+    def _extract_info(self, url: str, identity: Identity) -> dict:
+        with self.ydl_pool.checkout(identity) as ydl:
+            info = ydl.extract_info(url, download=False)
+            logger.info(f"Video found: {info.get('title', 'Unknown')}")
+        self._cache_info(info)
+        return info
+    
+    def _cache_info(self, info: dict):
+        """Сохраняет информацию в кэш: без ссылок - надолго, со ссылками - до их истечения"""
+        video_id = info.get('id')
+        if not self.metadata_cache or not video_id:
+            return
+        try:
+            full = yt_dlp.YoutubeDL.sanitize_info(info)
+            stable = dict(full)
+            stable.pop('url', None)
+            stable.pop('requested_formats', None)
+            stable['formats'] = [
+                {key: value for key, value in f.items() if key not in UNSTABLE_FORMAT_FIELDS}
+                for f in full.get('formats', [])
+            ]
+            stream_urls = [f['url'] for f in full.get('formats', []) if f.get('url')]
+            self.metadata_cache.put(video_id, 'yt_dlp', stable, streams=full, stream_urls=stream_urls)
+        except Exception as e:
+            logger.error(f"Error caching video info: {e}")
+    
+    def last_error(self, url: str) -> Optional[DownloadError]:
+        """Классифицированная причина последней неудачи для этого видео"""
+        return get_retry_manager().last_error(url)
+    
     def get_available_resolutions(self, info: dict) -> List[str]:
         try:
             formats = info.get('formats', [])
-            resolutions = set()
-            
-            # Логируем все форматы для отладки
-            logger.info("Available formats:")
-            for f in formats:
-                logger.info(f"Format ID: {f.get('format_id')}, Height: {f.get('height')}, "
-                           f"VCodec: {f.get('vcodec')}, Extension: {f.get('ext')}")
-                
-                if f.get('height') and f.get('vcodec') != 'none' and f.get('ext') in ['mp4', 'webm']:
-                    resolutions.add(f"{f['height']}p")
+            if logger.isEnabledFor(logging.DEBUG):
+                for f in formats:
+                    logger.debug(f"Format ID: {f.get('format_id')}, Height: {f.get('height')}, "
+                                 f"VCodec: {f.get('vcodec')}, Extension: {f.get('ext')}")
             
-            # Если нет видео форматов, добавляем стандартные опции
-            if not resolutions:
+            result = available_resolutions(formats)
+            if result == ['audio']:
+                # Нет видео форматов - только аудио
                 logger.warning("No video formats found, using fallback")
-                return ['audio']  # Только аудио
-            
-            # Сортируем по качеству
-            sorted_resolutions = sorted(resolutions, 
-                                      key=lambda x: int(x.replace('p', '')), 
-                                      reverse=True)
+                return result
             
-            # Добавляем опцию "audio"
-            result = sorted_resolutions[:5] + ['audio']
             logger.info(f"Available resolutions: {result}")
             return result
             
@@ -112,163 +163,164 @@ class YouTubeDownloader:
     
     def download_video(self, url: str, resolution: str = None, 
                       progress_callback=None) -> Optional[Tuple[str, str]]:
+        key = self.storage_key(url, resolution)
+        stored = restore(self.storage, key, self.download_dir)
+        if stored:
+            return stored
+        try:
+            return save(self.storage, key, get_retry_manager().call(
+                lambda: self._download_video(url, resolution, progress_callback),
+                url,
+                breakers=['yt_dlp']
+            ))
+        except DownloadError as e:
+            logger.error(f"Error downloading video: {e}")
+            return None
+    
+    def download_clip(self, url: str, resolution: str, start: float, end: float,
+                      progress_callback=None) -> Optional[Tuple[str, str]]:
+        """Скачивает только фрагмент [start, end]: yt-dlp запрашивает лишь нужные диапазоны
+        и фрагменты DASH, а ffmpeg режет по ключевым кадрам без перекодирования"""
+        key = self.storage_key(url, resolution, (start, end))
+        stored = restore(self.storage, key, self.download_dir)
+        if stored:
+            return stored
+        clip_opts = {
+            'download_ranges': yt_dlp.utils.download_range_func(None, [(start, end)]),
+            'force_keyframes_at_cuts': False,
+            # Экземпляр из пула уже привел outtmpl к словарю, поэтому подменяем словарем
+            'outtmpl': {'default': os.path.join(self.download_dir, f'%(title)s_{int(start)}-{int(end)}.%(ext)s')},
+        }
+        try:
+            return save(self.storage, key, get_retry_manager().call(
+                lambda: self._download_video(url, resolution, progress_callback, clip_opts),
+                url,
+                breakers=['yt_dlp']
+            ))
+        except DownloadError as e:
+            logger.error(f"Error downloading clip: {e}")
+            return None
+    
+    def _download_video(self, url: str, resolution: str = None, progress_callback=None,
+                        extra_opts: Optional[dict] = None) -> Optional[Tuple[str, str]]:
+        # Весь запрос идет от одной идентичности; повтор может получить другую
+        bandwidth_job = get_bandwidth_scheduler().register(INGRESS)
         try:
-            info = self.get_video_info(url)
+            with self.identity_pool.use(classify_exception) as identity:
+                return self._download_with_identity(url, resolution, progress_callback, identity, bandwidth_job,
+                                                    extra_opts)
+        finally:
+            bandwidth_job.close()
+    
+    def _download_with_identity(self, url: str, resolution: str, progress_callback,
+                                identity: Identity, bandwidth_job: BandwidthJob,
+                                extra_opts: Optional[dict] = None) -> Optional[Tuple[str, str]]:
+        # Ошибки извлечения пробрасываем наружу, чтобы повторы не вкладывались друг в друга.
+        # Ссылки из кэша привязаны к IP, поэтому с отдельным исходящим адресом их не берем
+        info = None
+        video_id = extract_video_id(url)
+        if video_id and self.metadata_cache and not identity.source_address:
+            info = self.metadata_cache.get_streams(video_id, 'yt_dlp')
+        if not info:
+            info = self._extract_info(url, identity)
+        
+        title = info.get('title', 'video')
+        
+        # Параметры запроса накладываются на общий профиль пула YoutubeDL;
+        # форматы уже получены при извлечении информации, повторный запрос не нужен
+        opts = {}
+        try:
+            opts['format'], description = select_format(info.get('formats', []), resolution)
+        except Exception as e:
+            logger.error(f"Error selecting format: {e}")
+            opts['format'], description = 'best', "fallback format: best"
+        logger.info(f"Using {description}")
+        opts.update(extra_opts or {})
+        
+        # Хук планировщика ограничивает скорость загрузки долей общей полосы
+        progress_hooks = [bandwidth_job.ydl_hook]
+        if progress_callback:
+            progress_hooks.append(self._wrap_progress_callback(progress_callback))
+        
+        # Проверяем размер файла
+        if not self.check_file_size(info):
+            logger.error("File too large")
+            return None
+        
+        logger.info(f"Starting download: {title}")
+        
+        # Скачиваем по уже извлеченной информации, не извлекая видео заново
+        with self.ydl_pool.checkout(identity, overrides=opts, progress_hooks=progress_hooks) as ydl:
+            result = ydl.process_ie_result(info, download=True)
+        
+        # Путь из результата yt-dlp надежнее поиска по названию (например, для фрагментов)
+        downloads = (result or {}).get('requested_downloads') or []
+        video_path = downloads[0].get('filepath') if downloads else None
+        if not video_path or not os.path.exists(video_path):
+            video_path = self._find_downloaded_file(title)
+        if video_path:
+            logger.info(f"Download completed: {video_path}")
+            return video_path, title
+        else:
+            logger.error("Downloaded file not found")
+            return None
+    
+    def resolve_direct_stream(self, url: str, resolution: str = None) -> Optional[DirectStream]:
+        """Прямая ссылка на готовый поток (комбинированный MP4 или аудио M4A) без скачивания"""
+        try:
+            video_id = extract_video_id(url)
+            info = None
+            if video_id and self.metadata_cache:
+                info = self.metadata_cache.get_streams(video_id, 'yt_dlp')
             if not info:
-                return None
-            
-            title = info.get('title', 'video')
-            
-            # Полностью переработанная логика выбора формата
-            opts = self.ydl_opts.copy()
+                info = self._extract_info(url, Identity())
             
+            formats = [f for f in info.get('formats', []) if f.get('url') and f.get('protocol') in ('https', 'http')]
             if resolution == 'audio':
-                # Для аудио - просто скачиваем аудио и конвертируем отдельно
-                opts['format'] = 'bestaudio[ext=m4a]/bestaudio/best'
-                # Убираем автоматическую конвертацию, сделаем это вручную
-                logger.info("Using audio format: bestaudio")
-                
-            elif resolution and resolution != 'audio':
-                # Для видео - простая логика выбора качества
-                height = resolution.replace("p", "")
-                
-                # Сначала получаем все доступные форматы
-                opts = {'quiet': True}
-                if 'cookiefile' in self.ydl_opts:
-                    opts['cookiefile'] = self.ydl_opts['cookiefile']
-                with yt_dlp.YoutubeDL(opts) as ydl:
-                    try:
-                        formats_info = ydl.extract_info(url, download=False)
-                        available_formats = formats_info.get('formats', [])
-                        
-                        # Ищем подходящий формат
-                        best_format = None
-                        target_height = int(height)
-                        
-                        # Ищем комбинированные форматы (с видео и аудио)
-                        combined_formats = [f for f in available_formats 
-                                          if f.get('vcodec') != 'none' and f.get('acodec') != 'none' 
-                                          and f.get('height')]
-                        
-                        # Ищем отдельные видео форматы
-                        video_only_formats = [f for f in available_formats 
-                                            if f.get('vcodec') != 'none' and f.get('acodec') == 'none' 
-                                            and f.get('height')]
-                        
-                        # Ищем аудио форматы
-                        audio_formats = [f for f in available_formats 
-                                       if f.get('acodec') != 'none' and f.get('vcodec') == 'none']
-                        
-                        # Сначала пробуем найти комбинированный формат
-                        if combined_formats:
-                            suitable_formats = [f for f in combined_formats 
-                                              if f.get('height', 0) <= target_height]
-                            
-                            if suitable_formats:
-                                best_format = max(suitable_formats, 
-                                                key=lambda x: x.get('height', 0))
-                                opts['format'] = best_format['format_id']
-                                logger.info(f"Selected combined format: {best_format['format_id']} "
-                                          f"({best_format.get('height')}p)")
-                            else:
-                                # Берем самый низкий комбинированный
-                                best_format = min(combined_formats, 
-                                                key=lambda x: x.get('height', 999999))
-                                opts['format'] = best_format['format_id']
-                                logger.info(f"Fallback to lowest combined format: {best_format['format_id']} "
-                                          f"({best_format.get('height')}p)")
-                        
-                        # Если нет комбинированных, объединяем видео + аудио
-                        elif video_only_formats and audio_formats:
-                            suitable_video = [f for f in video_only_formats 
-                                            if f.get('height', 0) <= target_height]
-                            
-                            if suitable_video:
-                                best_video = max(suitable_video, 
-                                               key=lambda x: x.get('height', 0))
-                            else:
-                                best_video = min(video_only_formats, 
-                                               key=lambda x: x.get('height', 999999))
-                            
-                            # Берем лучший аудио формат
-                            best_audio = max(audio_formats, 
-                                           key=lambda x: x.get('abr', 0) or 0)
-                            
-                            opts['format'] = f"{best_video['format_id']}+{best_audio['format_id']}"
-                            logger.info(f"Selected video+audio: {best_video['format_id']} "
-                                      f"({best_video.get('height')}p) + {best_audio['format_id']}")
-                        
-                        else:
-                            opts['format'] = 'best'
-                            logger.info("No suitable formats found, using 'best'")
-                            
-                    except Exception as e:
-                        logger.error(f"Error selecting format: {e}")
-                        opts['format'] = 'best'
-                        logger.info("Using fallback format: best")
+                candidates = [f for f in formats if f.get('vcodec') == 'none' and f.get('ext') == 'm4a']
+                fmt = max(candidates, key=lambda f: f.get('abr') or 0) if candidates else None
+                kind, mime_type = 'audio', 'audio/mp4'
             else:
-                # Просто лучшее качество
-                opts['format'] = 'best'
-                logger.info("Using format: best")
-            
-            if progress_callback:
-                opts['progress_hooks'] = [self._wrap_progress_callback(progress_callback)]
+                format_id, _ = select_format(formats, resolution)
+                fmt = next((f for f in formats if f['format_id'] == format_id and f.get('ext') == 'mp4'
+                            and f.get('vcodec') != 'none' and f.get('acodec') != 'none'), None)
+                kind, mime_type = 'video', 'video/mp4'
             
-            # Проверяем размер файла
-            if not self.check_file_size(info):
-                logger.error("File too large")
+            size = fmt and (fmt.get('filesize') or fmt.get('filesize_approx'))
+            if not size:
                 return None
-            
-            logger.info(f"Starting download: {title}")
-            
-            # Убираем simulate для реального скачивания
-            opts.pop('simulate', None)
-            
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                ydl.download([url])
-            
-            # Находим скачанный файл
-            video_path = self._find_downloaded_file(title)
-            if video_path:
-                logger.info(f"Download completed: {video_path}")
-                return video_path, title
-            else:
-                logger.error("Downloaded file not found")
-                return None
-            
+            title = info.get('title', 'video')
+            return DirectStream(
+                url=fmt['url'],
+                size=int(size),
+                mime_type=mime_type,
+                kind=kind,
+                filename=f"{title}.{fmt['ext']}",
+                title=title,
+                headers=fmt.get('http_headers')
+            )
         except Exception as e:
-            logger.error(f"Error downloading video: {e}")
+            logger.error(f"Error resolving direct stream: {e}")
             return None
     
     def _wrap_progress_callback(self, callback):
+        if isinstance(callback, ProgressTracker):
+            return callback.ydl_hook
+        
+        # Старый колбэк в сигнатуре pytubefix: один объект на загрузку, а не на каждый тик
+        stream = SizedStream()
+        
         def progress_hook(d):
             try:
+                total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
                 if d['status'] == 'downloading':
-                    downloaded = d.get('downloaded_bytes', 0)
-                    total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-                    
                     if total > 0:
-                        # Создаем фейковый stream объект
-                        class FakeStream:
-                            def __init__(self, filesize):
-                                self.filesize = filesize
-                        
-                        fake_stream = FakeStream(total)
-                        bytes_remaining = total - downloaded
-                        
-                        # Вызываем оригинальный callback
-                        callback(fake_stream, None, bytes_remaining)
-                        
+                        stream.filesize = total
+                        callback(stream, None, total - d.get('downloaded_bytes', 0))
                 elif d['status'] == 'finished':
                     # 100% когда закончили
-                    class FakeStream:
-                        def __init__(self, filesize):
-                            self.filesize = filesize
-                    
-                    total = d.get('total_bytes', 0) or 1000000  # fallback
-                    fake_stream = FakeStream(total)
-                    callback(fake_stream, None, 0)  # 0 bytes remaining = 100%
-                    
+                    stream.filesize = total or d.get('downloaded_bytes') or 1
+                    callback(stream, None, 0)
             except Exception as e:
                 logger.error(f"Progress callback error: {e}")
         
@@ -307,18 +359,13 @@ class YouTubeDownloader:
         
         return None
     
-    def convert_to_mp3(self, video_path: str) -> Optional[str]:
+    def convert_to_mp3(self, video_path: str, duration: Optional[float] = None) -> Optional[str]:
+        """MP3 с битрейтом, при котором файл влезает в лимит отправки; duration - из метаданных источника"""
         try:
             audio_path = video_path.rsplit('.', 1)[0] + '.mp3'
             
             logger.info(f"Converting to MP3: {video_path}")
-            (
-                ffmpeg
-                .input(video_path)
-                .output(audio_path, acodec='mp3', audio_bitrate='64k')
-                .overwrite_output()
-                .run(quiet=True)
-            )
+            encode_mp3(video_path, audio_path, duration, priority=PRIORITY_AUDIO)
             
             logger.info(f"Conversion completed: {audio_path}")
             return audio_path
@@ -327,6 +374,22 @@ class YouTubeDownloader:
             logger.error(f"Error converting to MP3: {e}")
             return None
     
+    def fit_to_limit(self, video_path: str, max_size: int = 50 * 1024 * 1024) -> Optional[str]:
+        """Сжимает видео, немного превышающее лимит, в один файл вместо нарезки на части"""
+        plan = plan_fit_to_limit(video_path, max_size)
+        if not plan:
+            return None
+        output_path = video_path.rsplit('.', 1)[0] + '.fit.mp4'
+        try:
+            logger.info(f"Compressing {video_path} to {plan.video_bitrate // 1000} kbps")
+            if compress_to_limit(video_path, output_path, plan, max_size):
+                return output_path
+            logger.warning(f"Compressed file still exceeds {max_size} bytes")
+        except Exception as e:
+            logger.error(f"Error compressing to limit: {e}")
+            self.cleanup_file(output_path)
+        return None
+    
     def cleanup_file(self, file_path: str):
         try:
             if os.path.exists(file_path):
@@ -336,6 +399,7 @@ class YouTubeDownloader:
             logger.error(f"Error deleting file {file_path}: {e}")
 
 if __name__ == "__main__":
+    setup_logging(log_file=os.getenv('LOG_FILE', 'downloader.log'))
     downloader = YouTubeDownloader()
     
     url = input("Enter YouTube URL: ")
@@ -0,0 +1,65 @@
+from typing import List, Tuple
+
+# Контейнеры, разрешения которых показываем пользователю
+RESOLUTION_EXTS = ('mp4', 'webm')
+AUDIO_FORMAT = 'bestaudio[ext=m4a]/bestaudio/best'
+
+
+def available_resolutions(formats: List[dict], limit: int = 5) -> List[str]:
+    """Лучшие разрешения из форматов yt-dlp (по убыванию) плюс 'audio'"""
+    heights = {
+        f['height'] for f in formats
+        if f.get('height') and f.get('vcodec') != 'none' and f.get('ext') in RESOLUTION_EXTS
+    }
+    return [f"{height}p" for height in sorted(heights, reverse=True)[:limit]] + ['audio']
+
+
+def select_format(formats: List[dict], resolution: str) -> Tuple[str, str]:
+    """Строка формата yt-dlp для выбранного качества и ее описание для лога.
+
+    Предпочитает комбинированный формат не выше нужной высоты, затем пару
+    видео + лучшее аудио, иначе 'best'. Форматы разбираются за один проход.
+    """
+    if resolution == 'audio':
+        return AUDIO_FORMAT, "audio format: bestaudio"
+    if not resolution:
+        return 'best', "format: best"
+
+    target_height = int(resolution.replace("p", ""))
+    best_combined = lowest_combined = None
+    best_video = lowest_video = None
+    best_audio = None
+
+    for f in formats:
+        has_video = f.get('vcodec') != 'none'
+        has_audio = f.get('acodec') != 'none'
+        height = f.get('height')
+
+        if has_video and height:
+            if has_audio:
+                if height <= target_height and (best_combined is None or height > best_combined['height']):
+                    best_combined = f
+                if lowest_combined is None or height < lowest_combined['height']:
+                    lowest_combined = f
+            else:
+                if height <= target_height and (best_video is None or height > best_video['height']):
+                    best_video = f
+                if lowest_video is None or height < lowest_video['height']:
+                    lowest_video = f
+        elif has_audio and not has_video:
+            if best_audio is None or (f.get('abr', 0) or 0) > (best_audio.get('abr', 0) or 0):
+                best_audio = f
+
+    if lowest_combined:
+        if best_combined:
+            return best_combined['format_id'], (
+                f"combined format: {best_combined['format_id']} ({best_combined['height']}p)")
+        return lowest_combined['format_id'], (
+            f"lowest combined format: {lowest_combined['format_id']} ({lowest_combined['height']}p)")
+
+    video = best_video or lowest_video
+    if video and best_audio:
+        return f"{video['format_id']}+{best_audio['format_id']}", (
+            f"video+audio: {video['format_id']} ({video['height']}p) + {best_audio['format_id']}")
+
+    return 'best', "no suitable formats found, using 'best'"
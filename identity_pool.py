@@ -0,0 +1,136 @@
+import os
+import glob
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Optional, List, Callable
+
+from download_errors import DownloadError, ThrottledError, AuthError, TransientError
+
+logger = logging.getLogger(__name__)
+
+
+class Identity:
+    """Набор кук и исходящий адрес, от имени которых идут запросы к YouTube"""
+
+    def __init__(self, cookiefile: Optional[str] = None, source_address: Optional[str] = None):
+        self.cookiefile = cookiefile
+        self.source_address = source_address
+        self.inflight = 0
+        self.health = 1.0  # 1.0 - здоров, 0.0 - постоянно получает ограничения
+        self.latency = 0.0  # сглаженная длительность запроса, сек
+        self.consecutive_throttles = 0
+        self.quarantined_until = 0.0
+        self.successes = 0
+        self.failures = 0
+
+    @property
+    def name(self) -> str:
+        cookie = os.path.basename(self.cookiefile) if self.cookiefile else 'anonymous'
+        return f"{cookie}@{self.source_address}" if self.source_address else cookie
+
+    def apply(self, opts: dict) -> dict:
+        """Добавляет куки и исходящий адрес в параметры yt-dlp"""
+        if self.cookiefile:
+            opts['cookiefile'] = self.cookiefile
+        if self.source_address:
+            opts['source_address'] = self.source_address
+        return opts
+
+    def __repr__(self):
+        return (f"Identity({self.name}, health={self.health:.2f}, inflight={self.inflight}, "
+                f"latency={self.latency:.1f}s)")
+
+
+class IdentityPool:
+    """Раздает идентичности по загрузке и здоровью, больные отправляет в карантин"""
+
+    def __init__(self, identities: List[Identity], quarantine_time: float = 300,
+                 auth_quarantine_time: float = 3600, throttle_limit: int = 3,
+                 clock: Callable[[], float] = time.monotonic):
+        if not identities:
+            identities = [Identity()]
+        self.identities = identities
+        self.quarantine_time = quarantine_time
+        self.auth_quarantine_time = auth_quarantine_time
+        self.throttle_limit = throttle_limit
+        self.clock = clock
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_directory(cls, download_dir: str, source_addresses: Optional[List[str]] = None, **kwargs):
+        """Загружает youtube_cookies.txt и все файлы cookies/*.txt, по одной идентичности
+        на каждую пару (куки, исходящий адрес)"""
+        cookiefiles = []
+        legacy_path = os.path.join(download_dir, 'youtube_cookies.txt')
+        if os.path.exists(legacy_path):
+            cookiefiles.append(legacy_path)
+        cookiefiles.extend(sorted(glob.glob(os.path.join(download_dir, 'cookies', '*.txt'))))
+        if not cookiefiles:
+            logger.warning(f"No cookies files found in {download_dir}")
+            cookiefiles = [None]
+
+        addresses = source_addresses or [None]
+        identities = [Identity(cookiefile, address) for cookiefile in cookiefiles for address in addresses]
+        logger.info(f"Identity pool: {[identity.name for identity in identities]}")
+        return cls(identities, **kwargs)
+
+    def acquire(self) -> Identity:
+        """Выбирает наименее загруженную здоровую идентичность"""
+        with self._lock:
+            now = self.clock()
+            available = [i for i in self.identities if i.quarantined_until <= now]
+            if not available:
+                # Все в карантине - берем ту, что выйдет из него раньше
+                available = [min(self.identities, key=lambda i: i.quarantined_until)]
+            identity = min(available, key=self._score)
+            identity.inflight += 1
+            return identity
+
+    def release(self, identity: Identity, error: Optional[DownloadError] = None, latency: float = 0.0):
+        """Обновляет здоровье идентичности по результату запроса"""
+        with self._lock:
+            identity.inflight = max(0, identity.inflight - 1)
+            if error is None:
+                identity.successes += 1
+                identity.consecutive_throttles = 0
+                identity.health = min(1.0, identity.health + 0.1)
+                identity.latency = latency if not identity.latency else 0.8 * identity.latency + 0.2 * latency
+                return
+
+            if isinstance(error, AuthError):
+                identity.failures += 1
+                identity.health = 0.0
+                self._quarantine(identity, self.auth_quarantine_time, error)
+            elif isinstance(error, ThrottledError):
+                identity.failures += 1
+                identity.consecutive_throttles += 1
+                identity.health = max(0.0, identity.health - 0.3)
+                if identity.consecutive_throttles >= self.throttle_limit:
+                    self._quarantine(identity, self.quarantine_time, error)
+            elif isinstance(error, TransientError):
+                identity.failures += 1
+                identity.health = max(0.0, identity.health - 0.05)
+
+    @contextmanager
+    def use(self, classify: Callable[[BaseException], DownloadError]):
+        """Выдает идентичность на время запроса и учитывает результат"""
+        identity = self.acquire()
+        started = self.clock()
+        try:
+            yield identity
+        except Exception as e:
+            self.release(identity, classify(e), self.clock() - started)
+            raise
+        else:
+            self.release(identity, None, self.clock() - started)
+
+    def _score(self, identity: Identity) -> float:
+        # Меньше - лучше: загрузка, плохое здоровье и медленные ответы штрафуются
+        return identity.inflight + (1.0 - identity.health) * 5 + identity.latency / 10
+
+    def _quarantine(self, identity: Identity, duration: float, error: DownloadError):
+        identity.quarantined_until = self.clock() + duration
+        identity.consecutive_throttles = 0
+        logger.warning(f"Identity {identity.name} quarantined for {duration:.0f}s: {error}")
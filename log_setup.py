@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import queue
+import copy
+import atexit
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional, Dict
+
+# Контекст задачи: попадает в каждую запись, сделанную внутри log_context
+job_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('job_id', default=None)
+user_id_var: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar('user_id', default=None)
+
+# Логгеры с частыми однотипными сообщениями: доля записей ниже WARNING, которая сохраняется.
+# httpx пишет строку на каждый запрос, включая long polling и загрузку диапазонами
+DEFAULT_SAMPLING = {'httpx': 0.05, 'httpcore': 0.0}
+
+# Стандартные поля LogRecord, которые не надо дублировать в JSON
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_exception_formatter = logging.Formatter()
+
+_listener: Optional[QueueListener] = None
+_lock = threading.Lock()
+
+
+@contextmanager
+def log_context(job_id: Optional[str] = None, user_id: Optional[int] = None):
+    """Помечает записи внутри блока ID задачи и пользователя"""
+    tokens = []
+    if job_id is not None:
+        tokens.append((job_id_var, job_id_var.set(job_id)))
+    if user_id is not None:
+        tokens.append((user_id_var, user_id_var.set(user_id)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет job_id и user_id в запись в потоке, который ее создал"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.job_id = job_id_var.get()
+        record.user_id = user_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Оставляет каждую N-ю запись частых логгеров; WARNING и выше проходят всегда"""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _rate(self, name: str) -> Optional[float]:
+        # Правило для 'httpx' действует и на 'httpx._client'
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        if rate is None or rate >= 1:
+            return True
+        if rate <= 0:
+            return False
+        with self._lock:
+            count = self._counters.get(record.name, 0)
+            self._counters[record.name] = count + 1
+        return count % round(1 / rate) == 0
+
+
+class LogQueueHandler(QueueHandler):
+    """QueueHandler, который сохраняет трейсбек отдельным полем.
+
+    Стандартный prepare склеивает сообщение с трейсбеком и обнуляет exc_info, и
+    JsonFormatter слушателя уже не может вывести поле exc. Здесь в потоке источника
+    подставляются только аргументы сообщения, а трейсбек текстом уходит в exc_text.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = record.exc_text or _exception_formatter.formatException(record.exc_info)
+        # Аргументы и объект исключения могут не пережить передачу в другой поток или процесс
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'thread': record.threadName,
+        }
+        for key in ('job_id', 'user_id'):
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+        # Поля из extra={...}
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS and key not in data and key not in ('job_id', 'user_id'):
+                data[key] = value if isinstance(value, (str, int, float, bool, type(None))) else repr(value)
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """Привычный текстовый формат для консоли с ID задачи, если он есть"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        job_id = getattr(record, 'job_id', None)
+        return f"{text} [job {job_id}]" if job_id else text
+
+
+def _parse_sampling(value: str) -> Dict[str, float]:
+    """LOG_SAMPLING=httpx=0.05,downloader_pytubefix=0.5"""
+    rates = {}
+    for item in value.split(','):
+        name, _, rate = item.strip().partition('=')
+        if name and rate:
+            rates[name] = float(rate)
+    return rates
+
+
+def setup_logging(log_file: Optional[str] = None, level: Optional[str] = None,
+                  json_file: bool = True, max_bytes: Optional[int] = None, backup_count: int = 5,
+                  sampling: Optional[Dict[str, float]] = None, console: bool = True) -> QueueListener:
+    """Единая точка настройки логов для бота, загрузчиков и утилит.
+
+    Записи уходят в очередь; файл и консоль пишет отдельный поток QueueListener,
+    поэтому логирование не блокирует цикл событий и потоки загрузки. Повторный вызов
+    ничего не делает.
+    """
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return _listener
+
+        log_file = log_file or os.getenv('LOG_FILE', 'bot.log')
+        level = (level or os.getenv('LOG_LEVEL', 'INFO')).upper()
+        max_bytes = max_bytes or int(os.getenv('LOG_MAX_MB', '20')) * 1024 * 1024
+        rates = dict(DEFAULT_SAMPLING)
+        rates.update(sampling if sampling is not None else _parse_sampling(os.getenv('LOG_SAMPLING', '')))
+
+        handlers = []
+        if log_file:
+            directory = os.path.dirname(log_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            file_handler = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count,
+                                               encoding='utf-8')
+            file_handler.setFormatter(JsonFormatter() if json_file else TextFormatter())
+            handlers.append(file_handler)
+        if console:
+            console_handler = logging.StreamHandler(sys.stderr)
+            console_handler.setFormatter(TextFormatter())
+            handlers.append(console_handler)
+
+        # В потоке источника: контекст, выборка, подстановка аргументов и текст трейсбека;
+        # форматирование в JSON или текст и запись - в потоке слушателя
+        queue_handler = LogQueueHandler(queue.SimpleQueue())
+        queue_handler.addFilter(ContextFilter())
+        queue_handler.addFilter(SamplingFilter(rates))
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        root.setLevel(level)
+
+        _listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+        return _listener
+
+
+def shutdown_logging():
+    """Дописывает оставшиеся записи и останавливает поток слушателя"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
@@ -0,0 +1,111 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import deque
+from typing import Optional, Dict
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних замеров задержки хранится для перцентилей
+LAG_WINDOW = 3000
+
+
+def percentile(samples, fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class LoopWatchdog:
+    """Следит за задержкой цикла событий.
+
+    Задача на цикле просыпается каждые interval секунд и записывает, насколько позже
+    срока она получила управление - это задержка, которую видят все обработчики.
+    Отдельный поток проверяет, что цикл отвечает: если он занят одним колбэком дольше
+    threshold, в лог пишется стек потока цикла в этот момент - видно, что именно его держит.
+    """
+
+    def __init__(self, interval: float = 0.05, threshold: float = 0.1, report_interval: float = 300):
+        self.interval = interval
+        self.threshold = threshold
+        self.report_interval = report_interval
+        self.samples: deque = deque(maxlen=LAG_WINDOW)
+        self.stalls = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._heartbeat = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._measure())
+        self._thread = threading.Thread(target=self._monitor, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._thread:
+            await asyncio.to_thread(self._thread.join)
+        self.report()
+
+    def stats(self) -> Dict[str, float]:
+        """Перцентили задержки цикла в миллисекундах по последним замерам"""
+        samples = list(self.samples)
+        return {
+            'p50_ms': percentile(samples, 0.50) * 1000,
+            'p99_ms': percentile(samples, 0.99) * 1000,
+            'max_ms': max(samples, default=0.0) * 1000,
+            'samples': len(samples),
+            'stalls': self.stalls,
+        }
+
+    def report(self):
+        stats = self.stats()
+        logger.info(
+            f"Loop lag p50={stats['p50_ms']:.1f}ms p99={stats['p99_ms']:.1f}ms "
+            f"max={stats['max_ms']:.1f}ms stalls={stats['stalls']}",
+            extra=stats
+        )
+
+    async def _measure(self):
+        last_report = time.monotonic()
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            self.samples.append(max(0.0, now - expected))
+            if self.report_interval and now - last_report >= self.report_interval:
+                last_report = now
+                self.report()
+
+    def _monitor(self):
+        reported_at = None
+        while not self._stop.wait(self.threshold / 2):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked < self.threshold:
+                continue
+            if reported_at == heartbeat:
+                # Об этой остановке уже сообщили
+                continue
+            reported_at = heartbeat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame else '<no frame>'
+            logger.warning(f"Event loop blocked for {blocked * 1000:.0f}ms, loop thread stack:\n{stack}")
@@ -0,0 +1,276 @@
+import os
+import re
+import time
+import hmac
+import shutil
+import asyncio
+import hashlib
+import logging
+import secrets
+import mimetypes
+from typing import Optional, Dict, Tuple
+from urllib.parse import quote, unquote
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Заголовки ответа источника, которые передаем клиенту как есть
+PROXY_RESPONSE_HEADERS = ('content-type', 'content-length', 'content-range', 'accept-ranges', 'last-modified')
+MAX_REQUEST_HEAD = 16 * 1024
+
+REASONS = {200: 'OK', 206: 'Partial Content', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+           405: 'Method Not Allowed', 410: 'Gone', 416: 'Range Not Satisfiable', 502: 'Bad Gateway',
+           503: 'Service Unavailable'}
+
+# Имя опубликованного файла: срок действия, случайный токен и расширение
+FILE_NAME_PATTERN = re.compile(r'^(\d+)-[A-Za-z0-9_-]+(\.[A-Za-z0-9]+)?$')
+
+
+def parse_range(value: str, size: int) -> Optional[Tuple[int, int]]:
+    """Границы (включительно) из заголовка Range.
+
+    None - заголовок не разобран или диапазонов несколько: отдаем файл целиком.
+    ValueError - диапазон за пределами файла (ответ 416).
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not first:
+            # bytes=-N - последние N байт
+            length = int(last)
+            if length <= 0:
+                raise ValueError(value)
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        if first.isdigit() or last.isdigit():
+            raise
+        return None
+    if start >= size or end < start:
+        raise ValueError(value)
+    return start, min(end, size - 1)
+
+
+def content_disposition(filename: str) -> str:
+    ascii_name = filename.encode('ascii', 'ignore').decode().replace('"', '').strip() or 'file'
+    return f"inline; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
+
+class ProxyEntry:
+    """Короткоживущая ссылка на поток источника"""
+
+    def __init__(self, url: str, headers: Dict[str, str], expires_at: float):
+        self.url = url
+        self.headers = headers
+        self.expires_at = expires_at
+
+
+class MediaServer:
+    """Легкий HTTP-сервер на asyncio, через который Telegram забирает медиа по ссылке.
+
+    Ссылки на потоки YouTube привязаны к IP, с которого их получили, поэтому Telegram
+    не может скачать их напрямую. Прокси передает байты источника без записи на диск,
+    включая запросы Range.
+
+    Если задан files_dir, сервер раздает и готовые файлы больше лимита Telegram по
+    подписанным ссылкам с ограниченным сроком: одна ссылка с перемоткой дешевле нарезки
+    и загрузки в Telegram. Файлы отдаются через sendfile и удаляются, когда срок истек.
+    """
+
+    def __init__(self, public_url: str, host: str = '0.0.0.0', port: int = 8080,
+                 max_connections: int = 32, proxy_ttl: float = 600,
+                 files_dir: Optional[str] = None, file_ttl: float = 24 * 3600, secret: Optional[str] = None):
+        self.public_url = public_url.rstrip('/')
+        self.host = host
+        self.port = port
+        self.proxy_ttl = proxy_ttl
+        self.files_dir = files_dir
+        self.file_ttl = file_ttl
+        # Без постоянного ключа ссылки перестают открываться после перезапуска
+        self._secret = (secret or secrets.token_hex(32)).encode()
+        if files_dir:
+            os.makedirs(files_dir, exist_ok=True)
+        self._connections = asyncio.Semaphore(max_connections)
+        self._proxies: Dict[str, ProxyEntry] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._cleanup_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._client = httpx.AsyncClient(follow_redirects=True, timeout=httpx.Timeout(30, read=120))
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=MAX_REQUEST_HEAD)
+        self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+        logger.info(f"Media server listening on {self.host}:{self.port} ({self.public_url})")
+
+    async def stop(self):
+        if self._cleanup_task:
+            self._cleanup_task.cancel()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._client:
+            await self._client.aclose()
+
+    def register_proxy(self, url: str, headers: Optional[Dict[str, str]] = None,
+                       ttl: Optional[float] = None) -> str:
+        """Публичная ссылка, по которой сервер отдаст поток источника"""
+        token = secrets.token_urlsafe(24)
+        self._proxies[token] = ProxyEntry(url, dict(headers or {}), time.time() + (ttl or self.proxy_ttl))
+        return f"{self.public_url}/proxy/{token}"
+
+    def publish_file(self, path: str, filename: str, ttl: Optional[float] = None) -> Tuple[str, float]:
+        """Переносит готовый файл в раздачу; возвращает подписанную ссылку и время ее истечения.
+
+        Файл переходит во владение сервера и удаляется после истечения срока.
+        """
+        expires_at = int(time.time() + (ttl or self.file_ttl))
+        name = f"{expires_at}-{secrets.token_urlsafe(12)}{os.path.splitext(path)[1]}"
+        shutil.move(path, os.path.join(self.files_dir, name))
+        return f"{self.public_url}/files/{name}/{quote(filename, safe='')}?sig={self._sign(name)}", expires_at
+
+    def _sign(self, name: str) -> str:
+        return hmac.new(self._secret, name.encode(), hashlib.sha256).hexdigest()[:32]
+
+    def _remove_expired_files(self, now: float):
+        for name in os.listdir(self.files_dir):
+            match = FILE_NAME_PATTERN.match(name)
+            if match and int(match.group(1)) <= now:
+                try:
+                    os.remove(os.path.join(self.files_dir, name))
+                except OSError as e:
+                    logger.error(f"Error deleting expired file {name}: {e}")
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(60)
+            now = time.time()
+            for token in [t for t, entry in self._proxies.items() if entry.expires_at <= now]:
+                del self._proxies[token]
+            if self.files_dir:
+                try:
+                    await asyncio.to_thread(self._remove_expired_files, now)
+                except OSError as e:
+                    logger.error(f"Expired files cleanup error: {e}")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if self._connections.locked():
+            await self._send_status(writer, 503)
+            writer.close()
+            return
+        async with self._connections:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+                method, target, headers = self._parse_head(head)
+                await self._dispatch(writer, method, target, headers)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+                await self._send_status(writer, 400)
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+            except Exception as e:
+                logger.error(f"Media server error: {e}")
+            finally:
+                writer.close()
+
+    @staticmethod
+    def _parse_head(head: bytes):
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, _ = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        return method.upper(), target, headers
+
+    async def _dispatch(self, writer: asyncio.StreamWriter, method: str, target: str, headers: Dict[str, str]):
+        if method not in ('GET', 'HEAD'):
+            await self._send_status(writer, 405)
+            return
+        path = target.split('?', 1)[0]
+        if path.startswith('/proxy/'):
+            entry = self._proxies.get(path[len('/proxy/'):])
+            if not entry or entry.expires_at <= time.time():
+                await self._send_status(writer, 404)
+                return
+            await self._serve_proxy(writer, method, headers, entry)
+            return
+        if path.startswith('/files/') and self.files_dir:
+            name, _, filename = path[len('/files/'):].partition('/')
+            await self._serve_file(writer, method, headers, name, unquote(filename) or name,
+                                   target.partition('?sig=')[2].split('&', 1)[0])
+            return
+        await self._send_status(writer, 404)
+
+    async def _serve_file(self, writer: asyncio.StreamWriter, method: str, headers: Dict[str, str],
+                          name: str, filename: str, signature: str):
+        match = FILE_NAME_PATTERN.match(name)
+        if not match or not hmac.compare_digest(signature, self._sign(name)):
+            await self._send_status(writer, 403)
+            return
+        if int(match.group(1)) <= time.time():
+            await self._send_status(writer, 410)
+            return
+        try:
+            file = await asyncio.to_thread(open, os.path.join(self.files_dir, name), 'rb')
+        except OSError:
+            await self._send_status(writer, 404)
+            return
+        with file:
+            stat = os.fstat(file.fileno())
+            size = stat.st_size
+            response_headers = {
+                'content-type': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+                'accept-ranges': 'bytes',
+                'last-modified': time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(stat.st_mtime)),
+                'content-disposition': content_disposition(filename),
+            }
+            try:
+                byte_range = parse_range(headers['range'], size) if 'range' in headers else None
+            except ValueError:
+                await self._send_head(writer, 416, {'content-range': f"bytes */{size}", 'content-length': '0'})
+                return
+            status, (start, end) = (206, byte_range) if byte_range else (200, (0, size - 1))
+            if status == 206:
+                response_headers['content-range'] = f"bytes {start}-{end}/{size}"
+            response_headers['content-length'] = str(end - start + 1)
+            await self._send_head(writer, status, response_headers)
+            if method == 'GET' and size:
+                # Ядро копирует байты из файла в сокет без буферов Python
+                await asyncio.get_running_loop().sendfile(writer.transport, file, start, end - start + 1)
+
+    async def _serve_proxy(self, writer: asyncio.StreamWriter, method: str, headers: Dict[str, str],
+                           entry: ProxyEntry):
+        upstream_headers = dict(entry.headers)
+        if 'range' in headers:
+            upstream_headers['Range'] = headers['range']
+        try:
+            async with self._client.stream(method, entry.url, headers=upstream_headers) as response:
+                response_headers = {name: response.headers[name]
+                                    for name in PROXY_RESPONSE_HEADERS if name in response.headers}
+                await self._send_head(writer, response.status_code, response_headers)
+                if method == 'GET':
+                    async for chunk in response.aiter_raw():
+                        writer.write(chunk)
+                        await writer.drain()
+        except httpx.HTTPError as e:
+            logger.warning(f"Proxy upstream error: {e}")
+            await self._send_status(writer, 502)
+
+    async def _send_head(self, writer: asyncio.StreamWriter, status: int, headers: Dict[str, str]):
+        lines = [f"HTTP/1.1 {status} {REASONS.get(status, 'OK')}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        lines.append("connection: close")
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+    async def _send_status(self, writer: asyncio.StreamWriter, status: int):
+        try:
+            await self._send_head(writer, status, {'content-length': '0'})
+        except ConnectionError:
+            pass
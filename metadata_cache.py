@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from contextlib import closing
+from urllib.parse import urlparse, parse_qs
+from typing import Optional, Tuple, Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = './downloads/metadata.sqlite3'
+
+# Подписанные ссылки считаем просроченными немного раньше срока из параметра expire
+STREAM_URL_MARGIN = 300
+
+
+def stream_urls_expire_at(urls: Iterable[str]) -> Optional[float]:
+    """Минимальный срок действия из параметра expire подписанных ссылок googlevideo"""
+    expires = []
+    for url in urls:
+        try:
+            value = parse_qs(urlparse(url).query).get('expire')
+            if not value and '/expire/' in url:
+                # Ссылки манифестов передают параметры в пути: .../expire/1700000000/...
+                parts = url.split('/')
+                value = [parts[parts.index('expire') + 1]]
+            if value:
+                expires.append(float(value[0]))
+        except (ValueError, IndexError):
+            continue
+    return min(expires) if expires else None
+
+
+class MetadataCache:
+    """Кэш метаданных видео в SQLite с двумя уровнями.
+
+    Стабильные поля (название, длительность, разрешения, размеры) живут долго и отдаются
+    даже устаревшими, пока идет фоновое обновление. Подписанные ссылки на потоки живут
+    до срока из их параметра expire.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = 5000,
+                 fresh_ttl: float = 6 * 3600, max_age: float = 7 * 24 * 3600,
+                 clock: Callable[[], float] = time.time):
+        # Путь читается здесь, а не при импорте: к этому моменту load_dotenv уже отработал
+        path = path or os.getenv('METADATA_CACHE_PATH', DEFAULT_CACHE_PATH)
+        self.path = path
+        self.max_entries = max_entries
+        self.fresh_ttl = fresh_ttl
+        self.max_age = max_age
+        self.clock = clock
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS video_meta ("
+                "video_id TEXT, backend TEXT, data TEXT, fetched_at REAL, accessed_at REAL, "
+                "PRIMARY KEY (video_id, backend))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS stream_urls ("
+                "video_id TEXT, backend TEXT, data TEXT, expires_at REAL, "
+                "PRIMARY KEY (video_id, backend))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS video_meta_lru ON video_meta (accessed_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # Отдельное соединение на вызов: кэш используют разные потоки и процессы
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, video_id: str, backend: str) -> Optional[Tuple[dict, bool]]:
+        """Возвращает (стабильные данные, устарели ли они) или None"""
+        now = self.clock()
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT data, fetched_at FROM video_meta WHERE video_id = ? AND backend = ?",
+                (video_id, backend)
+            ).fetchone()
+            if not row:
+                return None
+            data, fetched_at = row
+            if now - fetched_at > self.max_age:
+                conn.execute("DELETE FROM video_meta WHERE video_id = ? AND backend = ?", (video_id, backend))
+                return None
+            conn.execute(
+                "UPDATE video_meta SET accessed_at = ? WHERE video_id = ? AND backend = ?",
+                (now, video_id, backend)
+            )
+        return json.loads(data), now - fetched_at > self.fresh_ttl
+
+    def get_streams(self, video_id: str, backend: str) -> Optional[dict]:
+        """Данные с подписанными ссылками, если они еще не истекли"""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT data, expires_at FROM stream_urls WHERE video_id = ? AND backend = ?",
+                (video_id, backend)
+            ).fetchone()
+        if not row or row[1] - STREAM_URL_MARGIN <= self.clock():
+            return None
+        return json.loads(row[0])
+
+    def put(self, video_id: str, backend: str, stable: dict,
+            streams: Optional[dict] = None, stream_urls: Iterable[str] = ()):
+        now = self.clock()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO video_meta (video_id, backend, data, fetched_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (video_id, backend, json.dumps(stable), now, now)
+            )
+            if streams is not None:
+                self._write_streams(conn, video_id, backend, streams, stream_urls)
+            self._evict(conn)
+
+    def put_streams(self, video_id: str, backend: str, streams: dict, stream_urls: Iterable[str]):
+        """Обновляет только уровень ссылок: потоки извлечены заново, а стабильные поля не менялись"""
+        with closing(self._connect()) as conn, conn:
+            self._write_streams(conn, video_id, backend, streams, stream_urls)
+
+    @staticmethod
+    def _write_streams(conn: sqlite3.Connection, video_id: str, backend: str, streams: dict,
+                       stream_urls: Iterable[str]):
+        expires_at = stream_urls_expire_at(stream_urls)
+        if expires_at:
+            conn.execute(
+                "INSERT OR REPLACE INTO stream_urls (video_id, backend, data, expires_at) VALUES (?, ?, ?, ?)",
+                (video_id, backend, json.dumps(streams), expires_at)
+            )
+
+    def _evict(self, conn: sqlite3.Connection):
+        # LRU: удаляем записи, к которым дольше всего не обращались
+        count = conn.execute("SELECT COUNT(*) FROM video_meta").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        conn.execute(
+            "DELETE FROM video_meta WHERE rowid IN "
+            "(SELECT rowid FROM video_meta ORDER BY accessed_at LIMIT ?)",
+            (count - self.max_entries,)
+        )
+        conn.execute(
+            "DELETE FROM stream_urls WHERE expires_at < ? OR NOT EXISTS "
+            "(SELECT 1 FROM video_meta m WHERE m.video_id = stream_urls.video_id "
+            "AND m.backend = stream_urls.backend)",
+            (self.clock(),)
+        )
+
+    def refresh_in_background(self, video_id: str, backend: str, refresh: Callable[[], None]):
+        """Запускает обновление устаревшей записи, не более одного на видео"""
+        key = (video_id, backend)
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                refresh()
+            except Exception as e:
+                logger.error(f"Background metadata refresh failed for {video_id}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, name=f"meta-refresh-{video_id}", daemon=True).start()
@@ -0,0 +1,123 @@
+import os
+import random
+import asyncio
+import logging
+from typing import List, Optional, Callable, Awaitable, Dict
+
+from telegram import InputMediaDocument
+
+from bandwidth import pace_upload
+from async_download import read_file
+
+logger = logging.getLogger(__name__)
+
+# Telegram принимает не больше 10 файлов в одном альбоме
+MEDIA_GROUP_SIZE = 10
+
+
+class MultipartUploader:
+    """Параллельная отправка частей большого файла с повтором только неудачных частей"""
+
+    def __init__(self, bot, concurrency: int = 4, max_attempts: int = 3, retry_delay: float = 5,
+                 album: bool = True, timeout: float = 600):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.album = album
+        self.timeout = timeout
+
+    async def deliver(self, chat_id: int, part_paths: List[str], title: str,
+                      progress: Optional[Callable[[int, int, int, int], Awaitable[None]]] = None) -> List[int]:
+        """Отправляет части и возвращает номера частей, которые отправить не удалось"""
+        total_parts = len(part_paths)
+        sizes = await asyncio.to_thread(lambda: [os.path.getsize(path) for path in part_paths])
+        total_bytes = sum(sizes)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        messages: Dict[int, object] = {}
+        done = {'parts': 0, 'bytes': 0}
+
+        async def upload(index: int, path: str):
+            async with semaphore:
+                message = await self._send_part(chat_id, path, index, total_parts, title)
+            if message is None:
+                return
+            messages[index] = message
+            done['parts'] += 1
+            done['bytes'] += sizes[index - 1]
+            if progress:
+                try:
+                    await progress(done['parts'], total_parts, done['bytes'], total_bytes)
+                except Exception as e:
+                    logger.error(f"Multipart progress error: {e}")
+
+        await asyncio.gather(*(upload(i, path) for i, path in enumerate(part_paths, 1)))
+
+        failed = [i for i in range(1, total_parts + 1) if i not in messages]
+        if not failed and self.album and total_parts > 1:
+            await self._reorder_as_albums(chat_id, messages, title)
+        return failed
+
+    async def _send_part(self, chat_id: int, path: str, index: int, total: int, title: str):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                content = await read_file(path)
+                await pace_upload(len(content))
+                message = await self.bot.send_document(
+                    chat_id=chat_id,
+                    document=content,
+                    filename=os.path.basename(path),
+                    caption=f"📹 {title} (часть {index}/{total})",
+                    disable_notification=self.album,
+                    read_timeout=self.timeout,
+                    write_timeout=self.timeout,
+                    connect_timeout=120,
+                    pool_timeout=120
+                )
+                logger.info(f"Part {index}/{total} sent on attempt {attempt}")
+                return message
+            except Exception as e:
+                logger.error(f"Part {index}/{total} send attempt {attempt} failed: {e}")
+                if attempt < self.max_attempts:
+                    await asyncio.sleep(self.retry_delay * attempt + random.uniform(0, 1))
+        return None
+
+    async def _reorder_as_albums(self, chat_id: int, messages: Dict[int, object], title: str):
+        """Пересылает уже загруженные части альбомами по порядку и удаляет разрозненные сообщения"""
+        indexes = sorted(messages)
+        sent = []
+        try:
+            for start in range(0, len(indexes), MEDIA_GROUP_SIZE):
+                group = indexes[start:start + MEDIA_GROUP_SIZE]
+                if len(group) == 1:
+                    # Альбом должен содержать минимум 2 файла
+                    sent.append(await self.bot.send_document(
+                        chat_id=chat_id,
+                        document=messages[group[0]].document.file_id,
+                        caption=f"📹 {title} (часть {group[0]}/{len(indexes)})"
+                    ))
+                    continue
+                media = [
+                    InputMediaDocument(
+                        media=messages[i].document.file_id,
+                        caption=f"📹 {title} (часть {i}/{len(indexes)})"
+                    )
+                    for i in group
+                ]
+                sent.extend(await self.bot.send_media_group(chat_id=chat_id, media=media))
+        except Exception as e:
+            # Части уже в чате с номерами в подписях, порядок можно восстановить по ним.
+            # Отправленные альбомы убираем, чтобы части не повторялись
+            logger.error(f"Error sending parts as albums: {e}")
+            await self._delete_messages(sent)
+            return
+
+        await self._delete_messages([messages[i] for i in indexes])
+
+    @staticmethod
+    async def _delete_messages(messages: List[object]):
+        for message in messages:
+            try:
+                await message.delete()
+            except Exception as e:
+                logger.error(f"Error deleting part message {message.message_id}: {e}")
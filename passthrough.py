@@ -0,0 +1,89 @@
+import time
+import logging
+from urllib.parse import urlparse, parse_qs
+from typing import Optional, Dict
+
+import httpx
+
+from metadata_cache import stream_urls_expire_at, STREAM_URL_MARGIN
+
+logger = logging.getLogger(__name__)
+
+# Telegram скачивает файлы по ссылке только до 20 MB
+TELEGRAM_URL_LIMIT = 20 * 1024 * 1024
+
+# Форматы, которые Telegram принимает по ссылке в send_video / send_audio
+PASSTHROUGH_MIME_TYPES = {'video': ('video/mp4',), 'audio': ('audio/mp4', 'audio/mpeg')}
+
+
+class DirectStream:
+    """Готовый к отправке поток: прямая ссылка и все, что нужно для решения о passthrough"""
+
+    def __init__(self, url: str, size: int, mime_type: str, kind: str, filename: str, title: str,
+                 headers: Optional[Dict[str, str]] = None):
+        self.url = url
+        self.size = size
+        self.mime_type = mime_type
+        self.kind = kind  # video / audio
+        self.filename = filename
+        self.title = title
+        self.headers = headers or {}
+
+
+def is_ip_bound(url: str) -> bool:
+    """Подписанная ссылка googlevideo действует только для IP, который ее получил"""
+    query = parse_qs(urlparse(url).query)
+    signed_params = query.get('sparams', [''])[0].split(',')
+    return 'ip' in query or 'ip' in signed_params
+
+
+class PassthroughPlanner:
+    """Решает, можно ли отдать Telegram ссылку на поток вместо скачивания и загрузки.
+
+    Годятся небольшие поддерживаемые потоки с живой ссылкой. Если ссылка привязана
+    к нашему IP, Telegram получит короткоживущую ссылку через прокси media_server.
+    """
+
+    def __init__(self, media_server=None, max_bytes: int = TELEGRAM_URL_LIMIT, check_timeout: float = 5):
+        self.media_server = media_server
+        self.max_bytes = min(max_bytes, TELEGRAM_URL_LIMIT)
+        self.check_timeout = check_timeout
+
+    async def delivery_url(self, stream: DirectStream) -> Optional[str]:
+        """Ссылка для send_video / send_audio или None, если нужен обычный путь"""
+        if not stream.size or stream.size > self.max_bytes:
+            return None
+        if stream.mime_type not in PASSTHROUGH_MIME_TYPES.get(stream.kind, ()):
+            return None
+
+        expires_at = stream_urls_expire_at([stream.url])
+        if expires_at and expires_at - STREAM_URL_MARGIN <= time.time():
+            logger.info("Passthrough skipped: stream URL is about to expire")
+            return None
+
+        bound = is_ip_bound(stream.url)
+        if bound and not self.media_server:
+            return None
+        if not await self._reachable(stream):
+            return None
+
+        if bound:
+            ttl = (expires_at - time.time()) if expires_at else None
+            return self.media_server.register_proxy(stream.url, stream.headers, ttl=ttl)
+        return stream.url
+
+    async def _reachable(self, stream: DirectStream) -> bool:
+        # Первый байт вместо HEAD: googlevideo не всегда отвечает на HEAD
+        headers = dict(stream.headers, Range='bytes=0-0')
+        try:
+            async with httpx.AsyncClient(follow_redirects=True, timeout=self.check_timeout) as client:
+                # Тело не читаем: источник может проигнорировать Range и отдать весь файл
+                async with client.stream('GET', stream.url, headers=headers) as response:
+                    status = response.status_code
+        except httpx.HTTPError as e:
+            logger.info(f"Passthrough skipped: stream unreachable ({e})")
+            return False
+        if status not in (200, 206):
+            logger.info(f"Passthrough skipped: stream returned HTTP {status}")
+            return False
+        return True
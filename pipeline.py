@@ -0,0 +1,236 @@
+import time
+import contextvars
+import asyncio
+import logging
+from typing import Optional, List, Dict, Callable, Awaitable, Any
+
+logger = logging.getLogger(__name__)
+
+# Обработчик стадии возвращает DONE, если задача завершена раньше последней стадии
+DONE = object()
+
+
+class JobCancelled(Exception):
+    """Задачу отменили до завершения"""
+
+
+class Stage:
+    """Стадия конвейера: обработчик и сколько задач он обрабатывает одновременно.
+
+    Перед стадией стоит очередь на queue_size задач; когда она заполнена, предыдущая
+    стадия ждет - так медленная стадия сдерживает быстрые, а не копит задачи в памяти.
+    """
+
+    def __init__(self, name: str, handler: Callable[['Job'], Awaitable[Any]], workers: int = 1,
+                 queue_size: Optional[int] = None):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue_size = queue_size or self.workers * 2
+        self.queue: Optional[asyncio.Queue] = None
+        self.busy = 0
+        self.jobs = 0
+        self.failed = 0
+        self.run_time = 0.0
+        self.wait_time = 0.0
+        self.max_run_time = 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'workers': self.workers,
+            'busy': self.busy,
+            'queued': self.queue.qsize() if self.queue else 0,
+            'jobs': self.jobs,
+            'failed': self.failed,
+            'avg_run_s': self.run_time / self.jobs if self.jobs else 0.0,
+            'avg_wait_s': self.wait_time / self.jobs if self.jobs else 0.0,
+            'max_run_s': self.max_run_time,
+        }
+
+
+class Job:
+    """Задача конвейера: данные payload, которые стадии читают и дополняют, и ее результат"""
+
+    def __init__(self, pipeline: 'Pipeline', payload: Any, name: str = ''):
+        self.pipeline = pipeline
+        self.payload = payload
+        self.name = name
+        self.timings: List[tuple] = []  # (стадия, ожидание в очереди, работа) в секундах
+        self.created_at = time.monotonic()
+        self._enqueued_at = self.created_at
+        self._future: asyncio.Future = asyncio.get_running_loop().create_future()
+        # Результат отмененной задачи может никто не прочитать - не шумим об этом в логе
+        self._future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self._task: Optional[asyncio.Task] = None
+        self._cancel_requested = False
+        self._cleanups: List[Callable[[], Any]] = []
+        self._context = contextvars.copy_context()
+
+    def add_cleanup(self, callback: Callable[[], Any]):
+        """Освобождение ресурса (файла, буфера) после завершения задачи при любом исходе"""
+        self._cleanups.append(callback)
+
+    def cancel(self):
+        """Отменяет задачу: в очереди она будет пропущена, на стадии - прервана"""
+        if self._future.done():
+            return
+        self._cancel_requested = True
+        if self._task:
+            self._task.cancel()
+        else:
+            # Ждет в очереди: завершаем сразу, обработчик стадии ее пропустит
+            self.pipeline._spawn(self.pipeline._finish(self, error=JobCancelled()))
+
+    @property
+    def done(self) -> bool:
+        return self._future.done()
+
+    async def wait(self):
+        """Результат последней стадии; исключение стадии или JobCancelled"""
+        return await asyncio.shield(self._future)
+
+
+class Pipeline:
+    """Конвейер из стадий, связанных ограниченными очередями.
+
+    У каждой стадии свой пул обработчиков, поэтому сетевые, дисковые и вычислительные
+    шаги разных задач идут одновременно: пока одна задача загружается в Telegram,
+    следующая уже конвертируется, а третья качается. Обработчик получает Job и возвращает
+    None (дальше по порядку), DONE (задача готова) или имя стадии, куда перейти.
+    """
+
+    def __init__(self, stages: List[Stage], name: str = 'pipeline'):
+        self.name = name
+        self.stages = stages
+        self._by_name = {stage.name: index for index, stage in enumerate(stages)}
+        self._workers: List[asyncio.Task] = []
+        self._active: set = set()
+        # Фоновые задачи (перестановка в очередь, завершение отмененных): цикл событий
+        # держит на задачи только слабые ссылки, без этого набора их мог бы собрать GC
+        self._background: set = set()
+
+    async def start(self):
+        for index, stage in enumerate(self.stages):
+            stage.queue = asyncio.Queue(maxsize=stage.queue_size)
+            self._workers += [asyncio.create_task(self._worker(index), name=f"{self.name}:{stage.name}:{n}")
+                              for n in range(stage.workers)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        for task in list(self._background):
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._background, return_exceptions=True)
+        self._workers = []
+        for job in list(self._active):
+            await self._finish(job, error=JobCancelled())
+
+    async def submit(self, payload: Any, name: str = '') -> Job:
+        """Ставит задачу в очередь первой стадии; ждет, если очередь заполнена"""
+        job = Job(self, payload, name)
+        self._active.add(job)
+        await self._enqueue(job, 0)
+        return job
+
+    async def run(self, payload: Any, name: str = ''):
+        """submit и ожидание результата; отмена вызывающего отменяет и задачу"""
+        job = await self.submit(payload, name)
+        try:
+            return await job.wait()
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    async def _enqueue(self, job: Job, index: int):
+        job._enqueued_at = time.monotonic()
+        await self.stages[index].queue.put(job)
+
+    async def _worker(self, index: int):
+        stage = self.stages[index]
+        while True:
+            job = await stage.queue.get()
+            if job.done:
+                continue
+
+            started = time.monotonic()
+            waited = started - job._enqueued_at
+            stage.busy += 1
+            # Обработчик работает в контексте того, кто поставил задачу (job_id в логах и т.п.)
+            job._task = job._context.run(asyncio.create_task, stage.handler(job))
+            error = None
+            try:
+                route = await job._task
+            except asyncio.CancelledError:
+                if not job._cancel_requested:
+                    # Останавливают сам конвейер
+                    job._task.cancel()
+                    raise
+                error = JobCancelled()
+            except Exception as e:
+                error = e
+            finally:
+                job._task = None
+                stage.busy -= 1
+                elapsed = time.monotonic() - started
+                job.timings.append((stage.name, waited, elapsed))
+                stage.jobs += 1
+                stage.wait_time += waited
+                stage.run_time += elapsed
+                stage.max_run_time = max(stage.max_run_time, elapsed)
+
+            if error is not None:
+                if not isinstance(error, JobCancelled):
+                    stage.failed += 1
+                await self._finish(job, error=error)
+                continue
+            try:
+                await self._route(job, index, route)
+            except Exception as e:
+                # Неизвестная стадия в ответе обработчика не должна останавливать обработчик стадии
+                await self._finish(job, error=e)
+
+    async def _route(self, job: Job, index: int, route):
+        if route is DONE or (route is None and index == len(self.stages) - 1):
+            await self._finish(job, result=job.payload)
+            return
+        target = index + 1 if route is None else self._by_name[route]
+        if target <= index:
+            # Возврат на более раннюю стадию не должен занимать обработчик этой: если
+            # очереди по кругу заполнены, стадии ждали бы друг друга бесконечно
+            self._spawn(self._enqueue(job, target))
+            return
+        await self._enqueue(job, target)
+
+    async def _finish(self, job: Job, result=None, error: Optional[BaseException] = None):
+        if job.done:
+            return
+        self._active.discard(job)
+        for callback in reversed(job._cleanups):
+            try:
+                outcome = callback()
+                if asyncio.iscoroutine(outcome):
+                    await outcome
+            except Exception as e:
+                logger.error(f"Job cleanup error: {e}")
+        job._cleanups.clear()
+
+        total = time.monotonic() - job.created_at
+        stages = ', '.join(f"{name} {run:.1f}s" + (f" (+{wait:.1f}s queued)" if wait >= 0.1 else '')
+                           for name, wait, run in job.timings)
+        outcome = 'cancelled' if isinstance(error, JobCancelled) else ('failed' if error else 'done')
+        logger.info(f"{self.name} job {job.name} {outcome} in {total:.1f}s: {stages}",
+                    extra={'pipeline_total_s': round(total, 3)})
+
+        if error is not None:
+            job._future.set_exception(error)
+        else:
+            job._future.set_result(result)
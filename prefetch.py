@@ -0,0 +1,214 @@
+import os
+import uuid
+import shutil
+import asyncio
+import logging
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, Tuple, List, Dict, Callable, Set
+
+from download_errors import DownloadCancelled
+from bandwidth import bandwidth_weight
+
+logger = logging.getLogger(__name__)
+
+# Максимальный размер файла, который бот отправляет одним куском
+UPLOAD_LIMIT = 50 * 1024 * 1024
+# Доля полосы спекулятивной загрузки относительно запрошенной пользователем
+PREFETCH_BANDWIDTH_WEIGHT = 0.25
+
+
+class PrefetchCancelled(DownloadCancelled):
+    """Спекулятивная загрузка отменена"""
+
+
+class ChoiceStats:
+    """История выбора качества: по пользователю и общая"""
+
+    def __init__(self, history_size: int = 20):
+        self.history_size = history_size
+        self._user_history: Dict[int, deque] = {}
+        self._global = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, user_id: int, choice: str):
+        with self._lock:
+            history = self._user_history.setdefault(user_id, deque(maxlen=self.history_size))
+            history.append(choice)
+            self._global[choice] += 1
+
+    def predict(self, user_id: int, resolutions: List[str],
+                size_of: Callable[[str], Optional[int]], limit: int = UPLOAD_LIMIT) -> Optional[str]:
+        """Самый вероятный выбор: привычка пользователя, затем общая статистика,
+        затем максимальное качество, которое влезает в лимит отправки"""
+        with self._lock:
+            user_counts = Counter(self._user_history.get(user_id, ()))
+            global_counts = Counter(self._global)
+
+        for counts in (user_counts, global_counts):
+            for choice, _ in counts.most_common():
+                if choice in resolutions:
+                    return choice
+
+        for resolution in resolutions:
+            if resolution == 'audio':
+                continue
+            size = size_of(resolution)
+            if size and size <= limit:
+                return resolution
+        return 'audio' if 'audio' in resolutions else None
+
+
+class PrefetchJob:
+    """Спекулятивная загрузка одного формата"""
+
+    def __init__(self, url: str, resolution: str, work_dir: str, expected_size: int):
+        self.url = url
+        self.resolution = resolution
+        self.work_dir = work_dir
+        self.expected_size = expected_size
+        self.future = Future()
+        self.cancel_event = threading.Event()
+        self.claimed = False
+        self._progress_callback = None
+
+    def progress(self, stream, chunk, bytes_remaining):
+        # Исключение из колбэка прерывает загрузку pytubefix
+        if self.cancel_event.is_set():
+            raise PrefetchCancelled(self.url)
+        if self._progress_callback:
+            self._progress_callback(stream, chunk, bytes_remaining)
+
+    def set_stage(self, stage: str, total: int = 0):
+        if hasattr(self._progress_callback, 'set_stage'):
+            self._progress_callback.set_stage(stage, total)
+
+    def attach(self, progress_callback):
+        """Подключает прогресс бота к уже идущей загрузке"""
+        self._progress_callback = progress_callback
+
+    async def wait(self, download_dir: str) -> Optional[Tuple[str, str]]:
+        """Ждет окончания загрузки и переносит файл в общую папку загрузок"""
+        try:
+            result = await asyncio.wrap_future(self.future)
+        except Exception as e:
+            logger.error(f"Prefetch failed: {e}")
+            result = None
+
+        if result:
+            file_path, title = result
+            target_path = os.path.join(download_dir, os.path.basename(file_path))
+            await asyncio.to_thread(os.replace, file_path, target_path)
+            result = target_path, title
+        await asyncio.to_thread(shutil.rmtree, self.work_dir, ignore_errors=True)
+        return result
+
+
+class SpeculativePrefetcher:
+    """Скачивает наиболее вероятный формат, пока пользователь выбирает качество"""
+
+    def __init__(self, downloader_factory: Callable[[str], object], work_dir: str = "./downloads/prefetch",
+                 max_jobs: int = 2, max_bytes: int = 500 * 1024 * 1024, ttl: float = 120,
+                 bandwidth_weight: float = PREFETCH_BANDWIDTH_WEIGHT):
+        self.downloader_factory = downloader_factory
+        self.work_dir = work_dir
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bandwidth_weight = bandwidth_weight
+        self.stats = ChoiceStats()
+
+        self._jobs: Dict[int, PrefetchJob] = {}
+        # Загрузки, чьи потоки еще работают: забранные и отмененные уходят из _jobs раньше,
+        # поэтому бюджет считается по ним
+        self._in_flight: Set[PrefetchJob] = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="prefetch")
+        os.makedirs(work_dir, exist_ok=True)
+
+    def start(self, user_id: int, url: str, info: dict, resolutions: List[str], size_of=None) -> Optional[str]:
+        """Предсказывает выбор пользователя и запускает загрузку в рамках бюджета"""
+        self.cancel(user_id)
+
+        size_of = size_of or (lambda resolution: None)
+        resolution = self.stats.predict(user_id, resolutions, size_of)
+        if not resolution:
+            return None
+
+        expected_size = size_of(resolution)
+        if not expected_size:
+            logger.info(f"Prefetch skipped: unknown size for {resolution}")
+            return None
+
+        with self._lock:
+            in_flight = sum(job.expected_size for job in self._in_flight)
+            if len(self._in_flight) >= self.max_jobs or in_flight + expected_size > self.max_bytes:
+                logger.info(f"Prefetch skipped: budget exhausted ({len(self._in_flight)} jobs, {in_flight} bytes)")
+                return None
+
+            job_dir = os.path.join(self.work_dir, uuid.uuid4().hex)
+            os.makedirs(job_dir, exist_ok=True)
+            job = PrefetchJob(url, resolution, job_dir, expected_size)
+            self._jobs[user_id] = job
+            self._in_flight.add(job)
+        job.future.add_done_callback(lambda _: self._release(job))
+
+        downloader = self.downloader_factory(job_dir)
+        self._executor.submit(self._run, job, downloader)
+
+        timer = threading.Timer(self.ttl, self._expire, args=(user_id, job))
+        timer.daemon = True
+        timer.start()
+
+        logger.info(f"Prefetch started for user {user_id}: {resolution} ({expected_size} bytes)")
+        return resolution
+
+    def claim(self, user_id: int, url: str, resolution: str) -> Optional[PrefetchJob]:
+        """Забирает загрузку, если пользователь выбрал предсказанный формат, иначе отменяет ее"""
+        with self._lock:
+            job = self._jobs.pop(user_id, None)
+        if not job:
+            return None
+        if job.url == url and job.resolution == resolution and not job.cancel_event.is_set():
+            job.claimed = True
+            logger.info(f"Prefetch hit for user {user_id}: {resolution}")
+            return job
+
+        logger.info(f"Prefetch miss for user {user_id}: predicted {job.resolution}, chose {resolution}")
+        self._discard(job)
+        return None
+
+    def cancel(self, user_id: int):
+        with self._lock:
+            job = self._jobs.pop(user_id, None)
+        if job:
+            self._discard(job)
+
+    def _expire(self, user_id: int, job: PrefetchJob):
+        with self._lock:
+            if self._jobs.get(user_id) is not job:
+                return
+            del self._jobs[user_id]
+        logger.info(f"Prefetch for user {user_id} expired")
+        self._discard(job)
+
+    def _release(self, job: PrefetchJob):
+        with self._lock:
+            self._in_flight.discard(job)
+
+    def _discard(self, job: PrefetchJob):
+        job.cancel_event.set()
+        # Папку удаляем после остановки загрузки, чтобы не осталось частичных файлов
+        job.future.add_done_callback(lambda _: shutil.rmtree(job.work_dir, ignore_errors=True))
+
+    def _run(self, job: PrefetchJob, downloader):
+        if job.cancel_event.is_set():
+            job.future.set_result(None)
+            return
+        try:
+            with bandwidth_weight(self.bandwidth_weight):
+                result = downloader.download_video(job.url, job.resolution, job.progress)
+            job.future.set_result(result)
+        except Exception as e:
+            job.future.set_exception(e)
@@ -0,0 +1,134 @@
+import time
+from typing import Optional, Callable
+
+# Стадии обработки задачи
+STAGE_DOWNLOAD = 'download'
+STAGE_MERGE = 'merge'
+STAGE_CONVERT = 'convert'
+STAGE_UPLOAD = 'upload'
+
+
+class ProgressEvent:
+    """Снимок прогресса задачи, общий для всех бэкендов"""
+    __slots__ = ('stage', 'done', 'total', 'speed', 'avg_speed', 'eta',
+                 'fragment_index', 'fragment_count', 'timestamp')
+
+    def __init__(self, stage: str, done: int, total: int, speed: float, avg_speed: float,
+                 eta: Optional[float], fragment_index: Optional[int], fragment_count: Optional[int],
+                 timestamp: float):
+        self.stage = stage
+        self.done = done
+        self.total = total
+        self.speed = speed
+        self.avg_speed = avg_speed
+        self.eta = eta
+        self.fragment_index = fragment_index
+        self.fragment_count = fragment_count
+        self.timestamp = timestamp
+
+    @property
+    def percent(self) -> int:
+        if not self.total:
+            return 0
+        return min(100, int(self.done * 100 / self.total))
+
+
+class SizedStream:
+    """Минимальный объект с filesize для колбэков в сигнатуре pytubefix"""
+    __slots__ = ('filesize',)
+
+    def __init__(self, filesize: int = 0):
+        self.filesize = filesize
+
+
+class ProgressTracker:
+    """Собирает прогресс с выборкой по времени и байтам.
+
+    В горячем цикле update() делает только пару сравнений; событие создается, когда
+    с прошлого события прошло min_interval секунд и min_bytes байт, либо при смене стадии
+    и завершении. Колбэк sink вызывается из потока загрузки.
+    """
+    __slots__ = ('sink', 'min_interval', 'min_bytes', 'smoothing', 'clock', 'stage', 'latest',
+                 '_last_time', '_last_done', '_avg_speed')
+
+    def __init__(self, sink: Optional[Callable[[ProgressEvent], None]] = None, min_interval: float = 0.5,
+                 min_bytes: int = 256 * 1024, smoothing: float = 0.3, clock: Callable[[], float] = time.monotonic):
+        self.sink = sink
+        self.min_interval = min_interval
+        self.min_bytes = min_bytes
+        self.smoothing = smoothing
+        self.clock = clock
+        self.stage = STAGE_DOWNLOAD
+        self.latest: Optional[ProgressEvent] = None
+        self._last_time = clock()
+        self._last_done = 0
+        self._avg_speed = 0.0
+
+    def update(self, done: int, total: int = 0, fragment_index: Optional[int] = None,
+               fragment_count: Optional[int] = None, speed: Optional[float] = None, force: bool = False):
+        now = self.clock()
+        if done < self._last_done:
+            # Начался следующий файл (yt-dlp качает видео и аудио по очереди): его первое
+            # значение становится новой точкой отсчета скорости
+            self._last_done = done
+            self._last_time = now
+        elapsed = now - self._last_time
+        finished = total and done >= total
+        if not force and not finished and (elapsed < self.min_interval or done - self._last_done < self.min_bytes):
+            return
+
+        if speed is None:
+            speed = (done - self._last_done) / elapsed if elapsed > 0 else 0.0
+        if self._avg_speed:
+            self._avg_speed += self.smoothing * (speed - self._avg_speed)
+        else:
+            self._avg_speed = speed
+        eta = (total - done) / self._avg_speed if total and self._avg_speed > 0 else None
+
+        self._last_time = now
+        self._last_done = done
+        self.latest = ProgressEvent(self.stage, done, total, speed, self._avg_speed, eta,
+                                    fragment_index, fragment_count, now)
+        if self.sink:
+            self.sink(self.latest)
+
+    def set_stage(self, stage: str, total: int = 0):
+        """Переключает стадию (merge, convert, upload) и сразу публикует событие"""
+        self.stage = stage
+        self._last_done = 0
+        self._avg_speed = 0.0
+        self._last_time = self.clock()
+        self.update(0, total, force=True)
+
+    def __call__(self, stream, chunk, bytes_remaining):
+        # Совместимость с колбэком pytubefix (stream, chunk, bytes_remaining)
+        total = stream.filesize or 0
+        self.update(total - bytes_remaining, total)
+
+    def ydl_hook(self, d: dict):
+        """Хук прогресса yt-dlp"""
+        status = d.get('status')
+        total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+        if status == 'downloading':
+            self.update(d.get('downloaded_bytes') or 0, total, d.get('fragment_index'),
+                        d.get('fragment_count'), d.get('speed'))
+        elif status == 'finished':
+            done = d.get('downloaded_bytes') or total
+            self.update(done, total or done, force=True)
+
+
+def format_progress(event: ProgressEvent) -> str:
+    """Текст прогресса для сообщения пользователю"""
+    if event.stage == STAGE_MERGE:
+        return "🔧 Объединяю видео и аудио..."
+    if event.stage == STAGE_CONVERT:
+        return "🎵 Конвертирую в MP3..."
+
+    label = "📤 Отправка" if event.stage == STAGE_UPLOAD else "⏬ Скачивание"
+    parts = [f"{label}: {event.percent}%"]
+    if event.avg_speed > 0:
+        parts.append(f"{event.avg_speed / (1024 * 1024):.1f} MB/s")
+    if event.eta is not None:
+        minutes, seconds = divmod(int(event.eta), 60)
+        parts.append(f"осталось {minutes}:{seconds:02d}")
+    return " • ".join(parts)
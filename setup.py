@@ -37,6 +37,87 @@ TELEGRAM_BOT_TOKEN=your_bot_token_here
 
 # Папка для временных файлов (необязательно)
 DOWNLOAD_DIR=./downloads
+
+# Пул ffmpeg (необязательно): 0 воркеров = половина ядер,
+# 0 потоков = ядра поровну между воркерами
+FFMPEG_MAX_WORKERS=0
+FFMPEG_THREADS=0
+FFMPEG_NICE=10
+FFMPEG_TIMEOUT=3600
+
+# Спекулятивная загрузка, пока пользователь выбирает качество (необязательно)
+PREFETCH_ENABLED=1
+PREFETCH_MAX_JOBS=2
+PREFETCH_MAX_MB=500
+PREFETCH_TTL=120
+# Доля полосы загрузки относительно запрошенных пользователем (BANDWIDTH_INGRESS_MBIT)
+PREFETCH_BANDWIDTH_WEIGHT=0.25
+
+# Сколько частей большого видео отправлять одновременно
+UPLOAD_CONCURRENCY=4
+
+# Исходящие IP для yt-dlp через запятую (необязательно).
+# Дополнительные файлы кук кладите в downloads/cookies/*.txt
+YT_SOURCE_ADDRESSES=
+
+# Кэш метаданных видео (SQLite, общий для всех процессов)
+METADATA_CACHE_ENABLED=1
+METADATA_CACHE_PATH=./downloads/metadata.sqlite3
+
+# Ограничение полосы в Мбит/с (0 - без ограничений)
+BANDWIDTH_INGRESS_MBIT=0
+BANDWIDTH_EGRESS_MBIT=0
+
+# Сжатие видео до 2x больше лимита вместо нарезки на части
+FIT_TO_LIMIT_ENABLED=1
+FIT_MAX_JOBS=1
+FIT_MAX_SECONDS=300
+
+# MP3 длиннее порога (секунды) кодируется сегментами параллельно на воркерах
+# пула ffmpeg (FFMPEG_MAX_WORKERS); битрейт выбирается по длительности под лимит 50 MB
+MP3_PARALLEL_MIN_SECONDS=600
+
+# Небольшие файлы Telegram забирает по ссылке; для ссылок, привязанных к IP,
+# нужен встроенный сервер с публичным адресом
+PASSTHROUGH_ENABLED=1
+MEDIA_SERVER_PUBLIC_URL=
+MEDIA_SERVER_HOST=0.0.0.0
+MEDIA_SERVER_PORT=8080
+MEDIA_SERVER_MAX_CONNECTIONS=32
+
+# Файлы больше лимита Telegram встроенный сервер отдает по подписанной ссылке
+# (нужен MEDIA_SERVER_PUBLIC_URL). Задайте MEDIA_SERVER_SECRET, чтобы ссылки
+# переживали перезапуск
+FILE_LINKS_ENABLED=1
+FILE_LINK_TTL_HOURS=24
+MEDIA_SERVER_SECRET=
+
+# Логи: файл в JSON с ротацией, консоль текстом.
+# LOG_SAMPLING - доля сохраняемых записей частых логгеров, например httpx=0.05
+LOG_LEVEL=INFO
+LOG_FILE=bot.log
+LOG_MAX_MB=20
+LOG_SAMPLING=
+
+# Контроль задержки цикла событий: стек в лог, если цикл занят дольше порога
+LOOP_WATCHDOG_ENABLED=1
+LOOP_LAG_THRESHOLD_MS=100
+LOOP_LAG_REPORT_INTERVAL=300
+
+# Общее хранилище готовых файлов для нескольких узлов: local или s3 (пусто - выключено).
+# Для s3 нужен pip install boto3; MinIO подключается через S3_ENDPOINT_URL
+MEDIA_STORAGE=
+MEDIA_STORAGE_PATH=./downloads/storage
+S3_BUCKET=
+S3_PREFIX=
+S3_ENDPOINT_URL=
+S3_REGION=
+
+# Конвейер доставки: одновременно задач на стадиях скачивания, обработки
+# и подготовки (ffmpeg, нарезка, миниатюры; 0 - по числу ядер) и отправки в Telegram
+PIPELINE_FETCH_WORKERS=8
+PIPELINE_PROCESS_WORKERS=0
+PIPELINE_UPLOAD_WORKERS=4
 """
     
     if not os.path.exists(".env.example"):
@@ -0,0 +1,379 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from urllib.parse import quote, unquote
+from typing import Optional, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Размер части multipart-загрузки и диапазона при чтении (S3 требует не меньше 5 MB)
+PART_SIZE = 16 * 1024 * 1024
+COPY_CHUNK = 1024 * 1024
+
+
+def media_key(video_id: str, variant: Optional[str], clip: Optional[Tuple[float, float]] = None,
+              transform: Optional[str] = None) -> str:
+    """Ключ объекта по тому, что в нем лежит: видео, вариант (разрешение или audio),
+    фрагмент и преобразование (mp3, сжатие под лимит).
+
+    Одинаковый запрос на любом узле дает одинаковый ключ, независимо от бэкенда загрузки
+    и имени файла.
+    """
+    parts = [video_id, variant or 'best']
+    if clip:
+        parts.append(f"{clip[0]:.0f}-{clip[1]:.0f}")
+    if transform:
+        parts.append(transform)
+    digest = hashlib.sha256('|'.join(parts).encode('utf-8')).hexdigest()
+    return f"media/{digest[:2]}/{digest}"
+
+
+class StoredObject:
+    def __init__(self, key: str, size: int, metadata: Dict[str, str]):
+        self.key = key
+        self.size = size
+        self.metadata = metadata
+
+
+class MediaStorage(ABC):
+    """Хранилище готовых медиафайлов, общее для загрузчиков и отправки в боте.
+
+    Наследники реализуют stat, open_writer, read_range и delete; копирование файлов
+    целиком построено на них и может быть переопределено более быстрым способом.
+    """
+
+    @abstractmethod
+    def stat(self, key: str) -> Optional[StoredObject]:
+        """Размер и метаданные объекта; None, если его нет"""
+
+    @abstractmethod
+    def open_writer(self, key: str, metadata: Optional[Dict[str, str]] = None):
+        """Потоковая запись: объект с write(), контекстный менеджер. Объект появляется
+        под ключом только после успешного выхода из блока"""
+
+    @abstractmethod
+    def read_range(self, key: str, start: int, end: int) -> bytes:
+        """Байты [start, end] включительно, как в заголовке Range"""
+
+    @abstractmethod
+    def delete(self, key: str):
+        """Удаляет объект; отсутствующий ключ не ошибка"""
+
+    def put_file(self, key: str, path: str, metadata: Optional[Dict[str, str]] = None):
+        with self.open_writer(key, metadata) as writer, open(path, 'rb', buffering=0) as f:
+            while True:
+                chunk = f.read(COPY_CHUNK)
+                if not chunk:
+                    break
+                writer.write(chunk)
+
+    def get_file(self, key: str, path: str) -> Optional[StoredObject]:
+        """Копирует объект в локальный файл диапазонами по PART_SIZE"""
+        stored = self.stat(key)
+        if not stored:
+            return None
+        with _atomic_file(path) as f:
+            for start in range(0, stored.size, PART_SIZE):
+                f.write(self.read_range(key, start, min(start + PART_SIZE, stored.size) - 1))
+        return stored
+
+
+class _atomic_file:
+    """Файл, который появляется под своим именем только после успешной записи"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._tmp_path = None
+        self._file = None
+
+    def __enter__(self):
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, self._tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        self._file = os.fdopen(fd, 'wb')
+        return self._file
+
+    def __exit__(self, exc_type, exc, tb):
+        self._file.close()
+        if exc_type is None:
+            os.replace(self._tmp_path, self.path)
+        else:
+            os.remove(self._tmp_path)
+
+
+class LocalStorage(MediaStorage):
+    """Хранилище в каталоге; метаданные лежат рядом в .json.
+
+    Подходит для одного узла или общего сетевого диска.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split('/'))
+
+    def stat(self, key: str) -> Optional[StoredObject]:
+        path = self._path(key)
+        try:
+            size = os.path.getsize(path)
+            with open(path + '.json', encoding='utf-8') as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return StoredObject(key, size, metadata)
+
+    def open_writer(self, key: str, metadata: Optional[Dict[str, str]] = None):
+        return _LocalWriter(self, key, metadata or {})
+
+    def read_range(self, key: str, start: int, end: int) -> bytes:
+        with open(self._path(key), 'rb') as f:
+            f.seek(start)
+            return f.read(end - start + 1)
+
+    def delete(self, key: str):
+        path = self._path(key)
+        for file_path in (path + '.json', path):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def put_file(self, key: str, path: str, metadata: Optional[Dict[str, str]] = None):
+        # Копия, а не ссылка: загрузчики могут перезаписать свой файл на месте
+        target = self._path(key)
+        with _atomic_file(target) as f, open(path, 'rb') as source:
+            shutil.copyfileobj(source, f, COPY_CHUNK)
+        self._write_metadata(target, metadata or {})
+
+    def get_file(self, key: str, path: str) -> Optional[StoredObject]:
+        stored = self.stat(key)
+        if not stored:
+            return None
+        # Восстановленный файл никто не меняет на месте, поэтому хватает жесткой ссылки
+        if not _link(self._path(key), path):
+            with _atomic_file(path) as f, open(self._path(key), 'rb') as source:
+                shutil.copyfileobj(source, f, COPY_CHUNK)
+        return stored
+
+    @staticmethod
+    def _write_metadata(target: str, metadata: Dict[str, str]):
+        with _atomic_file(target + '.json') as f:
+            f.write(json.dumps(metadata, ensure_ascii=False).encode('utf-8'))
+
+
+class _LocalWriter:
+    def __init__(self, storage: LocalStorage, key: str, metadata: Dict[str, str]):
+        self._target = storage._path(key)
+        self._metadata = metadata
+        self._file = _atomic_file(self._target)
+
+    def __enter__(self):
+        self._handle = self._file.__enter__()
+        return self
+
+    def write(self, data) -> int:
+        return self._handle.write(data)
+
+    def __exit__(self, exc_type, exc, tb):
+        # Метаданные пишутся последними: без них stat объект не видит
+        self._file.__exit__(exc_type, exc, tb)
+        if exc_type is None:
+            LocalStorage._write_metadata(self._target, self._metadata)
+
+
+def _link(source: str, target: str) -> bool:
+    """Жесткая ссылка вместо копии; False, если файлы на разных разделах"""
+    tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.link"
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        return False
+    os.replace(tmp_path, target)
+    return True
+
+
+class S3Storage(MediaStorage):
+    """S3-совместимое хранилище (AWS S3, MinIO, Ceph) - общий уровень для всех узлов.
+
+    Запись идет multipart-загрузкой частями по PART_SIZE без временного файла, чтение -
+    запросами Range. Нужен boto3; для MinIO достаточно указать endpoint_url.
+    """
+
+    def __init__(self, bucket: str, prefix: str = '', endpoint_url: Optional[str] = None,
+                 region: Optional[str] = None, part_size: int = PART_SIZE):
+        try:
+            import boto3
+            from botocore.config import Config
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("S3 storage requires boto3: pip install boto3")
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        # Клиент boto3 потокобезопасен, один на все загрузки
+        self._client = boto3.client(
+            's3', endpoint_url=endpoint_url, region_name=region,
+            config=Config(retries={'max_attempts': 5, 'mode': 'adaptive'})
+        )
+        self._client_error = ClientError
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def stat(self, key: str) -> Optional[StoredObject]:
+        try:
+            response = self._client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except self._client_error as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        # Метаданные S3 - только ASCII, поэтому значения хранятся в URL-кодировке
+        metadata = {name: unquote(value) for name, value in response.get('Metadata', {}).items()}
+        return StoredObject(key, response['ContentLength'], metadata)
+
+    def open_writer(self, key: str, metadata: Optional[Dict[str, str]] = None):
+        return _S3Writer(self, self._key(key), {name: quote(str(value)) for name, value in (metadata or {}).items()})
+
+    def read_range(self, key: str, start: int, end: int) -> bytes:
+        response = self._client.get_object(Bucket=self.bucket, Key=self._key(key), Range=f"bytes={start}-{end}")
+        with response['Body'] as body:
+            return body.read()
+
+    def delete(self, key: str):
+        self._client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+class _S3Writer:
+    """Копит данные до размера части и отправляет их upload_part.
+
+    Маленький объект уходит одним put_object. При ошибке незавершенная
+    multipart-загрузка отменяется, чтобы части не занимали место в бакете.
+    """
+
+    def __init__(self, storage: S3Storage, key: str, metadata: Dict[str, str]):
+        self._storage = storage
+        self._client = storage._client
+        self._key = key
+        self._metadata = metadata
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def __enter__(self):
+        return self
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self._storage.part_size:
+            self._upload_part(bytes(self._buffer[:self._storage.part_size]))
+            del self._buffer[:self._storage.part_size]
+        return len(data)
+
+    def _upload_part(self, data: bytes):
+        if self._upload_id is None:
+            response = self._client.create_multipart_upload(
+                Bucket=self._storage.bucket, Key=self._key, Metadata=self._metadata
+            )
+            self._upload_id = response['UploadId']
+        number = len(self._parts) + 1
+        response = self._client.upload_part(
+            Bucket=self._storage.bucket, Key=self._key, UploadId=self._upload_id, PartNumber=number, Body=data
+        )
+        self._parts.append({'PartNumber': number, 'ETag': response['ETag']})
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._abort()
+            return
+        try:
+            if self._upload_id is None:
+                self._client.put_object(Bucket=self._storage.bucket, Key=self._key,
+                                        Body=bytes(self._buffer), Metadata=self._metadata)
+                return
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            self._client.complete_multipart_upload(
+                Bucket=self._storage.bucket, Key=self._key, UploadId=self._upload_id,
+                MultipartUpload={'Parts': self._parts}
+            )
+        except Exception:
+            self._abort()
+            raise
+
+    def _abort(self):
+        if self._upload_id is None:
+            return
+        try:
+            self._client.abort_multipart_upload(Bucket=self._storage.bucket, Key=self._key,
+                                                UploadId=self._upload_id)
+        except Exception as e:
+            logger.warning(f"Error aborting multipart upload {self._key}: {e}")
+
+
+def restore(storage: Optional[MediaStorage], key: Optional[str], directory: str) -> Optional[Tuple[str, str]]:
+    """Достает готовый файл из хранилища в directory. Возвращает (путь, название) как загрузчики"""
+    if not storage or not key:
+        return None
+    try:
+        stored = storage.stat(key)
+        if not stored:
+            return None
+        filename = stored.metadata.get('filename', 'media')
+        stem, ext = os.path.splitext(filename)
+        # Уникальное имя: тот же файл может одновременно отправляться нескольким пользователям
+        fd, path = tempfile.mkstemp(dir=directory, prefix=f"{stem[:100]}_", suffix=ext)
+        os.close(fd)
+        if not storage.get_file(key, path):
+            os.remove(path)
+            return None
+        logger.info(f"Restored {filename} from storage ({stored.size} bytes)")
+        return path, stored.metadata.get('title', stem)
+    except Exception as e:
+        logger.error(f"Error restoring {key} from storage: {e}")
+        return None
+
+
+def save(storage: Optional[MediaStorage], key: Optional[str],
+         result: Optional[Tuple[str, str]]) -> Optional[Tuple[str, str]]:
+    """Кладет результат загрузки (путь, название) в хранилище и возвращает его без изменений.
+
+    Ошибка хранилища не мешает отправке: файл просто не попадет в общий кэш.
+    """
+    if not storage or not key or not result:
+        return result
+    path, title = result
+    try:
+        storage.put_file(key, path, {'title': title, 'filename': os.path.basename(path)})
+        logger.info(f"Saved {os.path.basename(path)} to storage")
+    except Exception as e:
+        logger.error(f"Error saving {path} to storage: {e}")
+    return result
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage() -> Optional[MediaStorage]:
+    """Хранилище из переменных окружения; None, если MEDIA_STORAGE не задан"""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            backend = os.getenv('MEDIA_STORAGE', '').lower()
+            if backend == 'local':
+                _storage = LocalStorage(os.getenv('MEDIA_STORAGE_PATH', './downloads/storage'))
+            elif backend == 's3':
+                _storage = S3Storage(
+                    bucket=os.environ['S3_BUCKET'],
+                    prefix=os.getenv('S3_PREFIX', ''),
+                    endpoint_url=os.getenv('S3_ENDPOINT_URL') or None,
+                    region=os.getenv('S3_REGION') or None
+                )
+            else:
+                return None
+        return _storage
@@ -0,0 +1,38 @@
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    """Обработчик без журнала запросов в stderr"""
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalServer:
+    """HTTP-сервер на свободном порту в фоновом потоке - замена YouTube и googlevideo в тестах.
+
+    Состояние для обработчика передается ключевыми аргументами и доступно ему как self.server.<имя>.
+    """
+
+    def __init__(self, handler_class, **state):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        self.httpd.daemon_threads = True
+        self.httpd.lock = threading.Lock()
+        for name, value in state.items():
+            setattr(self.httpd, name, value)
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> 'LocalServer':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._thread.join()
@@ -0,0 +1,86 @@
+import time
+import asyncio
+
+import httpx
+
+from async_download import fetch_to_file
+from bandwidth import BandwidthScheduler, INGRESS, bandwidth_weight
+from http_harness import LocalServer, QuietHandler
+
+MB = 1024 * 1024
+
+
+class ThrottledOrigin(QuietHandler):
+    """Отдает диапазоны байт не быстрее server.rate байт в секунду"""
+
+    def do_GET(self):
+        body = self.server.body
+        start, end = 0, len(body) - 1
+        if 'Range' in self.headers:
+            first, last = self.headers['Range'].split('=', 1)[1].split('-')
+            start, end = int(first), min(int(last), end)
+        self.send_response(206 if 'Range' in self.headers else 200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        chunk = 64 * 1024
+        for offset in range(start, end + 1, chunk):
+            self.wfile.write(body[offset:min(offset + chunk, end + 1)])
+            time.sleep(chunk / self.server.rate)
+
+
+def download(url, path, size, job):
+    async def run():
+        async with httpx.AsyncClient() as client:
+            await fetch_to_file(client, url, str(path), size, bandwidth_job=job)
+    started = time.monotonic()
+    asyncio.run(run())
+    return time.monotonic() - started
+
+
+def test_single_job_is_limited_to_ingress_rate(tmp_path):
+    body = bytes(range(256)) * (2 * MB // 256)
+    scheduler = BandwidthScheduler(ingress_rate=1 * MB, burst_seconds=0.1)
+    with LocalServer(ThrottledOrigin, body=body, rate=8 * MB) as origin:
+        job = scheduler.register(INGRESS, len(body))
+        elapsed = download(origin.url, tmp_path / 'out.bin', len(body), job)
+        job.close()
+
+    # Без лимита источник отдал бы файл за ~0.25 с
+    assert 1.7 <= elapsed < 4
+    assert (tmp_path / 'out.bin').read_bytes() == body
+    assert job.done == len(body)
+
+
+def test_concurrent_jobs_share_ingress_rate(tmp_path):
+    body = b'x' * MB
+    scheduler = BandwidthScheduler(ingress_rate=1 * MB, burst_seconds=0.1)
+
+    async def run(url):
+        async with httpx.AsyncClient() as client:
+            async def one(index):
+                job = scheduler.register(INGRESS, len(body))
+                try:
+                    await fetch_to_file(client, url, str(tmp_path / f"{index}.bin"), len(body), bandwidth_job=job)
+                finally:
+                    job.close()
+                return time.monotonic() - started
+            started = time.monotonic()
+            return await asyncio.gather(one(0), one(1))
+
+    with LocalServer(ThrottledOrigin, body=body, rate=8 * MB) as origin:
+        finished = asyncio.run(run(origin.url))
+
+    # Общая полоса делится поровну: оба файла заканчиваются примерно через 2 с
+    assert all(1.5 <= elapsed < 4 for elapsed in finished)
+    assert abs(finished[0] - finished[1]) < 0.6
+
+
+def test_background_jobs_get_a_smaller_share():
+    scheduler = BandwidthScheduler(ingress_rate=1 * MB, small_job_bytes=0)
+    foreground = scheduler.register(INGRESS, 100 * MB)
+    with bandwidth_weight(0.25):
+        background = scheduler.register(INGRESS, 100 * MB)
+    scheduler.reserve(foreground, 1)
+    scheduler.reserve(background, 1)
+    assert foreground.bucket.rate == 0.8 * MB
+    assert background.bucket.rate == 0.2 * MB
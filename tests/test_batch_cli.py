@@ -0,0 +1,74 @@
+import os
+from types import SimpleNamespace
+
+from batch_cli import BatchRunner
+from bot_fixed import TelegramYTBot
+from downloader_pytubefix import YouTubeDownloader
+from storage import LocalStorage
+
+URL = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+
+
+class FakeDownloader:
+    """Загрузчик без сети с настоящими ключами хранилища"""
+    storage_key = YouTubeDownloader.storage_key
+
+    def __init__(self, root):
+        self.download_dir = str(root / 'downloads')
+        os.makedirs(self.download_dir)
+        self.storage = LocalStorage(str(root / 'storage'))
+        self.requested = []
+
+    def download_video(self, url, resolution=None, progress_callback=None):
+        self.requested.append(resolution)
+        path = os.path.join(self.download_dir, 'Song.m4a')
+        with open(path, 'wb') as f:
+            f.write(b'audio')
+        return path, 'Song'
+
+    def convert_to_mp3(self, path, duration=None):
+        mp3_path = path.rsplit('.', 1)[0] + '.mp3'
+        with open(mp3_path, 'wb') as f:
+            f.write(b'mp3')
+        return mp3_path
+
+    def cleanup_file(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    def last_error(self, url):
+        return None
+
+
+def test_audio_batch_uses_bot_storage_key(tmp_path):
+    downloader = FakeDownloader(tmp_path)
+    runner = BatchRunner(downloader, audio=True)
+    [item] = runner.run([URL], progress=False)
+    assert item.status == 'ok'
+    assert downloader.requested == ['audio']
+
+    # Кнопка MP3 в боте ищет результат как restore_stored(url, 'audio', clip=None, audio_only=True)
+    bot = SimpleNamespace(downloader=downloader)
+    path, title = TelegramYTBot.restore_stored(bot, URL, 'audio', None, True)
+    assert title == 'Song' and path.endswith('.mp3')
+
+    # Повторный прогон с --skip-existing находит файл в общем хранилище
+    again = BatchRunner(downloader, audio=True, skip_existing=True)
+    [item] = again.run([URL], progress=False)
+    assert item.status == 'skipped'
+
+
+def test_audio_with_resolution_is_stored_as_audio(tmp_path):
+    downloader = FakeDownloader(tmp_path)
+    runner = BatchRunner(downloader, resolution='720p', audio=True)
+    [item] = runner.run([URL], progress=False)
+    assert item.status == 'ok'
+    # Качается выбранное видео, а MP3 ложится туда же, где его ищет кнопка MP3 бота
+    assert downloader.requested == ['720p']
+    bot = SimpleNamespace(downloader=downloader)
+    path, title = TelegramYTBot.restore_stored(bot, URL, 'audio', None, True)
+    assert title == 'Song' and path.endswith('.mp3')
+
+    again = BatchRunner(downloader, resolution='720p', audio=True, skip_existing=True)
+    [item] = again.run([URL], progress=False)
+    assert item.status == 'skipped'
@@ -0,0 +1,46 @@
+import io
+import asyncio
+from types import SimpleNamespace
+
+from bot_fixed import Delivery, TelegramYTBot
+from downloader_pytubefix import StreamSelection
+
+URL = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+
+
+def box(kind: bytes, payload: bytes = b'') -> bytes:
+    return (8 + len(payload)).to_bytes(4, 'big') + kind + payload
+
+
+class FakeQuery:
+    def __init__(self):
+        self.from_user = SimpleNamespace(id=1)
+        self.message = SimpleNamespace(chat_id=42)
+
+    async def edit_message_text(self, text):
+        pass
+
+
+class FakeBot:
+    def __init__(self):
+        self.videos = []
+
+    async def send_video(self, **kwargs):
+        self.videos.append(kwargs)
+
+
+def test_buffered_video_is_sent_with_source_metadata():
+    bot = FakeBot()
+    delivery = Delivery(FakeQuery(), bot, URL, '720p', False, duration=212.4)
+    delivery.selection = StreamSelection(None, 'Video', [SimpleNamespace(width=1280, height=720)])
+    # moov перед mdat: перекладывать файл не нужно, ffprobe не вызывается
+    data = box(b'ftyp', b'isom\x00\x00\x02\x00') + box(b'moov') + box(b'mdat', b'\x00' * 32)
+    delivery.buffered = (io.BytesIO(data), 'Video.mp4', 'Video')
+
+    telegram_bot = TelegramYTBot.__new__(TelegramYTBot)
+    asyncio.run(telegram_bot.stage_prepare(SimpleNamespace(payload=delivery)))
+    assert asyncio.run(telegram_bot.send_from_memory(delivery))
+
+    sent, = bot.videos
+    assert (sent['duration'], sent['width'], sent['height']) == (212, 1280, 720)
+    assert sent['supports_streaming'] is True
@@ -0,0 +1,103 @@
+import pytest
+
+from download_errors import (CircuitBreaker, RetryManager, DownloadCancelled, ThrottledError,
+                             VideoUnavailableError, find_cancellation)
+from prefetch import PrefetchCancelled
+
+URL = 'https://youtu.be/dQw4w9WgXcQ'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def open_breaker(clock):
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=10, clock=clock)
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now = 10
+    return breaker
+
+
+def test_half_open_admits_single_probe():
+    clock = FakeClock()
+    breaker = open_breaker(clock)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_probe_reopens_breaker():
+    clock = FakeClock()
+    breaker = open_breaker(clock)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    clock.now = 20
+    assert breaker.allow()
+
+
+def test_lost_probe_is_replaced_after_timeout():
+    clock = FakeClock()
+    breaker = open_breaker(clock)
+    assert breaker.allow()
+    clock.now = 15
+    assert not breaker.allow()
+    clock.now = 20
+    assert breaker.allow()
+
+
+def test_neutral_probe_result_releases_slot():
+    clock = FakeClock()
+    manager = RetryManager(failure_threshold=1, reset_timeout=10)
+    breaker = manager.breaker('test')
+    breaker.clock = clock
+    breaker.record_failure()
+    clock.now = 10
+
+    def unavailable():
+        raise VideoUnavailableError("Video unavailable")
+    with pytest.raises(VideoUnavailableError):
+        manager.call(unavailable, URL, breakers=['test'])
+    # Ошибка самого видео ничего не говорит о бэкенде: следующий запрос снова проба
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert manager.call(lambda: 'ok', 'https://youtu.be/aaaaaaaaaaa', breakers=['test']) == 'ok'
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_cancellation_is_not_an_error():
+    manager = RetryManager(failure_threshold=1)
+    calls = []
+
+    def cancelled():
+        calls.append(1)
+        raise PrefetchCancelled(URL)
+    with pytest.raises(PrefetchCancelled):
+        manager.call(cancelled, URL, breakers=['test'])
+    assert calls == [1]
+    assert manager.last_error(URL) is None
+    assert manager.breaker('test').state == CircuitBreaker.CLOSED
+    assert manager.breaker('test').failures == 0
+
+
+def test_cancellation_wrapped_by_backend_is_found():
+    class WrappedError(Exception):
+        def __init__(self, msg, exc_info):
+            super().__init__(msg)
+            self.exc_info = exc_info
+
+    cancel = PrefetchCancelled(URL)
+    wrapped = WrappedError("ERROR: interrupted", (type(cancel), cancel, None))
+    assert find_cancellation(wrapped) is cancel
+    assert find_cancellation(ThrottledError("HTTP Error 429")) is None
+    assert isinstance(cancel, DownloadCancelled)
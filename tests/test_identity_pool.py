@@ -0,0 +1,92 @@
+from collections import Counter
+from http.cookiejar import MozillaCookieJar
+
+import httpx
+import pytest
+
+from download_errors import classify_exception, ThrottledError
+from identity_pool import Identity, IdentityPool
+from http_harness import LocalServer, QuietHandler
+
+
+class ThrottlingOrigin(QuietHandler):
+    """Отвечает 429 на куку, исчерпавшую свой лимит запросов"""
+
+    def do_GET(self):
+        cookie = self.headers.get('Cookie', '')
+        with self.server.lock:
+            self.server.seen[cookie] += 1
+            throttled = self.server.seen[cookie] > self.server.budget
+            if not throttled:
+                self.server.served[cookie] += 1
+        self.send_response(429 if throttled else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def write_cookies(path, value):
+    path.write_text("# Netscape HTTP Cookie File\n"
+                    f"127.0.0.1\tFALSE\t/\tFALSE\t2147483647\tSID\t{value}\n")
+    return str(path)
+
+
+def cookie_header(identity: Identity) -> str:
+    jar = MozillaCookieJar(identity.cookiefile)
+    jar.load()
+    return '; '.join(f"{cookie.name}={cookie.value}" for cookie in jar)
+
+
+def fetch(pool: IdentityPool, url: str) -> Identity:
+    with pool.use(classify_exception) as identity:
+        httpx.get(url, headers={'Cookie': cookie_header(identity)}).raise_for_status()
+        return identity
+
+
+@pytest.fixture
+def origin():
+    with LocalServer(ThrottlingOrigin, seen=Counter(), served=Counter(), budget=3) as server:
+        yield server
+
+
+@pytest.fixture
+def pool(tmp_path):
+    identities = [Identity(write_cookies(tmp_path / f"{name}.txt", name)) for name in ('a', 'b')]
+    return IdentityPool(identities, quarantine_time=300, throttle_limit=2, clock=FakeClock())
+
+
+def test_concurrent_requests_use_different_identities(origin, pool):
+    with pool.use(classify_exception) as first:
+        second = fetch(pool, origin.url)
+    assert first is not second
+    assert origin.httpd.served == {'SID=b': 1}
+
+
+def test_throttled_identity_rotates_and_cools_down(origin, pool):
+    a, b = pool.identities
+    results = []
+    for _ in range(10):
+        try:
+            results.append(fetch(pool, origin.url).name)
+        except httpx.HTTPStatusError as e:
+            assert isinstance(classify_exception(e), ThrottledError)
+            results.append('429')
+
+    # Каждая кука отработала свой лимит у источника, после 429 запросы ушли на другую
+    assert origin.httpd.served == {'SID=a': 3, 'SID=b': 3}
+    assert results[:8] == ['a.txt'] * 3 + ['429'] + ['b.txt'] * 3 + ['429']
+    assert a.quarantined_until == b.quarantined_until == 300
+    assert a.health < 1.0 and b.health < 1.0
+
+    # После карантина и сброса лимита у источника идентичности снова в работе
+    pool.clock.now = 301
+    origin.httpd.seen.clear()
+    assert fetch(pool, origin.url) in (a, b)
+    assert sum(origin.httpd.served.values()) == 7
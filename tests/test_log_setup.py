@@ -0,0 +1,44 @@
+import json
+import queue
+import logging
+
+from log_setup import ContextFilter, JsonFormatter, LogQueueHandler, TextFormatter, log_context
+
+
+def queued_record(log):
+    """Запись в том виде, в каком ее получает поток слушателя"""
+    handler = LogQueueHandler(queue.SimpleQueue())
+    handler.addFilter(ContextFilter())
+    logger = logging.getLogger('test_log_setup')
+    logger.addHandler(handler)
+    logger.propagate = False
+    try:
+        log(logger)
+    finally:
+        logger.removeHandler(handler)
+    return handler.queue.get_nowait()
+
+
+def test_json_record_keeps_traceback():
+    def log(logger):
+        with log_context(job_id='abc123'):
+            try:
+                {}['missing']
+            except KeyError:
+                logger.exception("Download %s failed", 'dQw4w9WgXcQ')
+
+    record = queued_record(log)
+    data = json.loads(JsonFormatter().format(record))
+    assert data['msg'] == "Download dQw4w9WgXcQ failed"
+    assert data['job_id'] == 'abc123'
+    assert data['exc'].startswith('Traceback') and "KeyError: 'missing'" in data['exc']
+    # Трейсбек идет отдельным полем, а в консоли остается под сообщением
+    assert 'Traceback' not in data['msg']
+    assert 'Traceback' in TextFormatter().format(record)
+
+
+def test_json_record_without_exception_has_no_exc():
+    record = queued_record(lambda logger: logger.warning("Slow %s", 'stage', extra={'seconds': 3}))
+    data = json.loads(JsonFormatter().format(record))
+    assert data['msg'] == "Slow stage" and data['seconds'] == 3
+    assert 'exc' not in data
@@ -0,0 +1,124 @@
+import os
+import asyncio
+
+import httpx
+import pytest
+
+from media_server import MediaServer, parse_range
+from http_harness import LocalServer, QuietHandler
+
+SIZE = 1000
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('bytes=0-', (0, SIZE - 1)),
+    ('bytes=100-199', (100, 199)),
+    ('bytes=900-5000', (900, SIZE - 1)),
+    ('bytes=-100', (900, SIZE - 1)),
+    ('bytes=-5000', (0, SIZE - 1)),
+    # Несколько диапазонов и чужие единицы - отдаем файл целиком
+    ('bytes=0-9,20-29', None),
+    ('items=0-9', None),
+    ('bytes=abc', None),
+])
+def test_parse_range(value, expected):
+    assert parse_range(value, SIZE) == expected
+
+
+@pytest.mark.parametrize('value', ['bytes=1000-', 'bytes=1500-1600', 'bytes=200-100', 'bytes=-0'])
+def test_unsatisfiable_range(value):
+    with pytest.raises(ValueError):
+        parse_range(value, SIZE)
+
+
+class RangeOrigin(QuietHandler):
+    """Источник для прокси: отдает server.body с поддержкой Range"""
+
+    def do_GET(self):
+        body = self.server.body
+        byte_range = parse_range(self.headers['Range'], len(body)) if 'Range' in self.headers else None
+        start, end = byte_range or (0, len(body) - 1)
+        self.send_response(206 if byte_range else 200)
+        if byte_range:
+            self.send_header('Content-Range', f"bytes {start}-{end}/{len(body)}")
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(body[start:end + 1])
+
+
+def serve(tmp_path, scenario):
+    """Запускает MediaServer на свободном порту и выполняет scenario(server, client, base_url)"""
+    async def run():
+        server = MediaServer('http://media.example', host='127.0.0.1', port=0,
+                             files_dir=str(tmp_path / 'links'), secret='test-secret')
+        await server.start()
+        port = server._server.sockets[0].getsockname()[1]
+        try:
+            async with httpx.AsyncClient() as client:
+                return await scenario(server, client, f"http://127.0.0.1:{port}")
+        finally:
+            await server.stop()
+    return asyncio.run(run())
+
+
+def publish(server, tmp_path, data, ttl=None):
+    source = tmp_path / 'Видео.mp4'
+    source.write_bytes(data)
+    link, expires_at = server.publish_file(str(source), 'Видео.mp4', ttl=ttl)
+    return link.replace(server.public_url, ''), expires_at
+
+
+def test_ranged_get_of_published_file(tmp_path):
+    data = os.urandom(256 * 1024)
+
+    async def scenario(server, client, base):
+        path, _ = publish(server, tmp_path, data)
+        full = await client.get(base + path)
+        ranged = await client.get(base + path, headers={'Range': 'bytes=1000-1999'})
+        tail = await client.get(base + path, headers={'Range': 'bytes=-10'})
+        multi = await client.get(base + path, headers={'Range': 'bytes=0-9,20-29'})
+        beyond = await client.get(base + path, headers={'Range': f"bytes={len(data)}-"})
+        return full, ranged, tail, multi, beyond
+
+    full, ranged, tail, multi, beyond = serve(tmp_path, scenario)
+    assert full.status_code == 200 and full.content == data
+    assert full.headers['accept-ranges'] == 'bytes'
+    assert ranged.status_code == 206 and ranged.content == data[1000:2000]
+    assert ranged.headers['content-range'] == f"bytes 1000-1999/{len(data)}"
+    assert tail.status_code == 206 and tail.content == data[-10:]
+    assert multi.status_code == 200 and multi.content == data
+    assert beyond.status_code == 416
+    assert beyond.headers['content-range'] == f"bytes */{len(data)}"
+
+
+def test_tampered_and_expired_links_are_rejected(tmp_path):
+    async def scenario(server, client, base):
+        path, _ = publish(server, tmp_path, b'x' * 100)
+        signature = path.rsplit('=', 1)[1]
+        forged = path[:-len(signature)] + ('0' if signature[0] != '0' else '1') + signature[1:]
+        unsigned = path.split('?', 1)[0]
+        # Подпись от другого файла не подходит
+        name = path.split('/')[2]
+        other = path.replace(name, str(int(name.split('-', 1)[0]) + 3600) + '-' + name.split('-', 1)[1])
+        expired_path, _ = publish(server, tmp_path, b'y' * 100, ttl=-1)
+        return [(await client.get(base + p)).status_code for p in (forged, unsigned, other, expired_path)]
+
+    assert serve(tmp_path, scenario) == [403, 403, 403, 410]
+
+
+def test_proxy_passes_range_to_origin(tmp_path):
+    body = bytes(range(256)) * 64
+
+    async def scenario(server, client, base):
+        link = server.register_proxy(origin.url + '/videoplayback')
+        path = link.replace(server.public_url, '')
+        ranged = await client.get(base + path, headers={'Range': 'bytes=256-511'})
+        missing = await client.get(base + '/proxy/unknown')
+        return ranged, missing
+
+    with LocalServer(RangeOrigin, body=body) as origin:
+        ranged, missing = serve(tmp_path, scenario)
+    assert ranged.status_code == 206
+    assert ranged.content == body[256:512]
+    assert ranged.headers['content-range'] == f"bytes 256-511/{len(body)}"
+    assert missing.status_code == 404
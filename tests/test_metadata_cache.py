@@ -0,0 +1,15 @@
+import os
+
+from metadata_cache import MetadataCache
+
+
+def test_path_is_read_from_environment_at_construction(tmp_path, monkeypatch):
+    # Переменная появляется после импорта модуля - как при load_dotenv в боте
+    path = str(tmp_path / 'meta' / 'cache.sqlite3')
+    monkeypatch.setenv('METADATA_CACHE_PATH', path)
+    cache = MetadataCache()
+    assert cache.path == path
+    assert os.path.exists(path)
+
+    explicit = str(tmp_path / 'explicit.sqlite3')
+    assert MetadataCache(explicit).path == explicit
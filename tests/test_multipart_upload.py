@@ -0,0 +1,69 @@
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+from multipart_upload import MultipartUploader
+
+
+class FakeBot:
+    """Чат в памяти: сообщения с file_id и удаление; альбом номер fail_album падает"""
+
+    def __init__(self, fail_album=None):
+        self.chat = {}
+        self.albums = 0
+        self.fail_album = fail_album
+        self._ids = itertools.count(1)
+
+    def _post(self, file_id, caption):
+        message_id = next(self._ids)
+
+        async def delete():
+            del self.chat[message_id]
+        message = SimpleNamespace(message_id=message_id, document=SimpleNamespace(file_id=file_id),
+                                  caption=caption, delete=delete)
+        self.chat[message_id] = message
+        return message
+
+    async def send_document(self, chat_id, document, caption=None, **kwargs):
+        file_id = document if isinstance(document, str) else f"file-{kwargs['filename']}"
+        return self._post(file_id, caption)
+
+    async def send_media_group(self, chat_id, media):
+        self.albums += 1
+        if self.albums == self.fail_album:
+            raise RuntimeError("Too Many Requests: retry after 30")
+        return [self._post(item.media, item.caption) for item in media]
+
+
+def make_parts(tmp_path, count):
+    paths = []
+    for index in range(1, count + 1):
+        path = tmp_path / f"video.part{index:02d}"
+        path.write_bytes(b'x' * 100)
+        paths.append(str(path))
+    return paths
+
+
+def captions(bot):
+    return sorted(message.caption for message in bot.chat.values())
+
+
+def test_parts_end_up_as_albums(tmp_path):
+    bot = FakeBot()
+    failed = asyncio.run(MultipartUploader(bot).deliver(1, make_parts(tmp_path, 12), 'Video'))
+    assert failed == []
+    assert bot.albums == 2
+    # Разрозненные сообщения удалены, каждая часть в чате ровно один раз
+    assert len(bot.chat) == 12
+    assert captions(bot) == sorted(f"📹 Video (часть {i}/12)" for i in range(1, 13))
+    assert min(bot.chat) > 12
+
+
+def test_failed_album_leaves_no_duplicates(tmp_path):
+    bot = FakeBot(fail_album=2)
+    failed = asyncio.run(MultipartUploader(bot).deliver(1, make_parts(tmp_path, 12), 'Video'))
+    assert failed == []
+    # Первый альбом уже ушел, второй упал: остаются исходные сообщения без повторов
+    assert len(bot.chat) == 12
+    assert captions(bot) == sorted(f"📹 Video (часть {i}/12)" for i in range(1, 13))
+    assert max(bot.chat) == 12
@@ -0,0 +1,63 @@
+import asyncio
+import gc
+
+import pytest
+
+from pipeline import Pipeline, Stage, JobCancelled
+
+
+def test_background_tasks_are_referenced_until_done():
+    async def scenario():
+        attempts = []
+
+        async def fetch(job):
+            attempts.append(job.payload)
+            return None
+
+        async def upload(job):
+            # Первая попытка возвращает задачу на раннюю стадию через фоновую задачу
+            return 'fetch' if len(attempts) == 1 else None
+
+        pipeline = Pipeline([Stage('fetch', fetch), Stage('upload', upload)])
+        spawned = []
+        spawn = pipeline._spawn
+
+        def tracked_spawn(coro):
+            task = spawn(coro)
+            spawned.append(task in pipeline._background)
+            gc.collect()
+            return task
+        pipeline._spawn = tracked_spawn
+
+        await pipeline.start()
+        job = await pipeline.submit('video')
+        assert await job.wait() == 'video'
+        assert spawned == [True]
+        assert attempts == ['video', 'video']
+        assert not pipeline._background
+        await pipeline.stop()
+
+    asyncio.run(scenario())
+
+
+def test_cancel_queued_job():
+    async def scenario():
+        release = asyncio.Event()
+
+        async def slow(job):
+            await release.wait()
+
+        pipeline = Pipeline([Stage('fetch', slow, workers=1, queue_size=2)])
+        await pipeline.start()
+        first = await pipeline.submit('first')
+        queued = await pipeline.submit('queued')
+        await asyncio.sleep(0)
+        queued.cancel()
+        with pytest.raises(JobCancelled):
+            await queued.wait()
+        assert not pipeline._background
+        release.set()
+        assert await first.wait() == 'first'
+        await pipeline.stop()
+
+    asyncio.run(scenario())
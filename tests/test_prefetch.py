@@ -0,0 +1,119 @@
+import os
+import time
+import threading
+
+import pytest
+
+from bandwidth import bandwidth_weight_var
+from prefetch import SpeculativePrefetcher, PrefetchCancelled
+
+URL = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+MB = 1024 * 1024
+
+
+class BlockingDownloader:
+    """Загрузчик, который качает, пока тест не откроет gate; колбэк вызывается на каждом куске"""
+
+    def __init__(self, work_dir, gate, weights):
+        self.work_dir = work_dir
+        self.gate = gate
+        self.weights = weights
+
+    def download_video(self, url, resolution, progress_callback):
+        self.weights.append(bandwidth_weight_var.get())
+        path = os.path.join(self.work_dir, f"{resolution}.mp4")
+        with open(path, 'wb') as f:
+            while not self.gate.wait(0.01):
+                progress_callback(None, b'x', 1)
+                f.write(b'x')
+        return path, 'Video'
+
+
+@pytest.fixture
+def gate():
+    gate = threading.Event()
+    yield gate
+    gate.set()
+
+
+def make_prefetcher(tmp_path, gate, weights=None, **kwargs):
+    weights = [] if weights is None else weights
+    return SpeculativePrefetcher(lambda work_dir: BlockingDownloader(work_dir, gate, weights),
+                                 work_dir=str(tmp_path / 'prefetch'), **kwargs)
+
+
+def start(prefetcher, user_id, size=10 * MB):
+    return prefetcher.start(user_id, URL, {}, ['720p', 'audio'], lambda resolution: size)
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_budget_counts_discarded_jobs_until_their_thread_stops(tmp_path, gate):
+    weights = []
+    prefetcher = make_prefetcher(tmp_path, gate, weights, max_jobs=1)
+    assert start(prefetcher, 1) == '720p'
+    wait_until(lambda: weights)
+    # Пользователь выбрал другой формат: загрузка отменена, но ее поток еще работает
+    assert prefetcher.claim(1, URL, 'audio') is None
+    assert start(prefetcher, 2) is None
+
+    gate.set()
+    wait_until(lambda: not prefetcher._in_flight)
+    assert start(prefetcher, 2) == '720p'
+
+
+def test_byte_budget_includes_claimed_jobs(tmp_path, gate):
+    prefetcher = make_prefetcher(tmp_path, gate, max_jobs=3, max_bytes=25 * MB)
+    assert start(prefetcher, 1) == '720p'
+    job = prefetcher.claim(1, URL, '720p')
+    assert job is not None and job.claimed
+    assert start(prefetcher, 2) == '720p'
+    # Забранная загрузка еще качается: 10 + 10 + 10 MB не влезают в 25 MB
+    assert start(prefetcher, 3) is None
+
+
+def test_claim_and_discard(tmp_path, gate):
+    weights = []
+    prefetcher = make_prefetcher(tmp_path, gate, weights)
+    start(prefetcher, 1)
+    start(prefetcher, 2)
+    wait_until(lambda: len(weights) == 2)
+
+    hit = prefetcher.claim(1, URL, '720p')
+    miss_job = prefetcher._jobs[2]
+    assert prefetcher.claim(2, URL, 'audio') is None
+    assert miss_job.cancel_event.is_set() and not hit.cancel_event.is_set()
+
+    # Отмененная загрузка прерывается колбэком, ее папка удаляется
+    with pytest.raises(PrefetchCancelled):
+        miss_job.future.result(timeout=2)
+    wait_until(lambda: not os.path.exists(miss_job.work_dir))
+
+    gate.set()
+    path, title = hit.future.result(timeout=2)
+    assert title == 'Video' and os.path.exists(path)
+
+
+def test_unclaimed_job_expires(tmp_path, gate):
+    prefetcher = make_prefetcher(tmp_path, gate, ttl=0.05)
+    start(prefetcher, 1)
+    job = prefetcher._jobs[1]
+    wait_until(job.cancel_event.is_set)
+    assert prefetcher.claim(1, URL, '720p') is None
+    wait_until(job.future.done)
+    wait_until(lambda: not prefetcher._in_flight)
+    wait_until(lambda: not os.path.exists(job.work_dir))
+
+
+def test_prefetch_runs_with_lower_bandwidth_weight(tmp_path, gate):
+    weights = []
+    prefetcher = make_prefetcher(tmp_path, gate, weights, bandwidth_weight=0.25)
+    start(prefetcher, 1)
+    wait_until(lambda: weights)
+    assert weights == [0.25]
+    assert bandwidth_weight_var.get() == 1.0
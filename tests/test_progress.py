@@ -0,0 +1,37 @@
+from progress import ProgressTracker
+
+MB = 1024 * 1024
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_second_file_restarts_byte_count():
+    clock = FakeClock()
+    events = []
+    tracker = ProgressTracker(events.append, min_interval=0.5, min_bytes=MB, clock=clock)
+
+    # Видео: 10 MB за 10 секунд
+    for second in range(1, 11):
+        clock.now = second
+        tracker.ydl_hook({'status': 'downloading', 'downloaded_bytes': second * MB, 'total_bytes': 10 * MB})
+    tracker.ydl_hook({'status': 'finished', 'downloaded_bytes': 10 * MB, 'total_bytes': 10 * MB})
+    video_events = len(events)
+
+    # Аудио: счетчик yt-dlp начинается с нуля, 2 MB в секунду
+    clock.now = 10.5
+    tracker.ydl_hook({'status': 'downloading', 'downloaded_bytes': 64 * 1024, 'total_bytes': 8 * MB})
+    for second in range(1, 5):
+        clock.now = 10.5 + second
+        tracker.ydl_hook({'status': 'downloading', 'downloaded_bytes': 64 * 1024 + second * 2 * MB,
+                          'total_bytes': 8 * MB})
+
+    audio = events[video_events:]
+    assert len(audio) == 4
+    assert all(event.speed == 2 * MB for event in audio)
+    assert [event.done for event in audio] == [64 * 1024 + i * 2 * MB for i in range(1, 5)]
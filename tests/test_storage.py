@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+from storage import MediaStorage, LocalStorage, S3Storage, media_key, restore, save
+
+MB = 1024 * 1024
+BUCKET = 'media'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    boto3 = pytest.importorskip('boto3')
+    moto = pytest.importorskip('moto')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.delenv('AWS_PROFILE', raising=False)
+    with moto.mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BUCKET)
+        yield S3Storage(BUCKET, prefix='cache', region='us-east-1', part_size=5 * MB)
+
+
+def make_file(path, size):
+    data = os.urandom(size)
+    path.write_bytes(data)
+    return str(path), data
+
+
+def test_media_storage_is_abstract():
+    with pytest.raises(TypeError):
+        MediaStorage()
+
+
+def test_s3_multipart_roundtrip(s3, tmp_path):
+    source, data = make_file(tmp_path / 'Видео.mp4', 11 * MB)
+    key = media_key('dQw4w9WgXcQ', '720p')
+    assert save(s3, key, (source, 'Видео — тест')) == (source, 'Видео — тест')
+
+    stored = s3.stat(key)
+    assert stored.size == len(data)
+    assert stored.metadata == {'title': 'Видео — тест', 'filename': 'Видео.mp4'}
+    assert s3.read_range(key, 5 * MB - 2, 5 * MB + 1) == data[5 * MB - 2:5 * MB + 2]
+
+    restore_dir = tmp_path / 'restored'
+    restore_dir.mkdir()
+    path, title = restore(s3, key, str(restore_dir))
+    assert title == 'Видео — тест'
+    assert path.endswith('.mp4')
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+    s3.delete(key)
+    assert s3.stat(key) is None
+
+
+def test_s3_small_object_and_failed_write(s3):
+    key = media_key('dQw4w9WgXcQ', 'audio', transform='mp3')
+    with s3.open_writer(key, {'title': 't'}) as writer:
+        writer.write(b'abc')
+    assert s3.read_range(key, 0, 2) == b'abc'
+
+    broken = media_key('dQw4w9WgXcQ', '1080p')
+    with pytest.raises(RuntimeError):
+        with s3.open_writer(broken) as writer:
+            writer.write(b'x' * (6 * MB))
+            raise RuntimeError("download interrupted")
+    # Незавершенная multipart-загрузка отменена, объекта нет
+    assert s3.stat(broken) is None
+    uploads = s3._client.list_multipart_uploads(Bucket=BUCKET)
+    assert not uploads.get('Uploads')
+
+
+def test_local_storage_roundtrip(tmp_path):
+    storage = LocalStorage(str(tmp_path / 'storage'))
+    source, data = make_file(tmp_path / 'clip.mp4', 3 * MB + 7)
+    key = media_key('dQw4w9WgXcQ', '360p', (10, 20))
+    save(storage, key, (source, 'Clip'))
+    assert storage.stat(key).size == len(data)
+
+    path, title = restore(storage, key, str(tmp_path))
+    assert title == 'Clip' and path != source
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    storage.delete(key)
+    assert storage.stat(key) is None
@@ -0,0 +1,181 @@
+import io
+import time
+import threading
+from types import SimpleNamespace
+
+import pytest
+from pytubefix.query import StreamQuery
+
+import downloader_pytubefix
+from downloader_pytubefix import StreamSelection, YouTubeDownloader
+
+
+def make_stream(itag, resolution=None, abr=None, progressive=False, audio=False, expire=None):
+    expire = expire or int(time.time()) + 6 * 3600
+    return SimpleNamespace(
+        itag=itag, resolution=resolution, abr=abr, subtype='mp4', mime_type='video/mp4',
+        is_progressive=progressive, is_adaptive=not progressive,
+        includes_audio_track=progressive or audio, includes_video_track=resolution is not None,
+        url=f"https://rr1.googlevideo.com/videoplayback?itag={itag}&expire={expire}",
+        filesize=1000 * itag, default_filename=f"{itag}.mp4"
+    )
+
+
+def make_info(expire=None):
+    streams = StreamQuery([
+        make_stream(18, '360p', progressive=True, expire=expire),
+        make_stream(137, '1080p', expire=expire),
+        make_stream(140, abr='128kbps', audio=True, expire=expire),
+    ])
+    yt = SimpleNamespace(title='Video', streams=streams)
+    return {'title': 'Video', 'duration': 60, 'view_count': 1, 'streams': streams, 'youtube': yt}
+
+
+@pytest.fixture
+def downloader(tmp_path, monkeypatch):
+    monkeypatch.setenv('METADATA_CACHE_ENABLED', '0')
+    return YouTubeDownloader(download_dir=str(tmp_path))
+
+
+def test_selection_reuses_video_info(downloader, monkeypatch):
+    def no_extraction(url):
+        raise AssertionError("YouTube(url) must not be called again")
+    monkeypatch.setattr(downloader_pytubefix, 'YouTube', no_extraction)
+
+    info = make_info()
+    selection = downloader.select_streams('https://youtu.be/dQw4w9WgXcQ', '360p', info)
+    assert [stream.itag for stream in selection.streams] == [18]
+    stream = downloader.resolve_direct_stream('https://youtu.be/dQw4w9WgXcQ', '360p', selection)
+    assert stream.size == 18000 and stream.title == 'Video'
+
+    merged = downloader.select_streams('https://youtu.be/dQw4w9WgXcQ', '1080p', info)
+    assert [stream.itag for stream in merged.streams] == [137, 140]
+    # Пару для слияния нельзя отдать ссылкой или скачать в память
+    assert downloader.resolve_direct_stream('https://youtu.be/dQw4w9WgXcQ', '1080p', merged) is None
+    assert downloader.download_to_buffer('https://youtu.be/dQw4w9WgXcQ', '1080p', selection=merged) is None
+
+
+def test_selection_extracts_again_when_urls_expire(downloader, monkeypatch):
+    fresh = make_info()
+    calls = []
+
+    def extract(url):
+        calls.append(url)
+        return fresh['youtube']
+    monkeypatch.setattr(downloader_pytubefix, 'YouTube', extract)
+
+    stale = make_info(expire=int(time.time()) + 60)
+    selection = downloader.select_streams('https://youtu.be/dQw4w9WgXcQ', '360p', stale)
+    assert calls == ['https://youtu.be/dQw4w9WgXcQ']
+    assert selection.yt is fresh['youtube']
+
+
+def test_cancel_event_stops_in_memory_download(downloader):
+    cancel_event = threading.Event()
+    written = []
+
+    class FakeYouTube:
+        def register_on_progress_callback(self, callback):
+            self.on_progress = callback
+
+    def stream_to_buffer(buffer):
+        # Как pytubefix: колбэк после каждого куска, исключение из него прерывает загрузку
+        for remaining in range(9, -1, -1):
+            buffer.write(b'x' * 100)
+            written.append(remaining)
+            if remaining == 7:
+                cancel_event.set()
+            yt.on_progress(stream, b'x' * 100, remaining * 100)
+
+    yt = FakeYouTube()
+    stream = SimpleNamespace(itag=18, filesize=1000, default_filename='18.mp4', stream_to_buffer=stream_to_buffer)
+    selection = StreamSelection(yt, 'Video', [stream])
+    result = downloader.download_to_buffer('https://youtu.be/dQw4w9WgXcQ', '360p', selection=selection,
+                                           cancel_event=cancel_event)
+    assert result is None
+    assert written == [9, 8, 7]
+
+
+def test_audio_clip_bitrate_follows_clip_length(downloader, monkeypatch):
+    commands = []
+
+    class RecordingTranscoder:
+        def run(self, command, priority):
+            commands.append(command.get_args())
+            raise RuntimeError("ffmpeg is not called in tests")
+    monkeypatch.setattr(downloader_pytubefix, 'get_transcoder', RecordingTranscoder)
+
+    selection = downloader.select_streams('https://youtu.be/dQw4w9WgXcQ', 'audio', make_info())
+    for start, end in ((0, 60), (0, 3 * 3600)):
+        assert downloader.download_clip('https://youtu.be/dQw4w9WgXcQ', 'audio', start, end, selection) is None
+    # Короткий фрагмент - обычные 64 kbps, трехчасовой - сколько влезет в лимит отправки
+    assert [args[args.index('-b:a') + 1] for args in commands] == ['64k', '32k']
+
+
+def real_stream(itag, mime, width=None, height=None, expire=None):
+    """Настоящий Stream pytubefix из данных формата, без сети"""
+    expire = expire or int(time.time()) + 6 * 3600
+    data = {'url': f"https://rr1.googlevideo.com/videoplayback?itag={itag}&expire={expire}", 'itag': itag,
+            'mimeType': mime, 'is_otf': False, 'bitrate': 500000, 'contentLength': str(1000 * itag),
+            'approxDurationMs': '60000', 'lastModified': '1700000000000000'}
+    if width:
+        data.update(width=width, height=height, fps=30)
+    return data
+
+
+def test_pytubefix_selection_uses_stream_url_cache(tmp_path, monkeypatch):
+    from pytubefix import Stream
+    from pytubefix.monostate import Monostate
+    from metadata_cache import MetadataCache
+
+    monostate = Monostate(on_progress=None, on_complete=None, title='Video', duration=60)
+    streams = StreamQuery([
+        Stream(real_stream(18, 'video/mp4; codecs="avc1.42001E, mp4a.40.2"', 640, 360), monostate, None, None),
+        Stream(real_stream(140, 'audio/mp4; codecs="mp4a.40.2"'), monostate, None, None),
+    ])
+    extractions = []
+
+    def extract(url):
+        extractions.append(url)
+        return SimpleNamespace(title='Video', length=60, streams=streams)
+    monkeypatch.setattr(downloader_pytubefix, 'YouTube', extract)
+
+    downloader = YouTubeDownloader(download_dir=str(tmp_path), metadata_cache=MetadataCache(str(tmp_path / 'm.db')))
+    first = downloader.select_streams('https://youtu.be/dQw4w9WgXcQ', '360p')
+    # Второй доставке (другой процесс или после перезапуска) извлечение не нужно
+    other = YouTubeDownloader(download_dir=str(tmp_path), metadata_cache=MetadataCache(str(tmp_path / 'm.db')))
+    cached = other.select_streams('https://youtu.be/dQw4w9WgXcQ', '360p')
+    audio = other.select_streams('https://youtu.be/dQw4w9WgXcQ', 'audio')
+    assert len(extractions) == 1
+
+    stream, = cached.streams
+    assert (stream.itag, stream.url, stream.filesize) == (18, first.streams[0].url, 18000)
+    assert stream.default_filename == 'Video.mp4' and cached.title == 'Video'
+    assert cached.frame_size() == (640, 360)
+    assert [s.itag for s in audio.streams] == [140]
+    # Колбэк прогресса регистрируется так же, как у YouTube
+    seen = []
+    cached.yt.register_on_progress_callback(lambda *args: seen.append(args[2]))
+    stream.on_progress(b'x', io.BytesIO(), 17999)
+    assert seen == [17999]
+
+
+def test_expiring_cached_stream_urls_are_extracted_again(tmp_path, monkeypatch):
+    from pytubefix import Stream
+    from pytubefix.monostate import Monostate
+    from metadata_cache import MetadataCache
+
+    monostate = Monostate(on_progress=None, on_complete=None, title='Video', duration=60)
+    mime = 'video/mp4; codecs="avc1.42001E, mp4a.40.2"'
+    streams = StreamQuery([Stream(real_stream(18, mime, 640, 360, expire=int(time.time()) + 60), monostate, None, None)])
+    extractions = []
+
+    def extract(url):
+        extractions.append(url)
+        return SimpleNamespace(title='Video', length=60, streams=streams)
+    monkeypatch.setattr(downloader_pytubefix, 'YouTube', extract)
+
+    downloader = YouTubeDownloader(download_dir=str(tmp_path), metadata_cache=MetadataCache(str(tmp_path / 'm.db')))
+    downloader.select_streams('https://youtu.be/dQw4w9WgXcQ', '360p')
+    downloader.select_streams('https://youtu.be/dQw4w9WgXcQ', '360p')
+    assert len(extractions) == 2
@@ -0,0 +1,44 @@
+import os
+import shutil
+
+import ffmpeg
+import pytest
+
+from transcoder import TranscodeService, TranscodeJob, encode_mp3_bytes, mp3_frames
+
+
+@pytest.fixture
+def service():
+    service = TranscodeService(max_workers=1, threads_per_job=3, nice=5)
+    yield service
+    service.shutdown()
+
+
+def test_thread_budget_before_output_with_overwrite(service):
+    args = service._apply_thread_budget(
+        ffmpeg.compile(ffmpeg.input('in.mp4').output('out.mp3', acodec='mp3').overwrite_output())
+    )
+    assert args[-1] == '-y'
+    assert args[args.index('-threads'):] == ['-threads', '3', 'out.mp3', '-y']
+
+
+def test_thread_budget_keeps_explicit_threads(service):
+    args = ffmpeg.compile(ffmpeg.input('in.mp4').output('out.mp4', threads=1))
+    assert service._apply_thread_budget(args) == args
+
+
+@pytest.mark.skipif(not hasattr(os, 'setpriority'), reason="POSIX only")
+def test_child_runs_with_lower_priority(service):
+    job = TranscodeJob(['sh', '-c', 'sleep 0.2; ps -o ni= -p $$'], priority=0, timeout=10)
+    niceness = int(service._execute(job).strip())
+    assert niceness == min(19, os.getpriority(os.PRIO_PROCESS, 0) + 5)
+
+
+@pytest.mark.skipif(not shutil.which('ffmpeg'), reason="ffmpeg not installed")
+def test_mp3_bytes_bitrate_follows_duration():
+    wav = (ffmpeg.input('sine=frequency=440:duration=2', format='lavfi')
+           .output('pipe:1', format='wav').run(capture_stdout=True, quiet=True)[0])
+    # Час звука в лимит 1 MB влезает только на минимальном битрейте
+    data = encode_mp3_bytes(wav, duration=3600, limit=1024 * 1024)
+    frames = mp3_frames(data[data.index(b'\xff\xfb'):])
+    assert frames and {length for _, length in frames} <= {104, 105}
@@ -0,0 +1,41 @@
+import pytest
+
+from youtube_utils import clamp_clip, parse_clip_request, parse_timestamp
+
+URL = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+
+
+@pytest.mark.parametrize('text, seconds', [
+    ('90', 90), ('1:30', 90), ('1:02:03', 3723), ('1h2m3s', 3723), ('2m', 120), ('12.5s', 12.5), ('abc', None),
+])
+def test_parse_timestamp(text, seconds):
+    assert parse_timestamp(text) == seconds
+
+
+@pytest.mark.parametrize('message, clip', [
+    (f"{URL} 1:02:03-1:05:00", (3723, 3900)),
+    (f"{URL} 1:23 2:45", (83, 165)),
+    (f"{URL}&t=83 2:45", (83, 165)),
+    (f"{URL} 0:30–1:00", (30, 60)),
+    (URL, None),
+    # Конец не позже начала и лишний текст - не фрагмент
+    (f"{URL} 2:45-1:23", None),
+    (f"{URL} 1:23-1:23", None),
+    (f"{URL} 1:23 2:45 3:00", None),
+    (f"{URL} hello", None),
+])
+def test_parse_clip_request(message, clip):
+    url, parsed = parse_clip_request(message)
+    assert url == message.split()[0]
+    assert parsed == clip
+
+
+def test_clip_is_clamped_to_duration():
+    assert clamp_clip((60, 600), 212) == (60, 212)
+    assert clamp_clip((60, 120), 212) == (60, 120)
+    # Начало за концом видео: фрагмента нет, отдается целиком
+    assert clamp_clip((300, 400), 212) is None
+    assert clamp_clip((212, 400), 212) is None
+    # Длительность неизвестна - границы не трогаем
+    assert clamp_clip((60, 600), 0) == (60, 600)
+    assert clamp_clip(None, 212) is None
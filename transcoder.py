@@ -0,0 +1,653 @@
+import os
+import time
+import heapq
+import shutil
+import tempfile
+import asyncio
+import logging
+import itertools
+import threading
+import subprocess
+from concurrent.futures import Future
+from typing import Optional, List, Tuple
+
+import ffmpeg
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты задач: чем меньше число, тем раньше задача попадет в работу
+PRIORITY_AUDIO = 0
+PRIORITY_VIDEO = 10
+PRIORITY_BACKGROUND = 20
+
+# Глобальные флаги, которые ffmpeg-python ставит после имени выходного файла
+TRAILING_GLOBAL_FLAGS = ('-y', '-n')
+
+
+class TranscodeError(Exception):
+    """Ошибка выполнения ffmpeg с сохраненным stderr"""
+
+    def __init__(self, message: str, returncode: Optional[int] = None, stderr: str = '',
+                 reason: str = 'failed', cmd: Optional[List[str]] = None):
+        super().__init__(message)
+        self.returncode = returncode
+        self.stderr = stderr
+        self.reason = reason  # failed / timeout / cancelled / not_found
+        self.cmd = cmd or []
+
+    @property
+    def summary(self) -> str:
+        """Последние содержательные строки stderr"""
+        lines = [line.strip() for line in self.stderr.splitlines() if line.strip()]
+        return ' | '.join(lines[-3:])
+
+    def __str__(self):
+        base = super().__str__()
+        if self.summary:
+            return f"{base}: {self.summary}"
+        return base
+
+
+class TranscodeJob:
+    """Задача ffmpeg в очереди пула"""
+
+    def __init__(self, args: List[str], priority: int, timeout: Optional[float],
+                 input_data: Optional[bytes] = None):
+        self.args = args
+        self.priority = priority
+        self.timeout = timeout
+        self.input_data = input_data
+        self.future = Future()
+        self.process = None
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """Отменяет задачу: из очереди убирает, запущенный ffmpeg убивает"""
+        with self._lock:
+            self.cancelled = True
+            process = self.process
+        if process and process.poll() is None:
+            logger.info(f"Killing ffmpeg process {process.pid}")
+            process.kill()
+        self.future.cancel()
+
+    def result(self, timeout: Optional[float] = None) -> bytes:
+        return self.future.result(timeout)
+
+
+class TranscodeService:
+    """Ограниченный пул процессов ffmpeg с приоритетами"""
+
+    def __init__(self, max_workers: Optional[int] = None, threads_per_job: Optional[int] = None,
+                 nice: int = 0, default_timeout: Optional[float] = 3600):
+        cpu_count = os.cpu_count() or 1
+        self.max_workers = max_workers or max(1, cpu_count // 2)
+        self.threads_per_job = threads_per_job or max(1, cpu_count // self.max_workers)
+        self.nice = nice
+        self.default_timeout = default_timeout
+
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._workers = []
+        self._shutdown = False
+
+        for i in range(self.max_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"ffmpeg-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+        logger.info(f"Transcode pool started: {self.max_workers} workers, "
+                    f"{self.threads_per_job} threads per job, nice={self.nice}")
+
+    def submit(self, stream, priority: int = PRIORITY_VIDEO, timeout: Optional[float] = None,
+               input_data: Optional[bytes] = None) -> TranscodeJob:
+        """Ставит ffmpeg-python стрим в очередь и возвращает задачу"""
+        args = self._apply_thread_budget(ffmpeg.compile(stream))
+        job = TranscodeJob(args, priority, timeout or self.default_timeout, input_data)
+
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Transcode service is shut down")
+            heapq.heappush(self._queue, (priority, next(self._counter), job))
+            self._condition.notify()
+        return job
+
+    def run(self, stream, priority: int = PRIORITY_VIDEO, timeout: Optional[float] = None,
+            input_data: Optional[bytes] = None) -> bytes:
+        """Выполняет задачу синхронно и возвращает stdout"""
+        job = self.submit(stream, priority, timeout, input_data)
+        try:
+            return job.result()
+        except BaseException:
+            job.cancel()
+            raise
+
+    async def run_async(self, stream, priority: int = PRIORITY_VIDEO, timeout: Optional[float] = None,
+                        input_data: Optional[bytes] = None) -> bytes:
+        """Асинхронный вариант run: отмена корутины убивает ffmpeg"""
+        job = self.submit(stream, priority, timeout, input_data)
+        try:
+            return await asyncio.wrap_future(job.future)
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+
+    def queue_size(self) -> int:
+        with self._condition:
+            return len(self._queue)
+
+    def shutdown(self):
+        with self._condition:
+            self._shutdown = True
+            pending = [job for _, _, job in self._queue]
+            self._queue.clear()
+            self._condition.notify_all()
+        for job in pending:
+            job.cancel()
+
+    def _apply_thread_budget(self, args: List[str]) -> List[str]:
+        # -threads - опция выходного файла: ffmpeg учитывает ее только перед именем выхода,
+        # а опции после последнего выхода игнорирует
+        if '-threads' in args:
+            return args
+        position = len(args) - 1
+        # overwrite_output() дописывает глобальный -y уже после имени выхода
+        while position > 0 and args[position] in TRAILING_GLOBAL_FLAGS:
+            position -= 1
+        return args[:position] + ['-threads', str(self.threads_per_job)] + args[position:]
+
+    def _lower_priority(self, pid: int):
+        # preexec_fn небезопасен в процессе с потоками, поэтому приоритет
+        # понижаем уже запущенному ffmpeg
+        if not self.nice or not hasattr(os, 'setpriority'):
+            return
+        try:
+            niceness = min(19, os.getpriority(os.PRIO_PROCESS, 0) + self.nice)
+            os.setpriority(os.PRIO_PROCESS, pid, niceness)
+        except OSError as e:
+            logger.warning(f"Cannot lower ffmpeg priority: {e}")
+
+    def _worker_loop(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._shutdown:
+                    self._condition.wait()
+                if self._shutdown:
+                    return
+                _, _, job = heapq.heappop(self._queue)
+
+            if job.cancelled or not job.future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                job.future.set_result(self._execute(job))
+            except Exception as e:
+                job.future.set_exception(e)
+
+    def _execute(self, job: TranscodeJob) -> bytes:
+        try:
+            with job._lock:
+                if job.cancelled:
+                    raise TranscodeError("ffmpeg job cancelled", reason='cancelled', cmd=job.args)
+                job.process = subprocess.Popen(
+                    job.args,
+                    stdin=subprocess.PIPE if job.input_data is not None else subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE
+                )
+                self._lower_priority(job.process.pid)
+        except FileNotFoundError as e:
+            raise TranscodeError(f"ffmpeg not found: {e}", reason='not_found', cmd=job.args)
+
+        process = job.process
+        try:
+            stdout, stderr = process.communicate(job.input_data, timeout=job.timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            _, stderr = process.communicate()
+            raise TranscodeError(f"ffmpeg timed out after {job.timeout}s", returncode=process.returncode,
+                                 stderr=stderr.decode(errors='replace'), reason='timeout', cmd=job.args)
+
+        stderr_text = stderr.decode(errors='replace')
+        if job.cancelled:
+            raise TranscodeError("ffmpeg job cancelled", returncode=process.returncode,
+                                 stderr=stderr_text, reason='cancelled', cmd=job.args)
+        if process.returncode != 0:
+            raise TranscodeError(f"ffmpeg exited with code {process.returncode}",
+                                 returncode=process.returncode, stderr=stderr_text, cmd=job.args)
+        return stdout
+
+
+_transcoder = None
+_transcoder_lock = threading.Lock()
+
+
+def get_transcoder() -> TranscodeService:
+    """Общий пул ffmpeg для всех загрузчиков, настраивается через переменные окружения"""
+    global _transcoder
+    with _transcoder_lock:
+        if _transcoder is None:
+            timeout = float(os.getenv('FFMPEG_TIMEOUT', '3600'))
+            _transcoder = TranscodeService(
+                max_workers=int(os.getenv('FFMPEG_MAX_WORKERS', '0')) or None,
+                threads_per_job=int(os.getenv('FFMPEG_THREADS', '0')) or None,
+                nice=int(os.getenv('FFMPEG_NICE', '10')),
+                default_timeout=timeout or None
+            )
+        return _transcoder
+
+
+# Кодеки, которые можно положить в MP4 без перекодирования
+MP4_VIDEO_CODECS = {'h264', 'hevc', 'av1', 'mpeg4'}
+MP4_AUDIO_CODECS = {'aac', 'mp3', 'alac'}
+
+# Флаги muxer'а MP4: moov в начале файла либо фрагментированный MP4
+FASTSTART_MOVFLAGS = '+faststart'
+FRAGMENTED_MOVFLAGS = '+frag_keyframe+empty_moov+default_base_moof'
+
+
+def probe_codec(path: str, codec_type: str) -> Optional[str]:
+    """Возвращает имя кодека первой дорожки указанного типа (video/audio)"""
+    try:
+        info = ffmpeg.probe(path, select_streams=codec_type[0])
+        for stream in info.get('streams', []):
+            if stream.get('codec_type') == codec_type:
+                return stream.get('codec_name')
+    except ffmpeg.Error as e:
+        logger.warning(f"ffprobe failed for {path}: {e.stderr.decode(errors='replace') if e.stderr else e}")
+    except Exception as e:
+        logger.warning(f"Error probing {path}: {e}")
+    return None
+
+
+# Префиксы строк codecs из mimeType YouTube (avc1.640028, mp4a.40.2) -> имена ffprobe
+CODEC_FAMILIES = {'avc1': 'h264', 'avc3': 'h264', 'hev1': 'hevc', 'hvc1': 'hevc', 'av01': 'av1',
+                  'vp9': 'vp9', 'vp09': 'vp9', 'mp4a': 'aac', 'opus': 'opus', 'vorbis': 'vorbis'}
+
+
+def codec_family(codec: Optional[str]) -> Optional[str]:
+    """Имя кодека в терминах ffprobe по строке codecs из манифеста"""
+    if not codec:
+        return None
+    return CODEC_FAMILIES.get(codec.split('.', 1)[0].lower())
+
+
+def mp4_merge_codecs(video_codec: Optional[str], audio_codec: Optional[str]) -> dict:
+    """Параметры ffmpeg для слияния в MP4: copy для совместимых дорожек, иначе перекодирование"""
+    params = {
+        'vcodec': 'copy' if video_codec in MP4_VIDEO_CODECS else 'libx264',
+        'acodec': 'copy' if audio_codec in MP4_AUDIO_CODECS else 'aac',
+    }
+    if params['vcodec'] != 'copy':
+        params['preset'] = 'veryfast'
+        params['crf'] = 23
+    if params['acodec'] != 'copy':
+        params['audio_bitrate'] = '160k'
+    return params
+
+
+# Миниатюра для Telegram: JPEG не больше 320 px по каждой стороне и 200 KB
+THUMBNAIL_SIZE = 320
+THUMBNAIL_QUALITY = 5
+# Боксы верхнего уровня MP4, после которых moov уже не ищем
+MP4_MAX_TOP_BOXES = 64
+
+
+class MediaInfo:
+    """Параметры готового файла для отправки в Telegram"""
+
+    def __init__(self, duration: Optional[float] = None, width: Optional[int] = None,
+                 height: Optional[int] = None, faststart: Optional[bool] = None):
+        self.duration = duration
+        self.width = width
+        self.height = height
+        # None - не MP4/MOV, проверять положение moov не нужно
+        self.faststart = faststart
+
+    def send_kwargs(self) -> dict:
+        """Параметры send_video/send_audio, которые удалось определить"""
+        params = {'duration': int(round(self.duration)) if self.duration else None,
+                  'width': self.width, 'height': self.height}
+        return {name: value for name, value in params.items() if value}
+
+
+def mp4_faststart(file) -> Optional[bool]:
+    """Стоит ли moov перед данными (mdat/moof) в MP4 из открытого бинарного файла.
+
+    Читаются только заголовки боксов верхнего уровня. None - файл не похож на MP4.
+    """
+    offset = 0
+    for _ in range(MP4_MAX_TOP_BOXES):
+        file.seek(offset)
+        header = file.read(8)
+        if len(header) < 8:
+            return None
+        size = int.from_bytes(header[:4], 'big')
+        box = header[4:8]
+        if not box.isalnum():
+            return None
+        if box == b'moov':
+            return True
+        if box in (b'mdat', b'moof'):
+            return False
+        if size == 1:
+            size = int.from_bytes(file.read(8), 'big')
+        if size < 8:
+            # size 0 - бокс до конца файла, дальше moov быть не может
+            return None
+        offset += size
+    return None
+
+
+def probe_media(path: str, duration_hint: Optional[float] = None) -> MediaInfo:
+    """Один вызов ffprobe на файл: длительность, размер кадра и положение moov.
+
+    duration_hint - длительность из метаданных источника; она нужна, когда контейнер
+    ее не хранит (фрагментированный MP4) или ffprobe недоступен.
+    """
+    info = MediaInfo(duration=duration_hint)
+    try:
+        data = ffmpeg.probe(path)
+        container = data.get('format', {})
+        info.duration = float(container.get('duration') or 0) or duration_hint
+        video = next((s for s in data.get('streams', []) if s.get('codec_type') == 'video'
+                      and not s.get('disposition', {}).get('attached_pic')), None)
+        if video:
+            info.width = int(video.get('width') or 0) or None
+            info.height = int(video.get('height') or 0) or None
+        if 'mp4' in container.get('format_name', '') or 'mov' in container.get('format_name', ''):
+            with open(path, 'rb') as f:
+                info.faststart = mp4_faststart(f)
+    except ffmpeg.Error as e:
+        logger.warning(f"ffprobe failed for {path}: {e.stderr.decode(errors='replace') if e.stderr else e}")
+    except Exception as e:
+        logger.warning(f"Error probing {path}: {e}")
+    return info
+
+
+def remux_faststart(path: str, output_path: Optional[str] = None,
+                    priority: int = PRIORITY_AUDIO) -> Optional[str]:
+    """Копия файла с moov в начале: дорожки копируются без перекодирования"""
+    output_path = output_path or path.rsplit('.', 1)[0] + '.faststart.mp4'
+    try:
+        get_transcoder().run(
+            ffmpeg.input(path).output(output_path, c='copy', movflags=FASTSTART_MOVFLAGS).overwrite_output(),
+            priority=priority
+        )
+        return output_path
+    except Exception as e:
+        logger.error(f"Faststart remux failed for {path}: {e}")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return None
+
+
+def thumbnail_time(duration: Optional[float]) -> float:
+    # Первый кадр часто черный или заставка
+    return min(duration / 10, 10.0) if duration else 0.0
+
+
+def make_thumbnail(path: str, at: float = 0.0, input_data: Optional[bytes] = None,
+                   priority: int = PRIORITY_AUDIO) -> Optional[bytes]:
+    """JPEG-миниатюра кадра на секунде at; input_data - файл в памяти вместо path"""
+    source = 'pipe:0' if input_data is not None else path
+    try:
+        data = get_transcoder().run(
+            ffmpeg.input(source, ss=at)
+            .output('pipe:1', format='mjpeg', vframes=1,
+                    vf=f"scale={THUMBNAIL_SIZE}:{THUMBNAIL_SIZE}:force_original_aspect_ratio=decrease",
+                    **{'q:v': THUMBNAIL_QUALITY}),
+            priority=priority,
+            input_data=input_data
+        )
+    except Exception as e:
+        logger.warning(f"Thumbnail failed for {path}: {e}")
+        return None
+    return data or None
+
+
+# MP3 (MPEG-1 Layer III, 44.1 kHz): битрейт выбирается по длительности, чтобы файл
+# сразу влез в лимит отправки, а длинные записи кодируются сегментами параллельно
+MP3_BITRATES = (32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+MP3_DEFAULT_BITRATE = 64
+MP3_SAMPLE_RATE = 44100
+MP3_FRAME_SAMPLES = 1152
+MP3_SIZE_MARGIN = 0.97
+MP3_DELIVERY_LIMIT = 50 * 1024 * 1024
+# Записи короче кодируются одним процессом; переопределяется MP3_PARALLEL_MIN_SECONDS
+MP3_PARALLEL_MIN_SECONDS = 600
+MP3_MIN_SEGMENT_SECONDS = 120
+# Сегмент кодируется с запасом кадров до и после своего участка: кодировщик успевает
+# разогнаться на настоящем звуке, а задержка кодека одинакова во всех сегментах,
+# поэтому лишние кадры отбрасываются ровно по границе кадра
+MP3_LEAD_FRAMES = 2
+MP3_TAIL_FRAMES = 2
+
+
+def mp3_bitrate(duration: Optional[float], limit: int = MP3_DELIVERY_LIMIT,
+                preferred: int = MP3_DEFAULT_BITRATE) -> int:
+    """Наибольший стандартный битрейт (kbps) не выше preferred, при котором файл влезет в limit"""
+    if not duration:
+        return preferred
+    budget = limit * 8 * MP3_SIZE_MARGIN / duration / 1000
+    fitting = [rate for rate in MP3_BITRATES if rate <= min(budget, preferred)]
+    # Даже 32 kbps не влезает - такой файл все равно уйдет ссылкой, а не в Telegram
+    return fitting[-1] if fitting else MP3_BITRATES[0]
+
+
+def mp3_frames(data: bytes) -> List[Tuple[int, int]]:
+    """(смещение, длина) кадров MPEG-1 Layer III в потоке без тегов"""
+    frames = []
+    offset = 0
+    while offset + 4 <= len(data):
+        header = int.from_bytes(data[offset:offset + 4], 'big')
+        # Синхрослово, MPEG-1, Layer III
+        if header & 0xFFFE0000 != 0xFFFA0000:
+            break
+        bitrate = MP3_BITRATES[((header >> 12) & 0xF) - 1] * 1000 if 0 < (header >> 12) & 0xF < 15 else 0
+        sample_rate = (44100, 48000, 32000, 0)[(header >> 10) & 0x3]
+        if not bitrate or not sample_rate:
+            break
+        length = 144 * bitrate // sample_rate + ((header >> 9) & 0x1)
+        frames.append((offset, length))
+        offset += length
+    return frames
+
+
+def _mp3_output(stream, bitrate: int, **params):
+    return stream.output('pipe:1', format='mp3', acodec='libmp3lame', audio_bitrate=f"{bitrate}k",
+                         ar=MP3_SAMPLE_RATE, vn=None, write_xing=0, id3v2_version=0, **params)
+
+
+def encode_mp3_parallel(path: str, output_path: str, duration: float, bitrate: int,
+                        segments: int, priority: int = PRIORITY_AUDIO):
+    """Кодирует сегменты по времени параллельно в пуле ffmpeg и склеивает кадры без перекодирования.
+
+    Битовый резервуар выключен, поэтому каждый кадр независим и склейка по границам
+    кадров не дает ни пауз, ни щелчков.
+    """
+    transcoder = get_transcoder()
+    total_frames = int(duration * MP3_SAMPLE_RATE / MP3_FRAME_SAMPLES) + 1
+    bounds = [total_frames * i // segments for i in range(segments + 1)]
+    jobs = []
+    try:
+        for index in range(segments):
+            lead = MP3_LEAD_FRAMES if index else 0
+            start = (bounds[index] - lead) * MP3_FRAME_SAMPLES / MP3_SAMPLE_RATE
+            params = {'reservoir': 0}
+            if index < segments - 1:
+                span = bounds[index + 1] - bounds[index] + lead + MP3_TAIL_FRAMES
+                params['t'] = span * MP3_FRAME_SAMPLES / MP3_SAMPLE_RATE
+            jobs.append(transcoder.submit(_mp3_output(ffmpeg.input(path, ss=start), bitrate, **params),
+                                          priority=priority))
+
+        with open(output_path, 'wb') as output:
+            for index, job in enumerate(jobs):
+                data = job.result()
+                frames = mp3_frames(data)
+                first = MP3_LEAD_FRAMES if index else 0
+                last = first + bounds[index + 1] - bounds[index] if index < segments - 1 else len(frames)
+                kept = frames[first:last]
+                if not kept:
+                    raise TranscodeError(f"MP3 segment {index} produced no frames")
+                output.write(memoryview(data)[kept[0][0]:kept[-1][0] + kept[-1][1]])
+    except BaseException:
+        for job in jobs:
+            job.cancel()
+        raise
+
+
+def encode_mp3(path: str, output_path: str, duration: Optional[float] = None,
+               limit: int = MP3_DELIVERY_LIMIT, priority: int = PRIORITY_AUDIO):
+    """MP3 с битрейтом под limit; длинные записи кодируются на всех воркерах пула"""
+    started = time.monotonic()
+    duration = duration or probe_media(path).duration
+    bitrate = mp3_bitrate(duration, limit)
+    transcoder = get_transcoder()
+    segments = min(transcoder.max_workers, int((duration or 0) // MP3_MIN_SEGMENT_SECONDS))
+    parallel_min = float(os.getenv('MP3_PARALLEL_MIN_SECONDS', MP3_PARALLEL_MIN_SECONDS))
+    if duration and duration >= parallel_min and segments > 1:
+        encode_mp3_parallel(path, output_path, duration, bitrate, segments, priority)
+    else:
+        transcoder.run(
+            ffmpeg.input(path).output(output_path, acodec='mp3', audio_bitrate=f"{bitrate}k").overwrite_output(),
+            priority=priority
+        )
+        segments = 1
+    logger.info(f"MP3 {bitrate} kbps, {segments} segment(s): {path} -> {os.path.getsize(output_path)} bytes "
+                f"in {time.monotonic() - started:.1f}s")
+
+
+def encode_mp3_bytes(data: bytes, duration: Optional[float] = None, limit: int = MP3_DELIVERY_LIMIT,
+                     priority: int = PRIORITY_AUDIO) -> bytes:
+    """MP3 из байтов через pipe с тем же выбором битрейта, что и encode_mp3"""
+    bitrate = mp3_bitrate(duration, limit)
+    return get_transcoder().run(
+        ffmpeg.input('pipe:0').output('pipe:1', format='mp3', acodec='mp3', audio_bitrate=f"{bitrate}k"),
+        priority=priority,
+        input_data=data
+    )
+
+
+# Сжатие под лимит отправки: двухпроходное ABR вместо нарезки на части
+FIT_MAX_OVERSHOOT = 2.0
+FIT_AUDIO_BITRATE = 96 * 1000
+FIT_MIN_VIDEO_BITRATE = 250 * 1000
+# Запас на контейнер и неточность ABR
+FIT_SIZE_MARGIN = 0.95
+# Секунды процессорного времени на секунду видео 720p за оба прохода (preset veryfast)
+FIT_CPU_PER_SECOND_720P = 0.6
+FIT_PRESET = 'veryfast'
+
+_fit_slots = None
+_fit_slots_lock = threading.Lock()
+
+
+def _get_fit_slots() -> threading.BoundedSemaphore:
+    """Слоты сжатия создаются при первом использовании, когда окружение уже загружено"""
+    global _fit_slots
+    with _fit_slots_lock:
+        if _fit_slots is None:
+            _fit_slots = threading.BoundedSemaphore(int(os.getenv('FIT_MAX_JOBS', '1')))
+        return _fit_slots
+
+
+class FitPlan:
+    """Параметры сжатия файла под лимит"""
+
+    def __init__(self, duration: float, width: int, height: int, video_bitrate: int,
+                 audio_bitrate: int, estimated_seconds: float):
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.video_bitrate = video_bitrate
+        self.audio_bitrate = audio_bitrate
+        self.estimated_seconds = estimated_seconds
+
+
+def fit_bitrate(duration: float, limit: int, audio_bitrate: int = FIT_AUDIO_BITRATE) -> int:
+    """Битрейт видео (бит/с), при котором файл длительностью duration влезет в limit байт"""
+    total = limit * 8 * FIT_SIZE_MARGIN / duration
+    return int(total - audio_bitrate)
+
+
+def plan_fit_to_limit(path: str, limit: int, max_overshoot: float = FIT_MAX_OVERSHOOT,
+                      max_seconds: Optional[float] = None) -> Optional[FitPlan]:
+    """План сжатия или None, если сжатие невыгодно.
+
+    Сжимаем только при небольшом превышении лимита, если битрейт не падает ниже
+    порога качества и прогноз времени кодирования укладывается в max_seconds.
+    """
+    if max_seconds is None:
+        max_seconds = float(os.getenv('FIT_MAX_SECONDS', '300'))
+    try:
+        size = os.path.getsize(path)
+        if size <= limit or size > limit * max_overshoot:
+            return None
+
+        info = ffmpeg.probe(path)
+        duration = float(info.get('format', {}).get('duration') or 0)
+        video = next((s for s in info.get('streams', []) if s.get('codec_type') == 'video'), None)
+        if not duration or not video:
+            return None
+    except Exception as e:
+        logger.warning(f"Cannot plan fit-to-limit for {path}: {e}")
+        return None
+
+    width, height = int(video.get('width') or 0), int(video.get('height') or 0)
+    video_bitrate = fit_bitrate(duration, limit)
+    if video_bitrate < FIT_MIN_VIDEO_BITRATE:
+        logger.info(f"Fit-to-limit skipped for {path}: target bitrate {video_bitrate} too low")
+        return None
+
+    pixels = (width * height) / (1280 * 720) if width and height else 1.0
+    cpu_seconds = duration * pixels * FIT_CPU_PER_SECOND_720P
+    estimated_seconds = cpu_seconds / get_transcoder().threads_per_job
+    if estimated_seconds > max_seconds:
+        logger.info(f"Fit-to-limit skipped for {path}: ~{estimated_seconds:.0f}s of encoding")
+        return None
+
+    return FitPlan(duration, width, height, video_bitrate, FIT_AUDIO_BITRATE, estimated_seconds)
+
+
+def compress_to_limit(path: str, output_path: str, plan: FitPlan, limit: int,
+                      priority: int = PRIORITY_BACKGROUND) -> bool:
+    """Двухпроходное кодирование libx264 с целевым битрейтом из плана"""
+    transcoder = get_transcoder()
+    log_dir = tempfile.mkdtemp(prefix='ffmpeg2pass-')
+    passlogfile = os.path.join(log_dir, 'pass')
+    video_params = {
+        'vcodec': 'libx264',
+        'preset': FIT_PRESET,
+        'video_bitrate': plan.video_bitrate,
+        'maxrate': int(plan.video_bitrate * 1.5),
+        'bufsize': plan.video_bitrate * 2,
+        'passlogfile': passlogfile,
+    }
+    started = time.monotonic()
+    # Слоты ограничивают число одновременных сжатий, чтобы не занять весь пул ffmpeg
+    with _get_fit_slots():
+        try:
+            transcoder.run(
+                ffmpeg.input(path).output(os.devnull, format='null', an=None, **{'pass': 1}, **video_params)
+                .overwrite_output(),
+                priority=priority
+            )
+            transcoder.run(
+                ffmpeg.input(path).output(output_path, acodec='aac', audio_bitrate=plan.audio_bitrate,
+                                          movflags=FASTSTART_MOVFLAGS, **{'pass': 2}, **video_params)
+                .overwrite_output(),
+                priority=priority
+            )
+        finally:
+            shutil.rmtree(log_dir, ignore_errors=True)
+
+    size = os.path.getsize(output_path)
+    logger.info(f"Fit-to-limit: {path} -> {size} bytes in {time.monotonic() - started:.1f}s "
+                f"(predicted {plan.estimated_seconds:.0f}s)")
+    if size > limit:
+        os.remove(output_path)
+        return False
+    return True
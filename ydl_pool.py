@@ -0,0 +1,78 @@
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Optional, List, Dict, Tuple, Callable
+
+import yt_dlp
+
+from identity_pool import Identity
+
+logger = logging.getLogger(__name__)
+
+
+class YDLPool:
+    """Пул заранее созданных экземпляров YoutubeDL с общим профилем параметров.
+
+    Экземпляр выдается одному запросу за раз; параметры запроса (формат, хуки прогресса)
+    накладываются на время выдачи и откатываются при возврате в пул.
+    """
+
+    def __init__(self, base_opts: dict, max_idle_per_identity: int = 4):
+        self.base_opts = dict(base_opts)
+        self.max_idle_per_identity = max_idle_per_identity
+        self._idle: Dict[Tuple, List[yt_dlp.YoutubeDL]] = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    @contextmanager
+    def checkout(self, identity: Identity, overrides: Optional[dict] = None,
+                 progress_hooks: Optional[List[Callable]] = None):
+        key = (identity.cookiefile, identity.source_address)
+        ydl = self._take(key, identity)
+
+        saved_params = ydl.params
+        saved_hooks = ydl._progress_hooks
+        saved_selector = getattr(ydl, 'format_selector', None)
+        try:
+            # Своя копия параметров и списка хуков на каждую выдачу: общие объекты экземпляра
+            # не меняются, и откат - просто возврат прежних ссылок
+            ydl.params = dict(saved_params, **(overrides or {}))
+            ydl._progress_hooks = list(saved_hooks) + list(progress_hooks or ())
+            # Селектор формата строится в конструкторе, поэтому пересобираем его явно
+            if overrides and 'format' in overrides and hasattr(ydl, 'build_format_selector'):
+                ydl.format_selector = ydl.build_format_selector(overrides['format'])
+            ydl._download_retcode = 0
+            yield ydl
+        finally:
+            ydl.params = saved_params
+            ydl._progress_hooks = saved_hooks
+            if saved_selector is not None:
+                ydl.format_selector = saved_selector
+            self._give_back(key, ydl)
+
+    def _take(self, key: Tuple, identity: Identity) -> yt_dlp.YoutubeDL:
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self.reused += 1
+                return idle.pop()
+            self.created += 1
+        logger.debug(f"Creating YoutubeDL instance for identity {identity.name}")
+        return yt_dlp.YoutubeDL(identity.apply(dict(self.base_opts)))
+
+    def _give_back(self, key: Tuple, ydl: yt_dlp.YoutubeDL):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_identity:
+                idle.append(ydl)
+                return
+        ydl.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for instances in idle.values():
+            for ydl in instances:
+                ydl.close()
+
@@ -0,0 +1,116 @@
+import re
+from typing import Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+# ID видео на YouTube - 11 символов из base64url алфавита
+VIDEO_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+# Компилируется один раз при импорте, а не на каждое сообщение
+YOUTUBE_URL_RE = re.compile(
+    r'(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/'
+    r'(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})'
+)
+
+
+def is_youtube_url(text: str) -> bool:
+    return bool(YOUTUBE_URL_RE.match(text))
+
+
+def extract_video_id(url: str) -> Optional[str]:
+    """Возвращает канонический ID видео из ссылки YouTube или None"""
+    try:
+        if VIDEO_ID_RE.match(url):
+            return url
+        if '://' not in url:
+            url = 'https://' + url
+
+        parsed = urlparse(url)
+        host = (parsed.hostname or '').lower()
+        path_parts = [part for part in parsed.path.split('/') if part]
+
+        query = parse_qs(parsed.query)
+
+        if host.endswith('youtu.be') and path_parts:
+            candidate = path_parts[0]
+        elif 'v' in query:
+            candidate = query['v'][0]
+        elif len(path_parts) >= 2 and path_parts[0] in ('embed', 'v', 'shorts', 'live'):
+            candidate = path_parts[1]
+        else:
+            return None
+
+        return candidate if VIDEO_ID_RE.match(candidate) else None
+    except Exception:
+        return None
+
+
+# Время: 90, 90s, 1:30, 1:02:03, 1h2m3s, 2m
+_CLOCK_RE = re.compile(r'^(?:(\d+):)?(\d{1,2}):(\d{1,2})(?:\.\d+)?$|^(\d+(?:\.\d+)?)$')
+_UNITS_RE = re.compile(r'^(?:(\d+)h)?(?:(\d+)m)?(?:(\d+(?:\.\d+)?)s?)?$')
+_RANGE_SPLIT_RE = re.compile(r'\s*(?:-|–|—|\.\.)\s*|\s+')
+
+
+def parse_timestamp(text: str) -> Optional[float]:
+    """Секунды из записи времени или None"""
+    text = text.strip().lower()
+    if not text:
+        return None
+    match = _CLOCK_RE.match(text)
+    if match:
+        hours, minutes, seconds, plain = match.groups()
+        if plain is not None:
+            return float(plain)
+        return int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds)
+    match = _UNITS_RE.match(text)
+    if match and any(match.groups()):
+        hours, minutes, seconds = match.groups()
+        return int(hours or 0) * 3600 + int(minutes or 0) * 60 + float(seconds or 0)
+    return None
+
+
+def format_timestamp(seconds: float) -> str:
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+def parse_clip_request(message: str) -> Tuple[str, Optional[Tuple[float, float]]]:
+    """Ссылка и фрагмент (начало, конец) из сообщения.
+
+    Поддерживается "ссылка 1:23-2:45", "ссылка 1:23 2:45" и "ссылка?t=83 2:45",
+    где начало берется из параметра t, а конец - из сообщения.
+    """
+    parts = message.strip().split(None, 1)
+    url = parts[0] if parts else ''
+    rest = parts[1].strip() if len(parts) > 1 else ''
+    if not rest:
+        return url, None
+
+    times = [parse_timestamp(part) for part in _RANGE_SPLIT_RE.split(rest) if part]
+    if len(times) == 1:
+        times = [url_start_time(url)] + times
+    if len(times) != 2 or None in times:
+        return url, None
+
+    start, end = times
+    if end <= start:
+        return url, None
+    return url, (start, end)
+
+
+def clamp_clip(clip: Optional[Tuple[float, float]], duration: Optional[float]) -> Optional[Tuple[float, float]]:
+    """Фрагмент в пределах длительности видео; None, если он начинается после конца"""
+    if not clip or not duration:
+        return clip
+    start, end = clip[0], min(clip[1], duration)
+    return (start, end) if start < end else None
+
+
+def url_start_time(url: str) -> Optional[float]:
+    """Время из параметра t= (или start=) ссылки YouTube"""
+    if '://' not in url:
+        url = 'https://' + url
+    query = parse_qs(urlparse(url).query)
+    value = (query.get('t') or query.get('start') or [None])[0]
+    return parse_timestamp(value) if value else None